@@ -21,6 +21,7 @@ from tqdm import tqdm
 import re
 
 from . import custom_routes
+from workflow_compiler import register_node_classes
 # import routes
 
 ag_path = os.path.join(os.path.dirname(__file__))
@@ -86,5 +87,8 @@ for file in files:
                 # print(display_name, name)
                 NODE_DISPLAY_NAME_MAPPINGS[name] = display_name
 
+# Input bindings the nodes declare, used to compile the inputs of a run
+register_node_classes(NODE_CLASS_MAPPINGS)
+
 WEB_DIRECTORY = "web-plugin"
 __all__ = ["NODE_CLASS_MAPPINGS", "NODE_DISPLAY_NAME_MAPPINGS"]
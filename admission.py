@@ -0,0 +1,508 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+# Dispatched strictly in this order, a lower class only runs when the higher
+# ones have nothing dispatchable
+PRIORITY_CLASSES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+DEFAULT_TENANT = "default"
+
+
+def parse_tenant_map(spec, cast=float):
+    """Parse "tenant_a=3,tenant_b=1,*=2" into {tenant: value}, * is the default"""
+    values = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        try:
+            tenant, value = part.rsplit("=", 1)
+            values[tenant.strip()] = cast(value)
+        except ValueError:
+            logger.warning(f"Ignoring invalid admission rule: {part}")
+    return values
+
+
+def tenant_key(data, token=None):
+    """The tenant a run is accounted to, its `tenant` field or else its token"""
+    tenant = data.get("tenant")
+    if tenant:
+        return str(tenant)
+    if token:
+        # Runs of one token share a tenant without the token ending up in stats
+        return "token:" + hashlib.sha256(token.encode()).hexdigest()[:16]
+    return DEFAULT_TENANT
+
+
+class AdmissionTicket:
+    __slots__ = ("tenant", "priority")
+
+    def __init__(self, tenant=DEFAULT_TENANT, priority=DEFAULT_PRIORITY):
+        self.tenant = tenant
+        self.priority = priority if priority in PRIORITY_CLASSES else DEFAULT_PRIORITY
+
+    @classmethod
+    def from_request(cls, data, token=None):
+        return cls(tenant_key(data, token), data.get("priority") or DEFAULT_PRIORITY)
+
+
+class AdmittedRun:
+    __slots__ = ("prompt_id", "entry", "ticket", "key", "submitted_at")
+
+    def __init__(self, prompt_id, entry, ticket, key):
+        self.prompt_id = prompt_id
+        self.entry = entry
+        self.ticket = ticket
+        # (finish tag, sequence, prompt_id), the order within its class
+        self.key = key
+        self.submitted_at = time.monotonic()
+
+
+class AdmissionScheduler:
+    """
+    Holds validated deploy runs in front of the ComfyUI prompt queue and
+    releases them while `can_dispatch()` allows, so the order is decided as
+    late as possible.
+
+    Priority classes are served strictly in order. Within a class tenants
+    share the GPU by weight with self-clocked fair queuing: a run is tagged
+    on arrival with its tenant's previous tag (or the class's virtual time,
+    whichever is later) plus 1 / weight, and runs go out in tag order. A
+    tenant at its concurrency cap is skipped until one of its runs finishes.
+    """
+
+    def __init__(
+        self,
+        dispatch,
+        can_dispatch,
+        weights=None,
+        caps=None,
+        retry_interval=0.25,
+    ):
+        # dispatch(prompt_id, entry) queues a run, can_dispatch() -> bool
+        self.dispatch = dispatch
+        self.can_dispatch = can_dispatch
+        self.weights = weights or {}
+        self.caps = caps or {}
+        self.retry_interval = retry_interval
+        self.queues = {priority: [] for priority in PRIORITY_CLASSES}
+        self.waiting = {}  # prompt_id -> AdmittedRun
+        self.virtual_time = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self.last_tags = {}  # (priority, tenant) -> finish tag of its last run
+        self.running = {}  # prompt_id -> tenant
+        self.running_by_tenant = {}
+        self.waiting_by_tenant = {}
+        self.sequence = itertools.count()
+        # prompt_id -> position, rebuilt on the first lookup after a change
+        self.positions = None
+        self.retry_handle = None
+        self.counters = {
+            "submitted": 0,
+            "dispatched": 0,
+            "finished": 0,
+            "cancelled": 0,
+            "dispatch_errors": 0,
+        }
+
+    def weight(self, tenant):
+        return max(self.weights.get(tenant, self.weights.get("*", 1.0)), 1e-6)
+
+    def cap(self, tenant):
+        """Most runs of the tenant dispatched at once, 0 for no cap"""
+        return int(self.caps.get(tenant, self.caps.get("*", 0)))
+
+    def submit(self, prompt_id, entry, ticket: AdmissionTicket):
+        self.cancel(prompt_id, count=False)
+        priority, tenant = ticket.priority, ticket.tenant
+
+        start = max(
+            self.virtual_time[priority], self.last_tags.get((priority, tenant), 0.0)
+        )
+        tag = start + 1.0 / self.weight(tenant)
+        self.last_tags[(priority, tenant)] = tag
+
+        key = (tag, next(self.sequence), prompt_id)
+        bisect.insort(self.queues[priority], key)
+        self.waiting[prompt_id] = AdmittedRun(prompt_id, entry, ticket, key)
+        self._count_waiting(tenant, 1)
+        self.positions = None
+        self.counters["submitted"] += 1
+
+        self.pump()
+        return self.state(prompt_id)
+
+    def cancel(self, prompt_id, count=True):
+        """Drop a run that was not dispatched yet, True if it was waiting"""
+        run = self.waiting.pop(prompt_id, None)
+        if run is None:
+            return False
+        queue = self.queues[run.ticket.priority]
+        index = bisect.bisect_left(queue, run.key)
+        if index < len(queue) and queue[index] == run.key:
+            del queue[index]
+        self._count_waiting(run.ticket.tenant, -1)
+        self.positions = None
+        if count:
+            self.counters["cancelled"] += 1
+        return True
+
+    def finish(self, prompt_id):
+        """A dispatched run left the GPU, its tenant may dispatch again"""
+        tenant = self.running.pop(prompt_id, None)
+        if tenant is None:
+            return
+        self.counters["finished"] += 1
+        remaining = self.running_by_tenant.get(tenant, 1) - 1
+        if remaining > 0:
+            self.running_by_tenant[tenant] = remaining
+        else:
+            self.running_by_tenant.pop(tenant, None)
+        self.pump()
+
+    def pump(self):
+        while self.waiting and self.can_dispatch():
+            run = self._next()
+            if run is None:
+                # Everything waiting is capped, finish() pumps again
+                return
+            self._dispatch(run)
+
+        if self.waiting and self.retry_handle is None and self._has_dispatchable():
+            # The prompt queue is full, nothing signals when it drains
+            loop = asyncio.get_running_loop()
+            self.retry_handle = loop.call_later(self.retry_interval, self._retry)
+
+    def _retry(self):
+        self.retry_handle = None
+        self.pump()
+
+    def _capped(self, tenant):
+        cap = self.cap(tenant)
+        return cap > 0 and self.running_by_tenant.get(tenant, 0) >= cap
+
+    def _count_waiting(self, tenant, delta):
+        remaining = self.waiting_by_tenant.get(tenant, 0) + delta
+        if remaining > 0:
+            self.waiting_by_tenant[tenant] = remaining
+        else:
+            self.waiting_by_tenant.pop(tenant, None)
+
+    def _has_dispatchable(self):
+        return any(not self._capped(tenant) for tenant in self.waiting_by_tenant)
+
+    def _next(self):
+        for priority in PRIORITY_CLASSES:
+            queue = self.queues[priority]
+            for index, key in enumerate(queue):
+                run = self.waiting[key[2]]
+                if self._capped(run.ticket.tenant):
+                    continue
+                del queue[index]
+                # Self clocked: virtual time is the tag of the run last served
+                self.virtual_time[priority] = key[0]
+                last_key = (priority, run.ticket.tenant)
+                if self.last_tags.get(last_key, 0.0) <= key[0]:
+                    # Caught up, a new run starts from the virtual time anyway
+                    self.last_tags.pop(last_key, None)
+                return run
+        return None
+
+    def _dispatch(self, run: AdmittedRun):
+        del self.waiting[run.prompt_id]
+        self.positions = None
+        tenant = run.ticket.tenant
+        self._count_waiting(tenant, -1)
+        try:
+            self.dispatch(run.prompt_id, run.entry)
+        except Exception as e:
+            self.counters["dispatch_errors"] += 1
+            logger.error(f"Failed to dispatch {run.prompt_id}: {e}")
+            return
+        self.running[run.prompt_id] = tenant
+        self.running_by_tenant[tenant] = self.running_by_tenant.get(tenant, 0) + 1
+        self.counters["dispatched"] += 1
+
+    def _build_positions(self):
+        positions = {}
+        for priority in PRIORITY_CLASSES:
+            for key in self.queues[priority]:
+                positions[key[2]] = len(positions)
+        self.positions = positions
+
+    def state(self, prompt_id):
+        """
+        Whether a run is waiting or dispatched, without its position so a
+        burst of submits doesn't rebuild the positions after every one
+        """
+        run = self.waiting.get(prompt_id)
+        if run is None:
+            if prompt_id in self.running:
+                return {"prompt_id": prompt_id, "state": "dispatched"}
+            return None
+        return {
+            "prompt_id": prompt_id,
+            "state": "waiting",
+            "priority": run.ticket.priority,
+            "tenant": run.ticket.tenant,
+        }
+
+    def position(self, prompt_id):
+        """
+        Where a run stands, in O(1) between queue changes. The position is
+        the number of waiting runs that go before it, a capped tenant's runs
+        can still be overtaken until its cap frees up.
+        """
+        run = self.waiting.get(prompt_id)
+        if run is None:
+            if prompt_id in self.running:
+                return {"prompt_id": prompt_id, "state": "dispatched"}
+            return None
+
+        if self.positions is None:
+            self._build_positions()
+        return {
+            "prompt_id": prompt_id,
+            "state": "waiting",
+            "position": self.positions[prompt_id],
+            "priority": run.ticket.priority,
+            "tenant": run.ticket.tenant,
+            "capped": self._capped(run.ticket.tenant),
+            "waiting_seconds": round(time.monotonic() - run.submitted_at, 3),
+        }
+
+    def stats(self):
+        tenants = {}
+        for tenant, waiting in self.waiting_by_tenant.items():
+            tenants[tenant] = {"waiting": waiting}
+        for tenant, running in self.running_by_tenant.items():
+            tenants.setdefault(tenant, {"waiting": 0})["running"] = running
+        for tenant, info in tenants.items():
+            info.setdefault("running", 0)
+            info["weight"] = self.weight(tenant)
+            info["cap"] = self.cap(tenant)
+        return {
+            **self.counters,
+            "waiting": {p: len(q) for p, q in self.queues.items()},
+            "running": len(self.running),
+            "tenants": tenants,
+        }
+
+
+def parse_deadline(data, now=None):
+    """
+    Latest time (unix seconds) a run may start, from its `deadline` (unix
+    seconds) or `max_queue_time` (seconds from now), None without either
+    """
+    now = time.time() if now is None else now
+    deadlines = []
+    try:
+        if data.get("deadline") is not None:
+            deadlines.append(float(data["deadline"]))
+        if data.get("max_queue_time") is not None:
+            deadlines.append(now + float(data["max_queue_time"]))
+    except (TypeError, ValueError):
+        logger.warning("Ignoring invalid deadline or max_queue_time")
+        return None
+    return min(deadlines) if deadlines else None
+
+
+class RuntimeEstimator:
+    """Expected execution seconds per workflow, an EWMA of its past runs"""
+
+    def __init__(self, default_seconds=30.0, alpha=0.3, max_workflows=512):
+        self.default_seconds = default_seconds
+        self.alpha = alpha
+        self.max_workflows = max_workflows
+        self.history = OrderedDict()  # workflow key -> (seconds, samples)
+
+    def estimate(self, workflow_key):
+        known = self.history.get(workflow_key)
+        return known[0] if known is not None else self.default_seconds
+
+    def observe(self, workflow_key, seconds):
+        known = self.history.pop(workflow_key, None)
+        if known is None:
+            self.history[workflow_key] = (seconds, 1)
+        else:
+            estimate = known[0] + self.alpha * (seconds - known[0])
+            self.history[workflow_key] = (estimate, known[1] + 1)
+        while len(self.history) > self.max_workflows:
+            self.history.popitem(last=False)
+
+
+class TrackedRun:
+    __slots__ = ("workflow_key", "estimate", "deadline", "started_at")
+
+    def __init__(self, workflow_key, estimate, deadline):
+        self.workflow_key = workflow_key
+        self.estimate = estimate
+        self.deadline = deadline
+        self.started_at = None
+
+
+class DeadlineTracker:
+    """
+    Tracks deploy runs from submission until they leave the GPU, to tell
+    when a new run would start: the estimated execution time of every run
+    queued ahead of it, plus what is left of the running ones, plus
+    untracked prompts in the queue at the default estimate. Runs that can't
+    start by their deadline are rejected up front, and queued runs whose
+    deadline passes are handed to `evict(prompt_id)` before they reach the
+    GPU.
+    """
+
+    def __init__(self, estimator: RuntimeEstimator, evict, queue_depth=None):
+        self.estimator = estimator
+        # evict(prompt_id) -> True if the run was removed from its queue
+        self.evict = evict
+        # queue_depth() -> prompts in the ComfyUI queue, tracked or not
+        self.queue_depth = queue_depth
+        self.runs = {}  # prompt_id -> TrackedRun
+        self.queued_seconds = 0.0
+        self.queued = 0
+        self.deadlines = []  # heap of (deadline, prompt_id)
+        self.timer = None
+        self.counters = {"admitted": 0, "rejected": 0, "evicted": 0, "observed": 0}
+
+    def expected_wait(self):
+        now = time.monotonic()
+        wait = self.queued_seconds
+        running = 0
+        for run in self.runs.values():
+            if run.started_at is not None:
+                running += 1
+                wait += max(0.0, run.estimate - (now - run.started_at))
+        if self.queue_depth is not None:
+            untracked = self.queue_depth() - running - self.queued
+            if untracked > 0:
+                wait += untracked * self.estimator.default_seconds
+        return wait
+
+    def admit(self, prompt_id, workflow_key, deadline=None):
+        """Start tracking a run, (False, expected wait) if it can't make its deadline"""
+        self.forget(prompt_id)
+        wait = self.expected_wait()
+        if deadline is not None and time.time() + wait > deadline:
+            self.counters["rejected"] += 1
+            return False, wait
+
+        run = TrackedRun(workflow_key, self.estimator.estimate(workflow_key), deadline)
+        self.runs[prompt_id] = run
+        self.queued += 1
+        self.queued_seconds += run.estimate
+        self.counters["admitted"] += 1
+        if deadline is not None:
+            heapq.heappush(self.deadlines, (deadline, prompt_id))
+            self._schedule()
+        return True, wait
+
+    def started(self, prompt_id):
+        run = self.runs.get(prompt_id)
+        if run is None or run.started_at is not None:
+            return
+        run.started_at = time.monotonic()
+        self._unqueue(run)
+
+    def finished(self, prompt_id, seconds):
+        """The run left the GPU after `seconds` of execution"""
+        run = self.runs.get(prompt_id)
+        if run is None:
+            return
+        if seconds is not None and seconds > 0:
+            self.estimator.observe(run.workflow_key, seconds)
+            self.counters["observed"] += 1
+        self.forget(prompt_id)
+
+    def forget(self, prompt_id):
+        """Stop tracking a run that won't run, or ended without a timing"""
+        run = self.runs.pop(prompt_id, None)
+        if run is not None and run.started_at is None:
+            self._unqueue(run)
+
+    def _unqueue(self, run):
+        self.queued -= 1
+        self.queued_seconds = max(0.0, self.queued_seconds - run.estimate)
+
+    def _schedule(self):
+        if not self.deadlines:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = max(0.0, self.deadlines[0][0] - time.time())
+        self.timer = asyncio.get_running_loop().call_later(delay, self._sweep)
+
+    def _sweep(self):
+        self.timer = None
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, prompt_id = heapq.heappop(self.deadlines)
+            run = self.runs.get(prompt_id)
+            # Already started, finished, or tracked again with another deadline
+            if run is None or run.started_at is not None or run.deadline != deadline:
+                continue
+            if self.evict(prompt_id):
+                self.counters["evicted"] += 1
+                self.forget(prompt_id)
+        self._schedule()
+
+    def stats(self):
+        return {
+            **self.counters,
+            "tracked": len(self.runs),
+            "queued": self.queued,
+            "expected_wait": round(self.expected_wait(), 3),
+            "workflows_timed": len(self.estimator.history),
+        }
+
+
+class SubmissionIndex:
+    """
+    Responses of recent run submissions by prompt_id, so a retried
+    submission gets the first response instead of queuing the run twice.
+    A retry arriving while the first is still being validated waits for it.
+    Bounded to the `max_entries` most recent prompt_ids, and submissions
+    that were not taken on (5xx, or 409 for an unknown workflow) are
+    forgotten so they can be retried.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # prompt_id -> Future of (status, body)
+        self.counters = {"submissions": 0, "duplicates": 0, "forgotten": 0}
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.entries
+
+    def claim(self, prompt_id):
+        """None when prompt_id is new and the caller has to resolve() it,
+        else the Future of the first submission's (status, body)"""
+        future = self.entries.get(prompt_id)
+        if future is not None:
+            self.entries.move_to_end(prompt_id)
+            self.counters["duplicates"] += 1
+            return future
+
+        self.counters["submissions"] += 1
+        self.entries[prompt_id] = asyncio.get_running_loop().create_future()
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return None
+
+    def resolve(self, prompt_id, status, body):
+        future = self.entries.get(prompt_id)
+        if future is None or future.done():
+            return
+        future.set_result((status, body))
+        if status >= 500 or status == 409:
+            del self.entries[prompt_id]
+            self.counters["forgotten"] += 1
+
+    def stats(self):
+        return {**self.counters, "entries": len(self.entries)}
@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from logging import getLogger
+from urllib.parse import urlencode, quote
+
+from aiohttp import web
+
+logger = getLogger("comfy-deploy")
+
+DEFAULT_API_URL = "https://api.comfydeploy.com"
+
+
+def pick(*fields, **defaults):
+    """Body builder forwarding the given fields from the request body"""
+
+    def build(data):
+        body = {field: data.get(field) for field in fields}
+        for field, value in defaults.items():
+            body[field] = data.get(field, value)
+        return body
+
+    return build
+
+
+def passthrough(data):
+    """Body builder forwarding the request body without api_url"""
+    return {k: v for k, v in data.items() if k != "api_url"}
+
+
+class ProxyRoute:
+    """
+    One proxied Comfy Deploy API endpoint.
+
+    Path parameters (`{workflow_id}`) and `api_url` are read from the query
+    string for GET routes and from the JSON body otherwise. `query` lists the
+    query params forwarded upstream (only when set, after `defaults`), `body`
+    builds the upstream JSON body, and `cache_ttl` > 0 makes a GET route
+    cacheable for that many seconds.
+    """
+
+    def __init__(
+        self,
+        method,
+        path,
+        upstream_path,
+        upstream_method=None,
+        query=(),
+        defaults=None,
+        body=None,
+        required=(),
+        require_auth=True,
+        cache_ttl=0,
+    ):
+        self.method = method
+        self.path = path
+        self.upstream_path = upstream_path
+        self.upstream_method = upstream_method or method
+        self.query = query
+        self.defaults = defaults or {}
+        self.body = body
+        self.required = required
+        self.require_auth = require_auth
+        self.cache_ttl = cache_ttl
+
+
+class CachedResponse:
+    __slots__ = ("status", "body", "content_type", "etag", "expires_at")
+
+    def __init__(self, status, body, content_type, etag, expires_at):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+class ApiProxy:
+    """
+    Shared engine behind the Comfy Deploy API proxies. Identical concurrent
+    GETs share one upstream request, and cacheable GETs are kept for a short
+    TTL per auth token, then revalidated with their ETag.
+    """
+
+    def __init__(self, get_session, max_entries=256):
+        # async get_session(url) -> aiohttp.ClientSession
+        self.get_session = get_session
+        self.max_entries = max_entries
+        self.cache = OrderedDict()  # key -> CachedResponse
+        self.in_flight = {}  # key -> Future
+        self.counters = {
+            "requests": 0,
+            "hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "coalesced": 0,
+            "upstream_requests": 0,
+            "errors": 0,
+        }
+
+    def register(self, routes, route: ProxyRoute):
+        async def handler(request):
+            return await self.handle(route, request)
+
+        routes.route(route.method, route.path)(handler)
+
+    async def handle(self, route: ProxyRoute, request):
+        self.counters["requests"] += 1
+        auth_header = request.headers.get("Authorization")
+
+        if route.require_auth and not auth_header:
+            return web.json_response(
+                {"error": "Authorization header is required"}, status=401
+            )
+
+        if route.method == "GET":
+            data = dict(request.rel_url.query)
+        else:
+            data = await request.json()
+
+        missing = [field for field in route.required if not data.get(field)]
+        if missing:
+            verb = "is" if len(route.required) == 1 else "are"
+            return web.json_response(
+                {"error": f"{', '.join(route.required)} {verb} required"}, status=400
+            )
+
+        api_url = data.get("api_url", DEFAULT_API_URL)
+        path_params = {
+            k: quote(str(v), safe="") for k, v in data.items() if v is not None
+        }
+        try:
+            target_url = api_url + route.upstream_path.format_map(
+                _MissingAsNone(path_params)
+            )
+        except (KeyError, ValueError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+
+        params = {}
+        for field in route.query:
+            value = data.get(field, route.defaults.get(field))
+            if value:
+                params[field] = value
+        if params:
+            target_url += f"?{urlencode(params)}"
+
+        headers = {"Authorization": auth_header} if auth_header else {}
+        body = route.body(data) if route.body is not None else None
+
+        try:
+            if route.upstream_method == "GET":
+                cached = await self._get(route, target_url, headers, auth_header)
+            else:
+                # Anything that writes makes this token's cached reads stale
+                self.invalidate(auth_header)
+                cached = await self._fetch(
+                    route.upstream_method, target_url, headers, body, None
+                )
+        except Exception as e:
+            self.counters["errors"] += 1
+            return web.json_response({"error": str(e)}, status=500)
+
+        return web.Response(
+            body=cached.body, status=cached.status, content_type=cached.content_type
+        )
+
+    async def _get(self, route, target_url, headers, auth_header):
+        key = self._key(auth_header, target_url)
+
+        cached = self.cache.get(key)
+        if cached is not None and cached.expires_at > time.monotonic():
+            self.cache.move_to_end(key)
+            self.counters["hits"] += 1
+            return cached
+
+        # Single flight, identical concurrent GETs share one upstream request
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await self._fetch("GET", target_url, headers, None, cached)
+            if route.cache_ttl > 0 and result.status == 200:
+                result.expires_at = time.monotonic() + route.cache_ttl
+                self._store(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting, don't let the exception go unretrieved
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                # Cancelled, the coalesced requests must not wait forever
+                future.set_exception(
+                    RuntimeError(f"Upstream request to {target_url} was cancelled")
+                )
+                future.exception()
+            self.in_flight.pop(key, None)
+
+    async def _fetch(self, method, target_url, headers, body, cached):
+        if cached is not None and cached.etag:
+            headers = {**headers, "If-None-Match": cached.etag}
+
+        self.counters["upstream_requests"] += 1
+        session = await self.get_session(target_url)
+        async with session.request(
+            method, target_url, json=body, headers=headers
+        ) as response:
+            if response.status == 304 and cached is not None:
+                self.counters["revalidated"] += 1
+                return CachedResponse(
+                    cached.status, cached.body, cached.content_type, cached.etag, 0
+                )
+
+            return CachedResponse(
+                response.status,
+                await response.read(),
+                response.content_type or "application/json",
+                response.headers.get("ETag"),
+                0,
+            )
+
+    def _key(self, auth_header, target_url):
+        scope = hashlib.sha256((auth_header or "").encode()).hexdigest()
+        return (scope, target_url)
+
+    def _store(self, key, result):
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    def invalidate(self, auth_header):
+        scope = self._key(auth_header, "")[0]
+        for key in [k for k in self.cache if k[0] == scope]:
+            del self.cache[key]
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_ratio": round(self.counters["hits"] / lookups, 3) if lookups else 0,
+            "cached_entries": len(self.cache),
+            "in_flight": len(self.in_flight),
+        }
+
+
+class _MissingAsNone(dict):
+    def __missing__(self, key):
+        # Matches the hand written proxies, which sent "None" for a missing id
+        return "None"
@@ -7,6 +7,7 @@ class ComfyUIDeployExternalAudio:
     RETURN_NAMES = ("audio",)
     FUNCTION = "load_audio"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "audio_file"
 
     @classmethod
     def INPUT_TYPES(cls):
@@ -26,6 +26,7 @@ class ComfyUIDeployExternalBoolean:
         
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "default_value"
     
     def run(self, input_id, default_value=None, display_name=None, description=None):
         print(f"Node '{input_id}' processing with switch set to {default_value}")
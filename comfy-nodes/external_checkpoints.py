@@ -41,6 +41,7 @@ class ComfyUIDeployExternalCheckpoint:
     FUNCTION = "run"
 
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "default_value"
 
     def run(self, input_id, default_value=None, display_name=None, description=None):
         import requests
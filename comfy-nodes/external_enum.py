@@ -41,6 +41,7 @@ class ComfyUIDeployExternalEnum:
     FUNCTION = "run"
 
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "default_value"
 
     def run(self, input_id, options=None, default_value=None, display_name=None, description=None):
         return [default_value]
\ No newline at end of file
@@ -11,6 +11,7 @@ class ComfyUIDeployExternalEXR:
     RETURN_NAMES = ("image", "mask") 
     FUNCTION = "load_exr"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "exr_file"
     
     @classmethod
     def INPUT_TYPES(cls):
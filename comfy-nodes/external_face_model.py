@@ -50,6 +50,7 @@ class ComfyUIDeployExternalFaceModel:
     RETURN_NAMES = ("path",)
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "face_model_url"
 
     def run(
         self,
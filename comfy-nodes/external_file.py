@@ -39,6 +39,7 @@ class ComfyUIDeployExternalFile:
     RETURN_NAMES = ("path",)
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "file_url"
 
     def run(
         self,
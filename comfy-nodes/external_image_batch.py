@@ -36,6 +36,7 @@ class ComfyUIDeployExternalImageBatch:
     RETURN_NAMES = ("image",)
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "images"
     
     def process_image(self, image):
         image = ImageOps.exif_transpose(image)
@@ -48,6 +48,7 @@ class ComfyUIDeployExternalLora:
     RETURN_NAMES = ("path",)
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "lora_url"
 
     def run(
         self,
@@ -42,6 +42,7 @@ class ComfyUIDeployExternalSeed:
     RETURN_NAMES = ("seed",)
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "default_value"
 
     # Limits
     _MAX_LIMIT = 999_999_999_999_999  # 15 digits
@@ -35,6 +35,7 @@ class ComfyUIDeployExternalText:
     FUNCTION = "run"
 
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "default_value"
 
     def run(self, input_id, default_value=None, display_name=None, description=None):
         return [default_value]
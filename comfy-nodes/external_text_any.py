@@ -37,6 +37,7 @@ class ComfyUIDeployExternalTextAny:
     FUNCTION = "run"
 
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_INPUT_FIELD = "default_value"
 
     def run(self, input_id, default_value=None, display_name=None, description=None):
         return [default_value]
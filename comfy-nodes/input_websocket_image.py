@@ -1,11 +1,9 @@
 import folder_paths
-from PIL import Image, ImageOps
-import numpy as np
 import torch
 from server import PromptServer, BinaryEventTypes
 import asyncio
 
-from globals import streaming_prompt_metadata, max_output_id_length
+from globals import max_output_id_length, realtime_frames
 
 class ComfyDeployWebscoketImageInput:
     @classmethod
@@ -34,6 +32,7 @@ class ComfyDeployWebscoketImageInput:
 
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_SESSION_FIELD = "client_id"
 
     @classmethod
     def VALIDATE_INPUTS(s, input_id):
@@ -46,19 +45,14 @@ class ComfyDeployWebscoketImageInput:
         return True
 
     def run(self, input_id, seed, default_value=None ,client_id=None):
-        # print(streaming_prompt_metadata[client_id].inputs)
-        if client_id in streaming_prompt_metadata and input_id in streaming_prompt_metadata[client_id].inputs:
-            if isinstance(streaming_prompt_metadata[client_id].inputs[input_id], Image.Image):
-                print("Returning image from websocket input")
-                
-                image = streaming_prompt_metadata[client_id].inputs[input_id]
-                
-                image = ImageOps.exif_transpose(image)
-                image = image.convert("RGB")
-                image = np.array(image).astype(np.float32) / 255.0
-                image = torch.from_numpy(image)[None,]
-                
-                return [image]
+        ring = realtime_frames.ring(client_id, input_id)
+        if ring is not None:
+            with ring.read() as (frame, seq):
+                if frame is not None:
+                    # A view of the uint8 frame, normalized in a single pass
+                    # into the float tensor the slot can be reused after
+                    image = torch.from_numpy(frame)[None,] * (1.0 / 255.0)
+                    return [image]
 
         print("Returning default value")
         return [default_value]
@@ -5,7 +5,7 @@ import torch
 from server import PromptServer, BinaryEventTypes
 import asyncio
 
-from globals import send_image, max_output_id_length
+from globals import preview_encoder, max_output_id_length, realtime_frames
 
 class ComfyDeployWebscoketImageOutput:
     @classmethod
@@ -17,7 +17,8 @@ class ComfyDeployWebscoketImageOutput:
                     {"multiline": False, "default": "output_id"},
                 ),
                 "images": ("IMAGE", ),
-                "file_type": (["WEBP", "PNG", "JPEG"], ),
+                # RAW is sent unencoded to v2 sockets, as PNG to the others
+                "file_type": (["WEBP", "PNG", "JPEG", "RAW"], ),
                 "quality": ("INT", {"default": 80, "min": 1, "max": 100, "step": 1}),
             },
             "optional": {
@@ -35,6 +36,7 @@ class ComfyDeployWebscoketImageOutput:
     RETURN_NAMES = ("text",)
     FUNCTION = "run"
     CATEGORY = "🔗ComfyDeploy"
+    DEPLOY_SESSION_FIELD = "client_id"
     
     @classmethod
     def VALIDATE_INPUTS(s, output_id):
@@ -47,19 +49,22 @@ class ComfyDeployWebscoketImageOutput:
         return True
 
     def run(self, output_id, images, file_type, quality, client_id):
-        prompt_server = PromptServer.instance
-        loop = prompt_server.loop
-        
-        def schedule_coroutine_blocking(target, *args):
-            future = asyncio.run_coroutine_threadsafe(target(*args), loop)
-            return future.result()  # This makes the call blocking
-        
-        for tensor in images:
-            array = 255.0 * tensor.cpu().numpy()
-            image = Image.fromarray(np.clip(array, 0, 255).astype(np.uint8))
+        loop = PromptServer.instance.loop
+
+        # The whole batch in one step, on the device before the transfer
+        frames = images.mul(255.0).clamp_(0, 255).to(torch.uint8).cpu().numpy()
 
-            schedule_coroutine_blocking(send_image, [file_type, image, None, quality], client_id, output_id)
-            print("Image sent")
+        # Encoded and sent in the background, execution carries on. v2 frames
+        # carry the capture time of the input frame this prompt read
+        preview_encoder.submit(
+            loop,
+            frames,
+            file_type,
+            quality,
+            client_id,
+            output_id,
+            timestamp_us=realtime_frames.capture_timestamp(client_id),
+        )
 
         return {"ui": {}}
         
@@ -3,57 +3,81 @@ import os
 import folder_paths
 import json
 import server
-from PIL import Image
 import time
 import execution
+import nodes
 import random
 import traceback
 import uuid
 import asyncio
 import inspect
-from urllib.parse import quote, urlencode
+from urllib.parse import quote
 import threading
 import hashlib
 import aiohttp
 from aiohttp import web, ClientSession, ClientError, ClientTimeout
 import aiofiles
 from typing import Dict, Any
-import copy
-import struct
 import atexit
 from model_management import get_torch_device
 import torch
 import psutil
-
-# Global session
-client_session = None
-
-
-async def ensure_client_session():
-    global client_session
-    if client_session is None:
-        # Configure TCP connection pooling for better performance
-        connector = aiohttp.TCPConnector(
-            limit=30,  # Maximum number of connections in the pool
-            limit_per_host=10,  # Maximum number of connections per host
-            enable_cleanup_closed=True,  # Clean up closed connections
-            force_close=False,  # Keep connections alive when possible
-            ttl_dns_cache=300,  # Cache DNS results for 5 minutes
-        )
-
-        # Create the session with the connector
-        client_session = aiohttp.ClientSession(
-            connector=connector,
-            timeout=ClientTimeout(total=None, connect=5, sock_read=60, sock_connect=5),
-            raise_for_status=False,  # We'll handle status manually
-        )
-        logger.info("Created global client session with optimized connection pooling")
-
+from run_reporting import StatusUplink, RunOutbox
+from outbound_http import (
+    RetryPolicy,
+    RetryBudget,
+    is_permanent_error,
+    is_retryable_error,
+    parse_retry_after,
+    ClientPool,
+)
+from api_proxy import ApiProxy, ProxyRoute, pick, passthrough
+from run_events import (
+    RunEventHub,
+    EventThrottle,
+    parse_throttle_intervals,
+    PROMPT_END_EVENTS,
+)
+from workflow_compiler import (
+    CompiledWorkflow,
+    compiled_workflows,
+    apply_binding_plan,
+    fork_workflow_api,
+    PromptTemplate,
+)
+from validation_cache import ValidationCache, structural_hash
+from admission import (
+    AdmissionScheduler,
+    AdmissionTicket,
+    DeadlineTracker,
+    RuntimeEstimator,
+    SubmissionIndex,
+    parse_deadline,
+    parse_tenant_map,
+)
+from result_cache import ResultCache, CachedResult, result_key
+from micro_batch import MicroBatcher, split_event
+from workflow_store import WorkflowStore
+from realtime_media import FRAME_FORMATS
+from realtime_protocol import (
+    EVENT_IMAGE_INPUT,
+    PROTOCOL_V1,
+    parse_input_frame,
+)
+from realtime_scheduler import RealtimeScheduler
+
+# All outbound HTTP goes through these pooled sessions, the status API and the
+# object storage uploads get separately sized pools
+client_pool = ClientPool(
+    pool_sizes={
+        "api": int(os.environ.get("CD_API_POOL_SIZE", "10")),
+        "storage": int(os.environ.get("CD_STORAGE_POOL_SIZE", "16")),
+    }
+)
 
 async def cleanup():
-    global client_session
-    if client_session:
-        await client_session.close()
+    await status_uplink.flush_all()
+    await client_pool.close()
 
 
 def exit_handler():
@@ -69,17 +93,44 @@ retry_delay_multiplier = float(os.environ.get("RETRY_DELAY_MULTIPLIER", "2"))
 
 print(f"max_retries: {max_retries}, retry_delay_multiplier: {retry_delay_multiplier}")
 
+status_flush_interval_ms = int(os.environ.get("CD_STATUS_FLUSH_MS", "250"))
+status_flush_max_events = int(os.environ.get("CD_STATUS_FLUSH_MAX_EVENTS", "25"))
+status_batch_requests = (
+    os.environ.get("CD_STATUS_BATCH_REQUESTS", "false").lower() == "true"
+)
+status_outbox_path = os.environ.get(
+    "CD_OUTBOX_PATH",
+    # It holds the run tokens, so it's kept out of the custom node's directory
+    os.path.join(
+        folder_paths.get_user_directory(), "comfyui-deploy", "status-outbox.jsonl"
+    ),
+)
+
+retry_policy = RetryPolicy(
+    max_retries=max_retries,
+    max_delay=float(os.environ.get("CD_RETRY_MAX_DELAY", "30")),
+    delay_multiplier=retry_delay_multiplier,
+    failure_threshold=int(os.environ.get("CD_CIRCUIT_FAILURE_THRESHOLD", "5")),
+    reset_timeout=float(os.environ.get("CD_CIRCUIT_RESET_SECONDS", "30")),
+    budget=RetryBudget(ratio=float(os.environ.get("CD_RETRY_BUDGET_RATIO", "0.2"))),
+)
+
 
 async def async_request_with_retry(
     method, url, disable_timeout=False, token=None, **kwargs
 ):
-    global client_session
-    await ensure_client_session()
-    retry_delay = 1  # Start with 1 second delay
+    session = await client_pool.session(url)
+    breaker = retry_policy.breaker(url)
+    retry_delay = retry_policy.base_delay
     initial_timeout = 5  # 5 seconds timeout for the initial connection
 
     start_time = time.time()
     for attempt in range(max_retries):
+        # Fails fast while the host's circuit is open
+        breaker.before_request()
+
+        retry_after = None
+        request_start = time.time()
         try:
             if not disable_timeout:
                 timeout = ClientTimeout(total=None, connect=initial_timeout)
@@ -90,48 +141,50 @@ async def async_request_with_retry(
                     kwargs["headers"] = {}
                 kwargs["headers"]["Authorization"] = f"Bearer {token}"
 
-            request_start = time.time()
-            async with client_session.request(method, url, **kwargs) as response:
-                request_end = time.time()
-                # logger.info(f"Request attempt {attempt + 1} took {request_end - request_start:.2f} seconds")
-
-                if response.status != 200:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status >= 400:
+                    retry_after = parse_retry_after(response)
                     error_body = await response.text()
-                    # logger.error(f"Request failed with status {response.status} and body {error_body}")
-                    # raise Exception(f"Request failed with status {response.status}")
+                    logger.error(
+                        f"Request {method} : {url} failed with status {response.status}: {error_body[:500]}"
+                    )
 
                 response.raise_for_status()
                 if method.upper() == "GET":
                     await response.read()
 
-                total_time = time.time() - start_time
-                # logger.info(f"Request succeeded after {total_time:.2f} seconds (attempt {attempt + 1}/{max_retries})")
+                breaker.record_success()
+                retry_policy.budget.deposit()
                 return response
-        except asyncio.TimeoutError:
-            logger.warning(
-                f"Request timed out after {initial_timeout} seconds (attempt {attempt + 1}/{max_retries})"
-            )
-        except ClientError as e:
+        except (asyncio.TimeoutError, ClientError) as e:
             end_time = time.time()
-            logger.error(f"Request failed (attempt {attempt + 1}/{max_retries}): {e}")
+            retryable = is_retryable_error(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                # The host answered, the request itself is wrong
+                breaker.record_success()
+
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning(
+                    f"Request timed out after {initial_timeout} seconds (attempt {attempt + 1}/{max_retries})"
+                )
+            else:
+                logger.error(
+                    f"Request failed (attempt {attempt + 1}/{max_retries}): {e}"
+                )
             logger.error(
-                f"Time taken for failed attempt: {end_time - request_start:.2f} seconds"
+                f"Time taken for failed attempt: {end_time - request_start:.2f} seconds, total: {end_time - start_time:.2f} seconds"
             )
-            logger.error(f"Total time elapsed: {end_time - start_time:.2f} seconds")
 
-            # Log the response body for ClientError as well
-            if hasattr(e, "response") and e.response is not None:
-                error_body = await e.response.text()
-                logger.error(f"Error response body: {error_body}")
-
-            if attempt == max_retries - 1:
+            if not retry_policy.should_retry(breaker, attempt, e):
                 logger.error(
-                    f"Request {method} : {url} failed after {max_retries} attempts: {e}"
+                    f"Request {method} : {url} failed after {attempt + 1} attempts: {e}"
                 )
                 raise
 
+        retry_delay = retry_policy.next_delay(retry_delay, retry_after)
         await asyncio.sleep(retry_delay)
-        retry_delay *= retry_delay_multiplier
 
     total_time = time.time() - start_time
     raise Exception(
@@ -139,6 +192,28 @@ async def async_request_with_retry(
     )
 
 
+async def send_status_report(status_endpoint, token, body):
+    # Only ever called by the outbox sender
+    await async_request_with_retry("POST", status_endpoint, token=token, json=body)
+
+
+# Reports are persisted before sending, so a slow or unavailable status
+# endpoint never loses a terminal status, even across restarts
+status_outbox = RunOutbox(
+    status_outbox_path,
+    send_status_report,
+    is_permanent_error=is_permanent_error,
+)
+# Every report to a run's status endpoint goes through here, so progress
+# updates can be coalesced and sent in batches instead of one request each
+status_uplink = StatusUplink(
+    status_outbox.put,
+    flush_interval=status_flush_interval_ms / 1000,
+    max_batch_size=status_flush_max_events,
+    batch_requests=status_batch_requests,
+)
+
+
 from logging import basicConfig, getLogger
 
 # Check for an environment variable to enable/disable Logfire
@@ -161,6 +236,12 @@ if not use_logfire:
     logger = getLogger("comfy-deploy")
     basicConfig(level="INFO")  # You can adjust the logging level as needed
 
+# Unsent reports of the previous run, replayed once the server has started
+try:
+    status_outbox.load()
+except Exception as e:
+    logger.error(f"Failed to load status outbox: {e}")
+
 
 def log(level, message, **kwargs):
     if use_logfire:
@@ -189,9 +270,13 @@ from globals import (
     StreamingPrompt,
     Status,
     sockets,
+    socket_fanout,
     SimplePrompt,
     streaming_prompt_metadata,
     prompt_metadata,
+    realtime_frames,
+    preview_encoder,
+    socket_protocols,
 )
 
 
@@ -233,37 +318,100 @@ status_endpoint = None
 file_upload_endpoint = None
 
 
-def clear_current_prompt(sid):
-    prompt_server = server.PromptServer.instance
-    to_delete = list(
-        streaming_prompt_metadata[sid].running_prompt_ids
-    )  # Convert set to list
-
-    logger.info(f"clearing out prompt: {to_delete}")
-    for id_to_delete in to_delete:
-        delete_func = lambda a: a[1] == id_to_delete
-        prompt_server.prompt_queue.delete_queue_item(delete_func)
-        logger.info(
-            f"deleted prompt: {id_to_delete}, remaining tasks: {prompt_server.prompt_queue.get_tasks_remaining()}"
+# Reuses validate_prompt results across runs of the same graph, and drops them
+# when the installed nodes or the model file lists change
+def prompt_rewritten():
+    # on_prompt handlers of other custom nodes may change any part of a prompt
+    return bool(getattr(server.PromptServer.instance, "on_prompt_handlers", None))
+
+
+validation_cache = ValidationCache(
+    lambda: nodes.NODE_CLASS_MAPPINGS,
+    max_entries=int(os.environ.get("CD_VALIDATION_CACHE_SIZE", "128")),
+    prompt_rewritten=prompt_rewritten,
+)
+
+
+def swizzle_get_filename_list_():
+    # Model names are validated too, a rescanned folder may have lost some
+    rescan = getattr(folder_paths, "get_filename_list_", None)
+    if rescan is None:
+        logger.warning(
+            "Model folder rescans can't be observed, validation cache disabled"
         )
+        validation_cache.max_entries = 0
+        return
 
-    streaming_prompt_metadata[sid].running_prompt_ids.clear()
+    def get_filename_list_(folder_name):
+        result = rescan(folder_name)
+        validation_cache.invalidate()
+        return result
 
+    folder_paths.get_filename_list_ = get_filename_list_
+
+
+swizzle_get_filename_list_()
+
+
+async def validate_prompt_compat(prompt_id, prompt, partial_execution_targets):
+    """Calls execution.validate_prompt whatever signature this ComfyUI has"""
+    valid = None
+    last_error = None
+
+    # v0.3.48 (3 args)
+    try:
+        valid = await execution.validate_prompt(
+            prompt_id, prompt, partial_execution_targets
+        )
+    except TypeError as e:
+        last_error = e
+        logger.debug(
+            f"validate_prompt with 3 params not supported, trying with 2. Debug: {last_error}"
+        )
+
+    # v0.3.45 - 0.3.47 (2 args)
+    if valid is None:
+        try:
+            valid = await execution.validate_prompt(prompt_id, prompt)
+        except TypeError as e:
+            last_error = e
+            logger.debug(
+                f"validate_prompt with 2 params not supported, trying legacy signature. Debug: {last_error}"
+            )
+
+    # v0.3.44 or older (1 arg)
+    if valid is None:
+        try:
+            valid = execution.validate_prompt(prompt)
+        except TypeError as e:
+            last_error = e
+            logger.error(
+                f"validate_prompt failed with all signatures. Last error: {last_error}"
+            )
+            raise
+
+    return valid
 
-async def post_prompt(json_data):
-    prompt_server = server.PromptServer.instance
-    json_data = prompt_server.trigger_on_prompt(json_data)
 
+def next_prompt_number(json_data):
+    prompt_server = server.PromptServer.instance
     if "number" in json_data:
-        number = float(json_data["number"])
-    else:
-        number = prompt_server.number
-        if "front" in json_data:
-            if json_data["front"]:
-                number = -number
+        return float(json_data["number"])
+
+    number = prompt_server.number
+    if "front" in json_data:
+        if json_data["front"]:
+            number = -number
+
+    prompt_server.number += 1
+    return number
 
-        prompt_server.number += 1
 
+async def prepare_prompt(json_data, compiled: CompiledWorkflow = None):
+    """
+    Validate a prompt for the queue. Returns (entry, response), entry is None
+    when the prompt can't be queued, otherwise it goes to enqueue_prompt.
+    """
     if "prompt" in json_data:
         prompt = json_data["prompt"]
         prompt_id = json_data.get("prompt_id") or str(uuid.uuid4())
@@ -272,41 +420,37 @@ async def post_prompt(json_data):
         if "partial_execution_targets" in json_data:
             partial_execution_targets = json_data["partial_execution_targets"]
 
-        # Handle different validate_prompt signatures (newest to oldest)
         valid = None
-        last_error = None
 
-        # v0.3.48 (3 args)
-        try:
-            valid = await execution.validate_prompt(
-                prompt_id, prompt, partial_execution_targets
-            )
-        except TypeError as e:
-            last_error = e
-            logger.debug(
-                f"validate_prompt with 3 params not supported, trying with 2. Debug: {last_error}"
+        # The same graph with other inputs only has its inputs checked again
+        validation_key = None
+        if compiled is not None:
+            validation_key = validation_cache.key(
+                prompt, compiled, partial_execution_targets
             )
+            valid = validation_cache.get(validation_key, prompt)
+            if valid is not None:
+                logger.debug(f"Validation cache hit for {prompt_id}")
 
-        # v0.3.45 - 0.3.47 (2 args)
         if valid is None:
-            try:
-                valid = await execution.validate_prompt(prompt_id, prompt)
-            except TypeError as e:
-                last_error = e
-                logger.debug(
-                    f"validate_prompt with 2 params not supported, trying legacy signature. Debug: {last_error}"
+            structure = None
+            if validation_key is not None:
+                structure = structural_hash(
+                    prompt, compiled.masked_fields, partial_execution_targets
                 )
+            valid = await validate_prompt_compat(
+                prompt_id, prompt, partial_execution_targets
+            )
 
-        # v0.3.44 or older (1 arg)
-        if valid is None:
-            try:
-                valid = execution.validate_prompt(prompt)
-            except TypeError as e:
-                last_error = e
-                logger.error(
-                    f"validate_prompt failed with all signatures. Last error: {last_error}"
+            if validation_key is not None:
+                validation_cache.put(
+                    validation_key,
+                    prompt,
+                    compiled.masked_fields,
+                    valid,
+                    structure,
+                    partial_execution_targets,
                 )
-                raise
 
         extra_data = {}
         if "extra_data" in json_data:
@@ -320,248 +464,443 @@ async def post_prompt(json_data):
         if valid[0]:
             outputs_to_execute = valid[2]
             # Backward compatibility: sensitive data handling added in newer ComfyUI
+            sensitive = None
             sensitive_keys = getattr(execution, "SENSITIVE_EXTRA_DATA_KEYS", None)
             if sensitive_keys:
                 sensitive = {}
                 for sensitive_val in sensitive_keys:
                     if sensitive_val in extra_data:
                         sensitive[sensitive_val] = extra_data.pop(sensitive_val)
-                prompt_server.prompt_queue.put(
-                    (
-                        number,
-                        prompt_id,
-                        prompt,
-                        extra_data,
-                        outputs_to_execute,
-                        sensitive,
-                    )
-                )
-            else:
-                # Old ComfyUI version without sensitive data support
-                prompt_server.prompt_queue.put(
-                    (number, prompt_id, prompt, extra_data, outputs_to_execute)
-                )
+            entry = (prompt_id, prompt, extra_data, outputs_to_execute, sensitive)
             response = {
                 "prompt_id": prompt_id,
-                "number": number,
+                "number": None,
                 "node_errors": valid[3],
             }
-            return response
+            return entry, response
         else:
             logger.info("invalid prompt:", valid[1])
-            return {"error": valid[1], "node_errors": valid[3]}
+            return None, {"error": valid[1], "node_errors": valid[3]}
     else:
-        return {"error": "no prompt", "node_errors": []}
+        return None, {"error": "no prompt", "node_errors": []}
 
 
-def randomSeed(num_digits=15):
-    # Special case for SONICSampler which uses np.int32
-    if num_digits == "sonic":
-        return random.randint(0, 2147483647)  # np.iinfo(np.int32).max
+def enqueue_prompt(entry, number):
+    prompt_server = server.PromptServer.instance
+    prompt_id, prompt, extra_data, outputs_to_execute, sensitive = entry
+    if sensitive is not None:
+        prompt_server.prompt_queue.put(
+            (number, prompt_id, prompt, extra_data, outputs_to_execute, sensitive)
+        )
+    else:
+        # Old ComfyUI version without sensitive data support
+        prompt_server.prompt_queue.put(
+            (number, prompt_id, prompt, extra_data, outputs_to_execute)
+        )
 
-    # Original logic for other cases
-    range_start = 10 ** (num_digits - 1)
-    range_end = (10**num_digits) - 1
-    return random.randint(range_start, range_end)
 
+async def post_prompt(
+    json_data,
+    compiled: CompiledWorkflow = None,
+    ticket: AdmissionTicket = None,
+    micro_batch=False,
+):
+    """
+    Validate and queue a prompt, through the admission scheduler with a
+    ticket, and held for a micro batch with micro_batch
+    """
+    prompt_server = server.PromptServer.instance
+    json_data = prompt_server.trigger_on_prompt(json_data)
+    admitted = ticket is not None and admission is not None
+    if not admitted:
+        number = next_prompt_number(json_data)
+
+    entry, response = await prepare_prompt(json_data, compiled=compiled)
+    if entry is not None:
+        if (
+            micro_batch
+            and micro_batcher is not None
+            and micro_batcher.offer(entry, compiled, ticket if admitted else None)
+        ):
+            # Numbered when its batch is queued
+            response["micro_batch"] = True
+        elif admitted:
+            # Numbered when the scheduler releases it
+            response["admission"] = admission.submit(entry[0], entry, ticket)
+        else:
+            enqueue_prompt(entry, number)
+            response["number"] = number
+    return response
+
+
+def evict_expired_run(prompt_id):
+    """Take a run whose deadline passed out of the queues, before it reaches the GPU"""
+    removed = micro_batcher is not None and micro_batcher.cancel(prompt_id)
+    if not removed:
+        removed = admission is not None and admission.cancel(prompt_id)
+    if not removed:
+        removed = server.PromptServer.instance.prompt_queue.delete_queue_item(
+            lambda item: item[1] == prompt_id
+        )
+        if removed and admission is not None:
+            # Never ends, its tenant's place is free now
+            admission.finish(prompt_id)
+    if removed:
+        logger.info(f"Evicted {prompt_id}, its deadline passed before it started")
+        asyncio.create_task(report_deadline_exceeded(prompt_id))
+    return removed
+
+
+async def report_deadline_exceeded(prompt_id):
+    await update_run_with_output(
+        prompt_id,
+        {
+            "error": {
+                "error_type": "DeadlineExceeded",
+                "message": "The run did not start before its deadline",
+            }
+        },
+    )
+    await update_run(prompt_id, Status.FAILED)
+
+
+# Estimates when a new run would start, from the queue and the past execution
+# times of each workflow, for runs submitted with a deadline or max_queue_time
+deadline_tracker = DeadlineTracker(
+    RuntimeEstimator(
+        default_seconds=float(os.environ.get("CD_DEFAULT_RUN_SECONDS", "30"))
+    ),
+    evict_expired_run,
+    queue_depth=lambda: server.PromptServer.instance.prompt_queue.get_tasks_remaining(),
+)
+
+
+async def submit_deploy_run(data, prompt, compiled: CompiledWorkflow, token):
+    """Queue a deploy run through the deadline check, result cache and admission"""
+    prompt_id = prompt["prompt_id"]
+    if prompt_id is not None:
+        deadline = parse_deadline(data)
+        admitted, expected_wait = deadline_tracker.admit(
+            prompt_id, compiled.hash, deadline
+        )
+        if not admitted:
+            return {
+                "prompt_id": prompt_id,
+                "error": "The run can not start before its deadline",
+                "node_errors": [],
+                "rejected": "deadline",
+                "deadline": deadline,
+                "expected_wait": round(expected_wait, 3),
+            }
+
+    ticket = AdmissionTicket.from_request(data, token)
+    try:
+        if data.get("result_cache") and prompt_id is not None:
+            res = await post_prompt_cached(
+                prompt,
+                compiled=compiled,
+                ticket=ticket,
+                token=token,
+                micro_batch=bool(data.get("micro_batch")),
+            )
+        else:
+            res = await post_prompt(
+                prompt,
+                compiled=compiled,
+                ticket=ticket,
+                micro_batch=bool(data.get("micro_batch")),
+            )
+    except Exception:
+        deadline_tracker.forget(prompt_id)
+        raise
+
+    held = "admission" in res or "micro_batch" in res
+    if res.get("number") is None and not held:
+        # Invalid, or served by the result cache, it won't take GPU time
+        deadline_tracker.forget(prompt_id)
+    return res
+
+
+def resubmit_followers(followers):
+    for follower_id, resubmit in followers:
+        asyncio.create_task(resubmit_attached_run(follower_id, resubmit))
+
+
+# Output manifests of finished runs, for runs submitted with result_cache: true
+result_cache = ResultCache(
+    max_entries=int(os.environ.get("CD_RESULT_CACHE_SIZE", "256")),
+    max_age=float(os.environ.get("CD_RESULT_CACHE_TTL", "3600")),
+    on_orphaned=resubmit_followers,
+)
 
-def apply_random_seed_to_workflow(workflow_api, workflow):
+
+async def post_prompt_cached(
+    json_data,
+    compiled: CompiledWorkflow = None,
+    ticket=None,
+    token=None,
+    micro_batch=False,
+):
     """
-    Applies a random seed to each element in the workflow_api that has a 'seed' input.
+    post_prompt through the result cache. A run identical to a finished one
+    gets its outputs replayed, one identical to a run in flight waits for it,
+    neither is queued.
 
-    Args:
-        workflow_api (dict): The workflow API dictionary to modify.
+    A micro batched run gets a latent of its batch instead of its own seed's,
+    so it can be served from the cache but its outputs are never stored.
     """
-    for key in workflow_api:
-        if "inputs" in workflow_api[key]:
-            if "seed" in workflow_api[key]["inputs"]:
-                # If seed is a list, it's an input from another node (generally `external number int`)
-                if isinstance(workflow_api[key]["inputs"]["seed"], list):
-                    continue
+    prompt_id = json_data["prompt_id"]
+    key = result_key(json_data["prompt"], token, compiled=compiled)
+
+    entry = result_cache.lookup(key)
+    if entry is not None:
+        logger.info(f"Result cache hit for {prompt_id}, from {entry.prompt_id}")
+        asyncio.create_task(replay_cached_result(prompt_id, entry))
+        return {
+            "prompt_id": prompt_id,
+            "number": None,
+            "node_errors": {},
+            "cached_from": entry.prompt_id,
+        }
 
-                # Check node type in workflow to determine if we should randomize
-                node_id = key
-                should_skip = (
-                    False  # Add a flag to track if we should skip randomization
-                )
+    if micro_batch:
+        return await post_prompt(
+            json_data, compiled=compiled, ticket=ticket, micro_batch=True
+        )
 
-                for node in workflow["nodes"]:
-                    if str(node["id"]) == node_id and node["type"] == "KSampler":
-                        # Check if this node has widgets_values and if seed setting is not "fixed"
-                        if "widgets_values" in node and len(node["widgets_values"]) > 1:
-                            seed_mode = node["widgets_values"][1]
-                            if seed_mode == "fixed":
-                                # Skip randomization for fixed seeds
-                                logger.info(
-                                    f"Skipping random seed for KSampler (node {node_id}) as it's set to fixed"
-                                )
-                                should_skip = True  # Set the flag to skip randomization
-                                break  # Exit the inner loop
-
-                            # Apply random seed for non-fixed seeds (randomize, iter, etc.)
-                            workflow_api[key]["inputs"]["seed"] = randomSeed()
-                            logger.info(
-                                f"Applied random seed {workflow_api[key]['inputs']['seed']} to KSampler (node {node_id})"
-                            )
-                            should_skip = (
-                                True  # Set the flag to skip default randomization
-                            )
-                            break  # Exit the inner loop
-                        break  # This break will skip checking other nodes if widgets_values doesn't exist
+    leader = result_cache.begin(
+        key,
+        prompt_id,
+        lambda: post_prompt_cached(json_data, compiled, ticket=ticket, token=token),
+    )
+    if leader is not None:
+        logger.info(f"Attached {prompt_id} to the identical run {leader}")
+        return {
+            "prompt_id": prompt_id,
+            "number": None,
+            "node_errors": {},
+            "attached_to": leader,
+        }
 
-                # Skip the rest of the code for this key if we already handled it
-                if should_skip:
-                    continue
+    try:
+        res = await post_prompt(json_data, compiled=compiled, ticket=ticket)
+    except Exception:
+        settle_result_cache(prompt_id, Status.FAILED)
+        raise
+    if "error" in res:
+        settle_result_cache(prompt_id, Status.FAILED)
+    return res
 
-                # Special case for SONICSampler
-                if workflow_api[key]["class_type"] == "SONICSampler":
-                    workflow_api[key]["inputs"]["seed"] = randomSeed("sonic")
-                    logger.info(
-                        f"Applied random seed {workflow_api[key]['inputs']['seed']} to SONICSampler"
-                    )
-                    continue
-                if workflow_api[key]["class_type"] == "PromptExpansion":
-                    workflow_api[key]["inputs"]["seed"] = randomSeed(8)
-                    logger.info(
-                        f"Applied random seed {workflow_api[key]['inputs']['seed']} to PromptExpansion"
-                    )
-                    continue
-                workflow_api[key]["inputs"]["seed"] = randomSeed()
-                logger.info(
-                    f"Applied random seed {workflow_api[key]['inputs']['seed']} to {workflow_api[key]['class_type']}"
-                )
 
-            if "noise_seed" in workflow_api[key]["inputs"]:
-                # If noise_seed is a list, it's an input from another node (generally `external number int`)
-                if isinstance(workflow_api[key]["inputs"]["noise_seed"], list):
-                    continue
-                if workflow_api[key]["class_type"] == "RandomNoise":
-                    workflow_api[key]["inputs"]["noise_seed"] = randomSeed()
-                    logger.info(
-                        f"Applied random noise_seed {workflow_api[key]['inputs']['noise_seed']} to RandomNoise"
-                    )
-                    continue
-                if workflow_api[key]["class_type"] == "KSamplerAdvanced":
-                    workflow_api[key]["inputs"]["noise_seed"] = randomSeed()
-                    logger.info(
-                        f"Applied random noise_seed {workflow_api[key]['inputs']['noise_seed']} to KSamplerAdvanced"
-                    )
-                    continue
-                if workflow_api[key]["class_type"] == "SamplerCustom":
-                    workflow_api[key]["inputs"]["noise_seed"] = randomSeed()
-                    logger.info(
-                        f"Applied random noise_seed {workflow_api[key]['inputs']['noise_seed']} to SamplerCustom"
-                    )
-                    continue
-                if workflow_api[key]["class_type"] == "XlabsSampler":
-                    workflow_api[key]["inputs"]["noise_seed"] = randomSeed()
-                    logger.info(
-                        f"Applied random noise_seed {workflow_api[key]['inputs']['noise_seed']} to SamplerCustom"
-                    )
-                    continue
+async def replay_cached_result(prompt_id, entry: CachedResult):
+    """Report the outputs of a cached run as the outputs of prompt_id"""
+    metadata = prompt_metadata.get(prompt_id)
+    if metadata is None or metadata.status is Status.CANCELLED:
+        return
 
+    await update_run(prompt_id, Status.RUNNING)
+    for body in entry.reports:
+        body = {**body, "run_id": prompt_id}
+        if "gpu_event_id" in body:
+            body["gpu_event_id"] = metadata.gpu_event_id
+        await status_uplink.report(
+            prompt_id, metadata.status_endpoint, metadata.token, body
+        )
+    for event in entry.events:
+        run_event_hub.publish(
+            prompt_id, {**event, "data": {**event["data"], "prompt_id": prompt_id}}
+        )
 
-def apply_inputs_to_workflow(workflow_api: Any, inputs: Any, sid: str = None):
-    # Loop through each of the inputs and replace them
-    for key, value in workflow_api.items():
-        if "inputs" in value:
-            # Support websocket
-            if sid is not None:
-                if value["class_type"] == "ComfyDeployWebscoketImageOutput":
-                    value["inputs"]["client_id"] = sid
-                if value["class_type"] == "ComfyDeployWebscoketImageInput":
-                    value["inputs"]["client_id"] = sid
+    mark_prompt_done(prompt_id)
+    await update_run(prompt_id, Status.SUCCESS)
+    await send("success", {"prompt_id": prompt_id})
 
-            if (
-                "input_id" in value["inputs"]
-                and inputs is not None
-                and value["inputs"]["input_id"] in inputs
-            ):
-                new_value = inputs[value["inputs"]["input_id"]]
 
-                # Lets skip it if its an image
-                if isinstance(new_value, Image.Image):
-                    continue
+async def resubmit_attached_run(prompt_id, resubmit):
+    """The run prompt_id was waiting for failed, it runs on its own after all"""
+    try:
+        res = await resubmit()
+    except Exception as e:
+        res = {"error": f"{type(e).__name__}: {e}", "node_errors": []}
+    if "error" in res:
+        await update_run_with_output(prompt_id, {"error": {**res}})
+        await update_run(prompt_id, Status.FAILED)
 
-                # Backward compactibility
-                value["inputs"]["input_id"] = new_value
 
-                # Fix for external text default value
-                if (
-                    value["class_type"] == "ComfyUIDeployExternalText"
-                    or value["class_type"] == "ComfyUIDeployExternalTextAny"
-                ):
-                    value["inputs"]["default_value"] = new_value
+def settle_result_cache(prompt_id, status: Status):
+    if status == Status.SUCCESS:
+        entry, followers = result_cache.complete(prompt_id)
+        for follower_id, _ in followers:
+            asyncio.create_task(replay_cached_result(follower_id, entry))
+    elif status in (Status.FAILED, Status.CANCELLED):
+        resubmit_followers(result_cache.abandon(prompt_id))
 
-                if value["class_type"] == "ComfyUIDeployExternalCheckpoint":
-                    value["inputs"]["default_value"] = new_value
 
-                if value["class_type"] == "ComfyUIDeployExternalImageBatch":
-                    value["inputs"]["images"] = new_value
+def dispatch_admitted_prompt(prompt_id, entry):
+    enqueue_prompt(entry, next_prompt_number({}))
 
-                if value["class_type"] == "ComfyUIDeployExternalEnum":
-                    value["inputs"]["default_value"] = new_value
 
-                if value["class_type"] == "ComfyUIDeployExternalLora":
-                    value["inputs"]["lora_url"] = new_value
+def dispatch_micro_batch(entry, ticket):
+    if ticket is not None and admission is not None:
+        admission.submit(entry[0], entry, ticket)
+    else:
+        enqueue_prompt(entry, next_prompt_number({}))
+
+
+# Runs submitted with micro_batch: true that only differ in their seeds are
+# queued as one prompt with a larger batch size, only when CD_MICRO_BATCH is on
+micro_batcher = None
+if os.environ.get("CD_MICRO_BATCH", "false").lower() in ("1", "true", "yes"):
+    micro_batcher = MicroBatcher(
+        dispatch_micro_batch,
+        max_size=int(os.environ.get("CD_MICRO_BATCH_MAX_SIZE", "8")),
+        max_wait=float(os.environ.get("CD_MICRO_BATCH_MAX_WAIT", "0.05")),
+        prompt_rewritten=prompt_rewritten,
+    )
 
-                if value["class_type"] == "ComfyUIDeployExternalSlider":
-                    value["inputs"]["default_value"] = new_value
 
-                if value["class_type"] == "ComfyUIDeployExternalBoolean":
-                    value["inputs"]["default_value"] = new_value
+def prompt_queue_has_room():
+    prompt_queue = server.PromptServer.instance.prompt_queue
+    return prompt_queue.get_tasks_remaining() < admission_depth
 
-                if value["class_type"] == "ComfyUIDeployExternalFaceModel":
-                    value["inputs"]["face_model_url"] = new_value
 
-                if value["class_type"] == "ComfyUIDeployExternalAudio":
-                    value["inputs"]["audio_file"] = new_value
+# Deploy runs wait here and are released into the prompt queue by priority
+# class and weighted fair share per tenant, only when CD_ADMISSION is on
+admission_depth = int(os.environ.get("CD_ADMISSION_DEPTH", "2"))
+admission = None
+if os.environ.get("CD_ADMISSION", "false").lower() in ("1", "true", "yes"):
+    admission = AdmissionScheduler(
+        dispatch_admitted_prompt,
+        prompt_queue_has_room,
+        weights=parse_tenant_map(os.environ.get("CD_ADMISSION_WEIGHTS")),
+        caps=parse_tenant_map(os.environ.get("CD_ADMISSION_CAPS"), int),
+    )
+
 
-                if value["class_type"] == "ComfyUIDeployExternalEXR":
-                    value["inputs"]["exr_file"] = new_value
+def dispatch_realtime_prompt(sid, entry):
+    prompt_id, prompt = entry[0], entry[1]
+    session = streaming_prompt_metadata.get(sid)
+    if session is not None:
+        session.running_prompt_ids.add(prompt_id)
+        prompt_metadata[prompt_id] = SimplePrompt(
+            status_endpoint=session.status_endpoint,
+            file_upload_endpoint=session.file_upload_endpoint,
+            workflow_api=prompt,
+            is_realtime=True,
+        )
+    enqueue_prompt(entry, next_prompt_number({}))
 
-                if value["class_type"] == "ComfyUIDeployExternalFile":
-                    value["inputs"]["file_url"] = new_value
 
-                if value["class_type"] == "ComfyUIDeployExternalSeed":
-                    logger.info(
-                        f"Applied random seed {new_value} to {value['class_type']}"
-                    )
-                    value["inputs"]["default_value"] = new_value
+def prompt_in_queue(prompt_id):
+    running, queued = server.PromptServer.instance.prompt_queue.get_current_queue()
+    return any(item[1] == prompt_id for item in running + queued)
+
+
+# Realtime sessions queue at most one prompt at a time, the newest frame waits
+# behind it and sessions take turns
+realtime_scheduler = RealtimeScheduler(
+    dispatch_realtime_prompt,
+    max_running=int(os.environ.get("CD_REALTIME_MAX_RUNNING", "2")),
+    is_queued=prompt_in_queue,
+)
+
+
+def release_realtime_prompt(prompt_id):
+    realtime_sid = realtime_scheduler.finish(prompt_id)
+    if realtime_sid in streaming_prompt_metadata:
+        streaming_prompt_metadata[realtime_sid].running_prompt_ids.discard(prompt_id)
+
+
+def randomSeed(num_digits=15):
+    # Special case for SONICSampler which uses np.int32
+    if num_digits == "sonic":
+        return random.randint(0, 2147483647)  # np.iinfo(np.int32).max
+
+    # Original logic for other cases
+    range_start = 10 ** (num_digits - 1)
+    range_end = (10**num_digits) - 1
+    return random.randint(range_start, range_end)
+
 
+def apply_random_seed_to_workflow(
+    workflow_api, workflow, compiled: CompiledWorkflow = None
+):
+    """
+    Applies a random seed to each seed input selected by the seed rules.
+
+    Args:
+        workflow_api (dict): The workflow API dictionary to modify.
+        workflow (dict): The UI workflow, holding the KSampler fixed/randomize mode.
+        compiled (CompiledWorkflow): The compiled workflow_api, when already known.
+    """
+    if compiled is None:
+        compiled = compiled_workflows.get(workflow_api)
+
+    for node_id, field, policy in compiled.seeds(workflow):
+        seed = randomSeed(policy)
+        workflow_api[node_id]["inputs"][field] = seed
+        logger.info(
+            f"Applied random {field} {seed} to {workflow_api[node_id]['class_type']} (node {node_id})"
+        )
 
-def send_prompt(sid: str, inputs: StreamingPrompt):
-    # workflow_api = inputs.workflow_api
-    workflow_api = copy.deepcopy(inputs.workflow_api)
-    workflow = copy.deepcopy(inputs.workflow)
 
-    # Random seed
-    apply_random_seed_to_workflow(workflow_api, workflow)
+def apply_inputs_to_workflow(
+    workflow_api: Any, inputs: Any, sid: str = None, compiled: CompiledWorkflow = None
+):
+    """
+    Writes the inputs into the fields their nodes declared. Pass the compiled
+    workflow when the workflow_api was already changed (e.g. by seeds), the
+    plan is looked up by the hash of the untouched workflow.
+    """
+    if compiled is None:
+        compiled = compiled_workflows.get(workflow_api)
+
+    apply_binding_plan(
+        workflow_api,
+        compiled.bindings,
+        inputs,
+        sid=sid,
+    )
 
-    logger.info("getting inputs", inputs.inputs)
 
-    apply_inputs_to_workflow(workflow_api, inputs.inputs, sid=sid)
+async def send_prompt(sid: str, inputs: StreamingPrompt):
+    # The session's workflow never changes, it is compiled once and every
+    # prompt only copies the nodes it writes to
+    if inputs.template is None:
+        inputs.compiled = compiled_workflows.get(inputs.workflow_api)
+        inputs.template = PromptTemplate(
+            inputs.workflow_api, inputs.compiled, inputs.workflow
+        )
 
-    logger.info(workflow_api)
+    workflow_api = inputs.template.materialize(
+        inputs.inputs,
+        sid=sid,
+        seed=randomSeed,
+    )
 
-    prompt_id = str(uuid.uuid4())
+    logger.debug(f"Realtime prompt for {sid}, inputs {list(inputs.inputs)}")
 
-    # prompt = {
-    #     "prompt": workflow_api,
-    #     "client_id": sid,  # "comfy_deploy_instance", #api.client_id
-    #     "prompt_id": prompt_id,
-    #     "extra_data": {"extra_pnginfo": {"workflow": workflow}},
-    # }
+    prompt = {
+        "prompt": workflow_api,
+        "client_id": sid,
+        "prompt_id": str(uuid.uuid4()),
+        "extra_data": {"extra_pnginfo": {"workflow": inputs.workflow}},
+    }
 
     try:
-        # res = post_prompt(prompt)
-        inputs.running_prompt_ids.add(prompt_id)
-        prompt_metadata[prompt_id] = SimplePrompt(
-            status_endpoint=inputs.status_endpoint,
-            file_upload_endpoint=inputs.file_upload_endpoint,
-            workflow_api=workflow_api,
-            is_realtime=True,
+        prompt_server = server.PromptServer.instance
+        entry, response = await prepare_prompt(
+            prompt_server.trigger_on_prompt(prompt), compiled=inputs.compiled
         )
+        if entry is None:
+            logger.info(f"Realtime prompt for {sid} is invalid: {response}")
+            await send("error", response, sid)
+            return
+        # Prompts deleted from the queue never end, their places are freed here
+        for prompt_id in realtime_scheduler.lost():
+            release_realtime_prompt(prompt_id)
+        # Replaces the session's pending prompt, if it has one
+        realtime_scheduler.offer(sid, entry)
     except Exception as e:
         error_type = type(e).__name__
         stack_trace_short = traceback.format_exc().strip().split("\n")[-2]
@@ -569,61 +908,167 @@ def send_prompt(sid: str, inputs: StreamingPrompt):
         logger.info(f"error: {error_type}, {e}")
         logger.info(f"stack trace: {stack_trace_short}")
 
-    # # Add custom logic here
-    # if 'prompt_id' in response:
-    #     prompt_id = response['prompt_id']
-    #     if prompt_id in prompt_metadata:
-    #         metadata = prompt_metadata[prompt_id]
 
-    #         # Add additional information to the response
-    #         response['status_endpoint'] = metadata.status_endpoint
-    #         response['file_upload_endpoint'] = metadata.file_upload_endpoint
+def prewarm_run_connections(status_endpoint, file_upload_endpoint):
+    """Open connections to the hosts a run will report to and upload to"""
+    client_pool.prewarm(status_endpoint, file_upload_endpoint, pool="api")
+    client_pool.prewarm(*client_pool.pool_origins.get("storage", ()))
+
+
+def request_token(request, data):
+    """The Comfy Deploy token of a run request, from cd_token or the bearer header"""
+    if "cd_token" in data:
+        return data["cd_token"]
+    auth_header = request.headers.get("Authorization")
+    if auth_header:
+        parts = auth_header.split()
+        if len(parts) == 2 and parts[0].lower() == "bearer":
+            return parts[1]
+    return None
+
+
+# Workflows uploaded once with PUT /comfyui-deploy/workflow-store, runs send
+# their workflow_hash instead of workflow_api_raw and workflow
+workflow_store = WorkflowStore(
+    max_entries=int(os.environ.get("CD_WORKFLOW_STORE_SIZE", "64")),
+    max_bytes=int(os.environ.get("CD_WORKFLOW_STORE_MB", "512")) * 1024 * 1024,
+)
+
+
+def resolve_run_workflow(data, fork=True):
+    """
+    (workflow_api, workflow, api_hash) of a run request, from its
+    workflow_hash or from workflow_api_raw and workflow. A stored
+    workflow_api is forked unless fork=False, it is shared by every run.
+    None when the workflow_hash is not in the store.
+    """
+    stored_hash = data.get("workflow_hash")
+    if stored_hash is None:
+        return data.get("workflow_api_raw"), data.get("workflow"), None
+
+    stored = workflow_store.get(stored_hash)
+    if stored is None:
+        return None
+    workflow_api = stored.workflow_api
+    if fork:
+        workflow_api = fork_workflow_api(workflow_api)
+    return workflow_api, stored.workflow, stored.api_hash
+
+
+def unknown_workflow(data):
+    return {
+        "prompt_id": data.get("prompt_id"),
+        "error": "Unknown workflow_hash, upload it to /comfyui-deploy/workflow-store",
+        "workflow_hash": data.get("workflow_hash"),
+        "upload_required": True,
+        "node_errors": [],
+    }
+
+
+@server.PromptServer.instance.routes.put("/comfyui-deploy/workflow-store")
+async def put_workflow(request):
+    """Store a workflow for runs to reference by the returned workflow_hash"""
+    data = await request.json()
+    if data.get("workflow_api_raw") is None:
+        return web.json_response({"error": "workflow_api_raw is required"}, status=400)
+
+    stored = workflow_store.put(data["workflow_api_raw"], data.get("workflow"))
+    # Compiled ahead of the first run
+    compiled_workflows.get(stored.workflow_api, hash=stored.api_hash)
+    return web.json_response({"workflow_hash": stored.hash})
+
+
+@server.PromptServer.instance.routes.get(
+    "/comfyui-deploy/workflow-store/{workflow_hash}"
+)
+async def get_workflow(request):
+    """Whether a workflow_hash is stored, 404 means it has to be uploaded"""
+    stored_hash = request.match_info["workflow_hash"]
+    if stored_hash not in workflow_store:
+        return web.json_response(
+            {"workflow_hash": stored_hash, "exists": False}, status=404
+        )
+    return web.json_response({"workflow_hash": stored_hash, "exists": True})
+
+
+# Recent submissions by prompt_id, a retried run gets its first response back
+run_submissions = SubmissionIndex(
+    max_entries=int(os.environ.get("CD_SUBMISSION_INDEX_SIZE", "4096"))
+)
+
+
+def duplicate_submission(prompt_id, status, body):
+    """The first response of a run submitted again, with its current status"""
+    body = dict(body) if isinstance(body, dict) else {"prompt_id": prompt_id}
+    body["duplicate"] = True
+    if prompt_id in prompt_metadata:
+        body["status"] = prompt_metadata[prompt_id].status.value
+    return body
+
+
+@server.PromptServer.instance.routes.post("/comfyui-deploy/run")
+async def comfy_deploy_run(request):
+    data = await request.json()
+    prompt_id = data.get("prompt_id")
+    # A native run gets its prompt_id from Comfy Deploy
+    if prompt_id is None or "is_native_run" in data:
+        return await run_deploy_request(request, data)
+
+    first = run_submissions.claim(prompt_id)
+    if first is not None:
+        logger.info(f"{prompt_id} was already submitted, not queuing it again")
+        status, body = await asyncio.shield(first)
+        return web.json_response(
+            duplicate_submission(prompt_id, status, body), status=status
+        )
 
+    response = None
+    try:
+        response = await run_deploy_request(request, data)
+    finally:
+        if response is None or response.status >= 500:
+            run_submissions.resolve(prompt_id, 500, None)
+        else:
+            run_submissions.resolve(prompt_id, response.status, json.loads(response.text))
+    return response
 
-@server.PromptServer.instance.routes.post("/comfyui-deploy/run")
-async def comfy_deploy_run(request):
-    # Extract the bearer token from the Authorization header
-    data = await request.json()
 
+async def run_deploy_request(request, data):
     client_id = data.get("client_id")
     # We proxy the request to Comfy Deploy, this is a native run
     if "is_native_run" in data:
-        async with aiohttp.ClientSession() as session:
-            # pprint(data)
-            # headers = request.headers.copy()
-            # headers['Content-Type'] = 'application/json'
-            async with session.post(
-                data.get("native_run_api_endpoint"),
-                json=data,
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": request.headers.get("Authorization"),
-                },
-            ) as response:
-                data = await response.json()
-                # print(data)
+        session = await client_pool.session(data.get("native_run_api_endpoint"))
+        # pprint(data)
+        # headers = request.headers.copy()
+        # headers['Content-Type'] = 'application/json'
+        async with session.post(
+            data.get("native_run_api_endpoint"),
+            json=data,
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": request.headers.get("Authorization"),
+            },
+        ) as response:
+            data = await response.json()
+            # print(data)
 
-    if "cd_token" in data:
-        token = data["cd_token"]
-    else:
-        auth_header = request.headers.get("Authorization")
-        token = None
-        if auth_header:
-            parts = auth_header.split()
-            if len(parts) == 2 and parts[0].lower() == "bearer":
-                token = parts[1]
+    token = request_token(request, data)
+
+    resolved = resolve_run_workflow(data)
+    if resolved is None:
+        return web.json_response(unknown_workflow(data), status=409)
 
     # In older version, we use workflow_api, but this has inputs already swapped in nextjs frontend, which is tricky
-    workflow_api = data.get("workflow_api_raw")
+    workflow_api, workflow, api_hash = resolved
     # The prompt id generated from comfy deploy, can be None
     prompt_id = data.get("prompt_id")
     inputs = data.get("inputs")
     gpu_event_id = data.get("gpu_event_id", None)
-    workflow = data.get("workflow")
 
     # Now it handles directly in here
-    apply_random_seed_to_workflow(workflow_api, workflow)
-    apply_inputs_to_workflow(workflow_api, inputs)
+    compiled = compiled_workflows.get(workflow_api, hash=api_hash)
+    apply_random_seed_to_workflow(workflow_api, workflow, compiled=compiled)
+    apply_inputs_to_workflow(workflow_api, inputs, compiled=compiled)
 
     prompt = {
         "prompt": workflow_api,
@@ -639,9 +1084,12 @@ async def comfy_deploy_run(request):
         token=token,
         gpu_event_id=gpu_event_id,
     )
+    prewarm_run_connections(
+        data.get("status_endpoint"), data.get("file_upload_endpoint")
+    )
 
     try:
-        res = await post_prompt(prompt)
+        res = await submit_deploy_run(data, prompt, compiled, token)
     except Exception as e:
         error_type = type(e).__name__
         stack_trace_short = traceback.format_exc().strip().split("\n")[-2]
@@ -659,6 +1107,11 @@ async def comfy_deploy_run(request):
             status=500, reason=f"{error_type}: {e}, {stack_trace_short}"
         )
 
+    if res.get("rejected"):
+        # Not queued and not failed, the caller can take it elsewhere
+        prompt_metadata.pop(prompt_id, None)
+        return web.json_response(res, status=503)
+
     status = 200
 
     if (
@@ -679,26 +1132,213 @@ async def comfy_deploy_run(request):
     return web.json_response(res, status=status)
 
 
+@server.PromptServer.instance.routes.post("/comfyui-deploy/run/batch")
+async def comfy_deploy_run_batch(request):
+    """
+    Queue many runs of one workflow. The body is a /comfyui-deploy/run body
+    plus `runs`, a list of {prompt_id, inputs, status_endpoint,
+    file_upload_endpoint, gpu_event_id}, each falling back to the top level
+    value. The workflow is parsed and compiled once, validated in full once
+    and per run only for its inputs, and the valid runs are queued together
+    with consecutive numbers.
+    """
+    data = await request.json()
+    runs = data.get("runs")
+    if not isinstance(runs, list) or not runs:
+        return web.json_response({"error": "runs is required"}, status=400)
+    if data.get("workflow_api_raw") is None and data.get("workflow_hash") is None:
+        return web.json_response(
+            {"error": "workflow_api_raw or workflow_hash is required"}, status=400
+        )
+    stored_hash = data.get("workflow_hash")
+    if stored_hash is not None and stored_hash not in workflow_store:
+        return web.json_response(unknown_workflow(data), status=409)
+
+    claimed = set()
+    try:
+        return await run_deploy_batch(request, data, runs, claimed)
+    finally:
+        # Only left unresolved when the batch failed as a whole
+        for prompt_id in claimed:
+            run_submissions.resolve(prompt_id, 500, None)
+
+
+async def run_deploy_batch(request, data, runs, claimed):
+    token = request_token(request, data)
+    client_id = data.get("client_id")
+    # Every run forks its own copy
+    workflow_api, workflow, api_hash = resolve_run_workflow(data, fork=False)
+    compiled = compiled_workflows.get(workflow_api, hash=api_hash)
+    prompt_server = server.PromptServer.instance
+
+    results = []
+    prepared = []  # (result index, queue entry)
+    duplicates = []  # (result index, prompt_id, future of the first submission)
+    to_run = []  # (result index, prompt_id, run)
+    endpoints = set()
+    failed = []  # (prompt_id, gpu_event_id, error output, status to report)
+
+    # Every prompt_id is claimed before anything is awaited, a batch waiting
+    # on another's claim while holding its own could deadlock with it
+    for run in runs:
+        prompt_id = run.get("prompt_id") or str(uuid.uuid4())
+        if prompt_id in claimed:
+            results.append(
+                {
+                    "prompt_id": prompt_id,
+                    "error": "prompt_id is repeated in the batch",
+                    "node_errors": [],
+                }
+            )
+            continue
+        results.append(None)
+        if run.get("prompt_id"):
+            first = run_submissions.claim(prompt_id)
+            if first is not None:
+                # Submitted before, by another batch or a retry of this one
+                duplicates.append((len(results) - 1, prompt_id, first))
+                continue
+            claimed.add(prompt_id)
+        to_run.append((len(results) - 1, prompt_id, run))
+
+    for index, prompt_id, run in to_run:
+        gpu_event_id = run.get("gpu_event_id", data.get("gpu_event_id"))
+        status_endpoint = run.get("status_endpoint", data.get("status_endpoint"))
+        file_upload_endpoint = run.get(
+            "file_upload_endpoint", data.get("file_upload_endpoint")
+        )
+
+        endpoints.add((status_endpoint, file_upload_endpoint))
+
+        run_workflow_api = fork_workflow_api(workflow_api)
+        apply_random_seed_to_workflow(run_workflow_api, workflow, compiled=compiled)
+        apply_inputs_to_workflow(run_workflow_api, run.get("inputs"), compiled=compiled)
+
+        prompt_metadata[prompt_id] = SimplePrompt(
+            status_endpoint=status_endpoint,
+            file_upload_endpoint=file_upload_endpoint,
+            workflow_api=run_workflow_api,
+            token=token,
+            gpu_event_id=gpu_event_id,
+        )
+
+        prompt = {
+            "prompt": run_workflow_api,
+            "client_id": "comfy_deploy_instance" if client_id is None else client_id,
+            "prompt_id": prompt_id,
+            "extra_data": {"extra_pnginfo": {"workflow": workflow}},
+        }
+        try:
+            # Only the first run misses the validation cache
+            entry, res = await prepare_prompt(
+                prompt_server.trigger_on_prompt(prompt), compiled=compiled
+            )
+        except Exception as e:
+            error_type = type(e).__name__
+            stack_trace = traceback.format_exc().strip()
+            logger.info(f"error: {error_type}, {e}")
+            entry, res = None, {"error": f"{error_type}: {e}", "node_errors": []}
+            failed.append(
+                (
+                    prompt_id,
+                    gpu_event_id,
+                    {"error": {"error_type": error_type, "stack_trace": stack_trace}},
+                    Status.FAILED,
+                )
+            )
+        else:
+            if res.get("node_errors"):
+                # Even tho there are node_errors it can still be run
+                failed.append(
+                    (
+                        prompt_id,
+                        gpu_event_id,
+                        {"error": {**res}},
+                        Status.FAILED if "error" in res else None,
+                    )
+                )
+
+        results[index] = {"prompt_id": prompt_id, **res}
+        if entry is not None:
+            prepared.append((index, entry))
+
+    # No await in between, the runs are queued back to back with their numbers
+    ticket = AdmissionTicket.from_request(data, token)
+    for index, entry in prepared:
+        if admission is not None:
+            results[index]["admission"] = admission.submit(entry[0], entry, ticket)
+            continue
+        number = next_prompt_number({"front": data.get("front", False)})
+        enqueue_prompt(entry, number)
+        results[index]["number"] = number
+
+    for status_endpoint, file_upload_endpoint in endpoints:
+        prewarm_run_connections(status_endpoint, file_upload_endpoint)
+
+    for index, prompt_id, _ in to_run:
+        result = results[index]
+        taken = result.get("number") is not None or "admission" in result
+        run_submissions.resolve(prompt_id, 200 if taken else 400, result)
+
+    for prompt_id, gpu_event_id, output, status in failed:
+        await update_run_with_output(prompt_id, output, gpu_event_id=gpu_event_id)
+        # When there are critical errors, the prompt is actually not run
+        if status is not None:
+            await update_run(prompt_id, status)
+
+    # Our own claims are resolved, waiting on other submissions is safe now
+    for index, prompt_id, first in duplicates:
+        status, body = await asyncio.shield(first)
+        results[index] = duplicate_submission(prompt_id, status, body)
+
+    # Runs queued despite non-fatal node_errors count as queued
+    not_queued = len(results) - len(prepared) - len(duplicates)
+    if not not_queued:
+        status = 200
+    elif not prepared:
+        status = 400
+    else:
+        status = 207
+    return web.json_response(
+        {
+            "queued": len(prepared),
+            "duplicates": len(duplicates),
+            "failed": not_queued,
+            "runs": results,
+        },
+        status=status,
+    )
+
+
 @server.PromptServer.instance.routes.post("/comfyui-deploy/interrupt")
 async def interrupt_prompt(request):
     data = await request.json()
     prompt_id = data.get("prompt_id")
+    if admission is not None:
+        # Not released to the prompt queue yet, it never runs
+        admission.cancel(prompt_id)
+    if micro_batcher is not None:
+        micro_batcher.cancel(prompt_id)
     await update_run(prompt_id, Status.CANCELLED)
     return web.json_response({"message": "Prompt interrupted"}, status=200)
 
 
 async def stream_prompt(data, token):
+    resolved = resolve_run_workflow(data)
+    if resolved is None:
+        return unknown_workflow(data)
+
     # In older version, we use workflow_api, but this has inputs already swapped in nextjs frontend, which is tricky
-    workflow_api = data.get("workflow_api_raw")
+    workflow_api, workflow, api_hash = resolved
     # The prompt id generated from comfy deploy, can be None
     prompt_id = data.get("prompt_id")
     inputs = data.get("inputs")
-    workflow = data.get("workflow")
     gpu_event_id = data.get("gpu_event_id", None)
 
     # Now it handles directly in here
-    apply_random_seed_to_workflow(workflow_api, workflow)
-    apply_inputs_to_workflow(workflow_api, inputs)
+    compiled = compiled_workflows.get(workflow_api, hash=api_hash)
+    apply_random_seed_to_workflow(workflow_api, workflow, compiled=compiled)
+    apply_inputs_to_workflow(workflow_api, inputs, compiled=compiled)
 
     prompt = {
         "prompt": workflow_api,
@@ -714,11 +1354,14 @@ async def stream_prompt(data, token):
         token=token,
         gpu_event_id=gpu_event_id,
     )
+    prewarm_run_connections(
+        data.get("status_endpoint"), data.get("file_upload_endpoint")
+    )
 
     # log('info', "Begin prompt", prompt=prompt)
 
     try:
-        res = await post_prompt(prompt)
+        res = await submit_deploy_run(data, prompt, compiled, token)
     except Exception as e:
         error_type = type(e).__name__
         stack_trace_short = traceback.format_exc().strip().split("\n")[-2]
@@ -732,6 +1375,27 @@ async def stream_prompt(data, token):
         await update_run(prompt_id, Status.FAILED)
         # return web.Response(status=500, reason=f"{error_type}: {e}, {stack_trace_short}")
         # raise Exception("Prompt failed")
+        return {
+            "prompt_id": prompt_id,
+            "error": f"{error_type}: {e}, {stack_trace_short}",
+            "node_errors": [],
+        }
+
+    if res.get("rejected"):
+        # Not queued and not failed, end the streams following it
+        prompt_metadata.pop(prompt_id, None)
+        run_event_hub.publish(
+            prompt_id,
+            {
+                "event": "status",
+                "data": {
+                    "prompt_id": prompt_id,
+                    "status": Status.FAILED.value,
+                    "rejected": res["rejected"],
+                },
+            },
+        )
+        return res
 
     status = 200
 
@@ -753,16 +1417,48 @@ async def stream_prompt(data, token):
     # return web.json_response(res, status=status)
 
 
-comfy_message_queues: Dict[str, asyncio.Queue] = {}
+def run_status(prompt_id):
+    metadata = prompt_metadata.get(prompt_id)
+    return metadata.status.value if metadata is not None else None
+
+
+# Event streams of the prompts followed over /comfyui-deploy/run/streaming
+run_event_hub = RunEventHub(
+    replay_size=int(os.environ.get("CD_SSE_REPLAY_SIZE", "512")),
+    retention=float(os.environ.get("CD_SSE_RETENTION_SECONDS", "120")),
+    status_lookup=run_status,
+)
+sse_heartbeat_interval = float(os.environ.get("CD_SSE_HEARTBEAT_SECONDS", "15"))
+
+# Seconds between two sends of the same prompt/node progress, per destination
+event_throttle = EventThrottle(
+    parse_throttle_intervals(
+        os.environ.get("CD_EVENT_THROTTLE"),
+        {
+            ("progress", "ws"): 0.1,
+            ("progress", "sse"): 0.25,
+            ("progress", "status"): 1.0,
+            ("progress_state", "*"): 0.5,
+        },
+    ),
+    min_delta=float(os.environ.get("CD_EVENT_THROTTLE_MIN_DELTA", "0.1")),
+)
+
+
+def parse_last_event_id(request, data=None):
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id is None:
+        last_event_id = request.rel_url.query.get("last_event_id")
+    if last_event_id is None and data:
+        last_event_id = data.get("last_event_id")
+    try:
+        return int(last_event_id) if last_event_id is not None else 0
+    except (TypeError, ValueError):
+        return 0
 
 
 @server.PromptServer.instance.routes.post("/comfyui-deploy/run/streaming")
 async def stream_response(request):
-    response = web.StreamResponse(
-        status=200, reason="OK", headers={"Content-Type": "text/event-stream"}
-    )
-    await response.prepare(request)
-
     # Extract the bearer token from the Authorization header
     auth_header = request.headers.get("Authorization")
     token = None
@@ -771,54 +1467,108 @@ async def stream_response(request):
         if len(parts) == 2 and parts[0].lower() == "bearer":
             token = parts[1]
 
-    pending = True
     data = await request.json()
 
     prompt_id = data.get("prompt_id")
-    comfy_message_queues[prompt_id] = asyncio.Queue()
+    prompt_ids = list(data.get("prompt_ids") or [])
+    if prompt_id is not None and prompt_id not in prompt_ids:
+        prompt_ids.insert(0, prompt_id)
+
+    # Without a workflow this only follows (or resumes) already started prompts
+    start_run = data.get("workflow_api_raw") is not None
+    if start_run and prompt_id is not None:
+        # A retry follows the run it already started
+        start_run = run_submissions.claim(prompt_id) is None
+
+    return await serve_run_events(
+        request,
+        prompt_ids,
+        parse_last_event_id(request, data),
+        data=data if start_run else None,
+        token=token,
+    )
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/run/streaming")
+async def follow_run_events(request):
+    prompt_ids = []
+    for value in request.rel_url.query.getall("prompt_id", []):
+        prompt_ids.extend(p for p in value.split(",") if p)
+
+    return await serve_run_events(request, prompt_ids, parse_last_event_id(request))
+
+
+async def serve_run_events(request, prompt_ids, last_event_id, data=None, token=None):
+    response = web.StreamResponse(
+        status=200,
+        reason="OK",
+        headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"},
+    )
+    await response.prepare(request)
+
+    if data is None:
+        unknown = [
+            p
+            for p in prompt_ids
+            if p not in run_event_hub and p not in prompt_metadata
+        ]
+        for prompt_id in unknown:
+            prompt_ids.remove(prompt_id)
+            await response.write(
+                f"event: error\ndata: {json.dumps({'prompt_id': prompt_id, 'error': 'Unknown prompt_id'})}\n\n".encode(
+                    "utf-8"
+                )
+            )
+
+    # Subscribe before the run starts so no event can be missed
+    subscription = run_event_hub.subscribe(prompt_ids, last_event_id)
 
     with log_span("Streaming Run"):
         log("info", "Streaming prompt")
 
         try:
-            result = await stream_prompt(data=data, token=token)
-            await response.write(
-                f"event: event_update\ndata: {json.dumps(result)}\n\n".encode("utf-8")
-            )
-            # await response.write(.encode('utf-8'))
-            await response.drain()  # Ensure the buffer is flushed
-
-            while pending:
-                if prompt_id in comfy_message_queues:
-                    if not comfy_message_queues[prompt_id].empty():
-                        data = await comfy_message_queues[prompt_id].get()
-
-                        # log('info', data["event"], data=json.dumps(data))
-                        # logger.info("listener", data)
-                        await response.write(
-                            f"event: event_update\ndata: {json.dumps(data)}\n\n".encode(
-                                "utf-8"
-                            )
-                        )
-                        await response.drain()  # Ensure the buffer is flushed
+            if data is not None:
+                try:
+                    result = await stream_prompt(data=data, token=token)
+                except Exception:
+                    run_submissions.resolve(data.get("prompt_id"), 500, None)
+                    raise
+                if result.get("rejected"):
+                    status = 503
+                elif result.get("upload_required"):
+                    status = 409
+                else:
+                    status = 200
+                run_submissions.resolve(data.get("prompt_id"), status, result)
+                await response.write(
+                    f"event: event_update\ndata: {json.dumps(result)}\n\n".encode(
+                        "utf-8"
+                    )
+                )
+                await response.drain()  # Ensure the buffer is flushed
 
-                        if data["event"] == "status":
-                            if data["data"]["status"] in (
-                                Status.FAILED.value,
-                                Status.SUCCESS.value,
-                            ):
-                                pending = False
+            while not subscription.done:
+                record = await subscription.next(timeout=sse_heartbeat_interval)
+                if record is None:
+                    # Keeps proxies from closing an idle stream
+                    await response.write(b": heartbeat\n\n")
+                    continue
 
-                await asyncio.sleep(0.1)  # Adjust the sleep duration as needed
+                event_id, _, _, encoded = record
+                await response.write(
+                    f"id: {event_id}\nevent: event_update\ndata: {encoded}\n\n".encode(
+                        "utf-8"
+                    )
+                )
+                await response.drain()  # Ensure the buffer is flushed
         except asyncio.CancelledError:
             log("info", "Streaming was cancelled")
             raise
         except Exception as e:
             log("error", "Streaming error", error=e)
         finally:
-            # event_emitter.off("send_json", task)
+            run_event_hub.unsubscribe(subscription)
             await response.write_eof()
-            comfy_message_queues.pop(prompt_id, None)
             return response
 
 
@@ -1045,7 +1795,7 @@ async def update_realtime_run_status(
     if status_endpoint is None:
         return
     # requests.post(status_endpoint, json=body)
-    await async_request_with_retry("POST", status_endpoint, json=body)
+    await status_uplink.report(realtime_id, status_endpoint, None, body)
 
 
 @server.PromptServer.instance.routes.get("/comfyui-deploy/ws")
@@ -1060,6 +1810,14 @@ async def websocket_handler(request):
         sid = uuid.uuid4().hex
 
     sockets[sid] = ws
+    socket_fanout.attach(sid, ws)
+    # Binary frames sent to this socket, v1 unless it asks for v2
+    try:
+        socket_protocols.set(
+            sid, int(request.rel_url.query.get("protocol", PROTOCOL_V1))
+        )
+    except ValueError as e:
+        logger.info(f"Keeping protocol v1 for {sid}: {e}")
 
     auth_token = request.rel_url.query.get("token", None)
     get_workflow_endpoint_url = request.rel_url.query.get("workflow_endpoint", None)
@@ -1117,8 +1875,29 @@ async def websocket_handler(request):
                         input = data.get("inputs")
                         streaming_prompt_metadata[sid].inputs.update(input)
                     elif event_type == "queue_prompt":
-                        clear_current_prompt(sid)
-                        send_prompt(sid, streaming_prompt_metadata[sid])
+                        await send_prompt(sid, streaming_prompt_metadata[sid])
+                    elif event_type == "protocol":
+                        try:
+                            socket_protocols.set(sid, int(data.get("version")))
+                        except (TypeError, ValueError) as e:
+                            logger.info(f"Keeping the protocol of {sid}: {e}")
+                        await send(
+                            "protocol", {"version": socket_protocols.version(sid)}, sid
+                        )
+                    elif event_type in ("subscribe", "unsubscribe"):
+                        topics = {
+                            "prompt_ids": data.get("prompt_ids") or [],
+                            "events": data.get("events") or [],
+                            "logs": bool(data.get("logs")),
+                            "everything": bool(data.get("all")),
+                        }
+                        if event_type == "subscribe":
+                            socket_fanout.subscribe(sid, **topics)
+                        else:
+                            socket_fanout.unsubscribe(sid, **topics)
+                        await send(
+                            "subscriptions", socket_fanout.subscriptions(sid), sid
+                        )
                     else:
                         # Handle other event types
                         pass
@@ -1126,54 +1905,45 @@ async def websocket_handler(request):
                     logger.info("Failed to decode JSON from message")
 
             if msg.type == aiohttp.WSMsgType.BINARY:
-                data = msg.data
-                (event_type,) = struct.unpack("<I", data[:4])
-                if event_type == 0:  # Image input
-                    (image_type_code,) = struct.unpack("<I", data[4:8])
-                    input_id_bytes = data[
-                        8:32
-                    ]  # Extract the next 24 bytes for the input ID
-                    input_id = input_id_bytes.decode(
-                        "ascii"
-                    ).strip()  # Decode the input ID from ASCII
-                    logger.info(event_type)
-                    logger.info(image_type_code)
-                    logger.info(input_id)
-                    image_data = data[32:]  # The rest is the image data
-                    if image_type_code == 1:
-                        image_type = "JPEG"
-                    elif image_type_code == 2:
-                        image_type = "PNG"
-                    elif image_type_code == 3:
-                        image_type = "WEBP"
-                    else:
+                # image_data is a view of the message, not copied out
+                (
+                    event_type,
+                    image_type_code,
+                    input_id,
+                    image_data,
+                    size,
+                    timestamp_us,
+                ) = parse_input_frame(msg.data)
+
+                if event_type == EVENT_IMAGE_INPUT:
+                    # Decoded off the loop into the input's frame ring, the
+                    # newest frame wins
+                    if not realtime_frames.submit(
+                        asyncio.get_running_loop(),
+                        sid,
+                        input_id,
+                        image_type_code,
+                        image_data,
+                        size=size,
+                        timestamp_us=timestamp_us,
+                    ):
                         logger.info(f"Unknown image type code: ${image_type_code}")
-                        return
-                    image = Image.open(BytesIO(image_data))
-                    # Check if the input ID already exists and replace the input with the new one
-                    if input_id in streaming_prompt_metadata[sid].inputs:
-                        # If the input exists, we assume it's an image and attempt to close it to free resources
-                        try:
-                            existing_image = streaming_prompt_metadata[sid].inputs[
-                                input_id
-                            ]
-                            if hasattr(existing_image, "close"):
-                                existing_image.close()
-                        except Exception as e:
-                            logger.info(
-                                f"Error closing previous image for input ID {input_id}: {e}"
-                            )
-                    streaming_prompt_metadata[sid].inputs[input_id] = image
-                    # clear_current_prompt(sid)
-                    # send_prompt(sid, streaming_prompt_metadata[sid])
-                    logger.info(
-                        f"Received {image_type} image of size {image.size} with input ID {input_id}"
+                        continue
+                    logger.debug(
+                        f"Received {FRAME_FORMATS[image_type_code]} frame of {len(image_data)} bytes with input ID {input_id}"
                     )
 
             if msg.type == aiohttp.WSMsgType.ERROR:
                 logger.info("ws connection closed with exception %s" % ws.exception())
     finally:
-        sockets.pop(sid, None)
+        socket_fanout.detach(sid, ws)
+        # A reconnect under the same clientId may own the sid by now, its
+        # protocol, frame rings and pending prompt are not this socket's
+        if sockets.get(sid) is ws:
+            del sockets[sid]
+            realtime_frames.drop(sid)
+            realtime_scheduler.drop(sid)
+            socket_protocols.drop(sid)
 
         if realtime_id is not None:
             await update_realtime_run_status(
@@ -1207,24 +1977,27 @@ async def comfy_deploy_check_ws_status(request):
 
 async def send(event, data, sid=None):
     try:
-        # message = {"event": event, "data": data}
-        if sid:
-            ws = sockets.get(sid)
-            if (
-                ws != None and not ws.closed
-            ):  # Check if the WebSocket connection is open and not closing
-                await ws.send_json({"event": event, "data": data})
-        else:
-            for ws in sockets.values():
-                if (
-                    not ws.closed
-                ):  # Check if the WebSocket connection is open and not closing
-                    await ws.send_json({"event": event, "data": data})
+        # Serialized once and queued per socket, never waits on a slow client
+        socket_fanout.publish_json(event, data, sid=sid or None)
     except Exception as e:
         logger.info(f"Exception: {e}")
         traceback.print_exc()
 
 
+# Headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
 @server.PromptServer.instance.routes.get("/comfydeploy/{tail:.*}")
 @server.PromptServer.instance.routes.post("/comfydeploy/{tail:.*}")
 async def proxy_to_comfydeploy(request):
@@ -1239,41 +2012,54 @@ async def proxy_to_comfydeploy(request):
 
     # print(f"Proxying request to: {target_url}")
 
+    # Bodies are streamed through as-is in both directions, nothing is decoded
+    headers = {
+        k: v
+        for k, v in request.headers.items()
+        if k.lower() != "host" and k.lower() not in HOP_BY_HOP_HEADERS
+    }
+    data = request.content if request.body_exists else None
+
+    response = None
     try:
-        # Create a new ClientSession for each request
-        async with ClientSession() as client_session:
-            # Forward the request
-            client_req = await client_session.request(
-                method=request.method,
-                url=target_url,
-                headers={
-                    k: v
-                    for k, v in request.headers.items()
-                    if k.lower() not in ("host", "content-length")
-                },
-                data=await request.read(),
-                allow_redirects=False,
+        session = await client_pool.raw_session(target_url)
+        async with session.request(
+            method=request.method,
+            url=target_url,
+            headers=headers,
+            data=data,
+            allow_redirects=False,
+        ) as client_req:
+            response = web.StreamResponse(
+                status=client_req.status, reason=client_req.reason
             )
+            for k, v in client_req.headers.items():
+                if k.lower() not in HOP_BY_HOP_HEADERS:
+                    response.headers.add(k, v)
+            await response.prepare(request)
+
+            async for chunk in client_req.content.iter_any():
+                # Stop pulling from upstream once the client has gone away
+                if request.transport is None or request.transport.is_closing():
+                    logger.info(f"Client disconnected, aborting proxy to {target_url}")
+                    return response
+                await response.write(chunk)
 
-            # Read the entire response content
-            content = await client_req.read()
-
-            # Try to decode the content as JSON
-            try:
-                json_data = json.loads(content)
-                # If successful, return a JSON response
-                return web.json_response(json_data, status=client_req.status)
-            except json.JSONDecodeError:
-                # If it's not valid JSON, return the content as-is
-                return web.Response(
-                    body=content, status=client_req.status, headers=client_req.headers
-                )
+            await response.write_eof()
+            return response
 
+    except (ConnectionResetError, asyncio.CancelledError):
+        logger.info(f"Proxy to {target_url} cancelled")
+        raise
     except ClientError as e:
         print(f"Client error occurred while proxying request: {str(e)}")
+        if response is not None and response.prepared:
+            return response
         return web.Response(status=502, text=f"Bad Gateway: {str(e)}")
     except Exception as e:
         print(f"Error occurred while proxying request: {str(e)}")
+        if response is not None and response.prepared:
+            return response
         return web.Response(status=500, text=f"Internal Server Error: {str(e)}")
 
 
@@ -1466,28 +2252,78 @@ server.PromptServer.send_sync = swizzle_send_sync
 send_json = prompt_server.send_json
 
 
-async def send_json_override(self, event, data, sid=None):
+async def send_json_override(self, event, data, sid=None, forward=True):
     # logger.info(f"INTERNAL: event={event}, data={data}, sid={sid}")
     prompt_id = data.get("prompt_id")
 
+    members = micro_batcher.members(prompt_id) if micro_batcher is not None else None
+    if members is not None:
+        # ComfyUI clients see the batch prompt they were told about, the
+        # deploy sinks see each of its runs with its share of the outputs
+        await self.send_json_original(event, data, sid)
+        prompt_end = event in PROMPT_END_EVENTS or (
+            event == "executing" and data.get("node") is None
+        )
+        if admission is not None and prompt_end:
+            admission.finish(prompt_id)
+        for index, member_id in enumerate(members):
+            await send_json_override(
+                self,
+                event,
+                split_event(event, data, member_id, index, len(members)),
+                sid,
+                forward=False,
+            )
+        if event == "executing" and data.get("node") is None:
+            micro_batcher.finish(prompt_id)
+        return
+
     target_sid = sid
     if target_sid == "comfy_deploy_instance":
         target_sid = None
 
-    # now we send everything
-    await asyncio.wait(
-        [
-            asyncio.create_task(send(event, data, sid=target_sid)),
-            asyncio.create_task(self.send_json_original(event, data, sid)),
-        ]
+    # now we send everything, high frequency events through the throttle
+    event_throttle.submit(
+        "ws",
+        event,
+        data,
+        lambda event, data: asyncio.create_task(send(event, data, sid=target_sid)),
     )
+    if forward:
+        await self.send_json_original(event, data, sid)
+
+    event_throttle.submit(
+        "sse",
+        event,
+        data,
+        lambda event, data: run_event_hub.publish(
+            prompt_id, {"event": event, "data": data}
+        ),
+    )
+
+    event_throttle.submit(
+        "status",
+        event,
+        data,
+        lambda event, data: asyncio.create_task(
+            update_run_ws_event(prompt_id, event, data)
+        ),
+    )
+
+    prompt_end = event in PROMPT_END_EVENTS or (
+        event == "executing" and data.get("node") is None
+    )
+    if admission is not None and prompt_end:
+        admission.finish(prompt_id)
 
-    if prompt_id in comfy_message_queues:
-        comfy_message_queues[prompt_id].put_nowait({"event": event, "data": data})
+    if prompt_end and realtime_scheduler.is_running(prompt_id):
+        release_realtime_prompt(prompt_id)
 
-    asyncio.create_task(update_run_ws_event(prompt_id, event, data))
+    if event in ("execution_error", "execution_interrupted"):
+        deadline_tracker.forget(prompt_id)
 
     if event == "execution_start":
+        deadline_tracker.started(prompt_id)
         if prompt_id in prompt_metadata:
             prompt_metadata[prompt_id].start_time = time.perf_counter()
 
@@ -1531,6 +2367,9 @@ async def send_json_override(self, event, data, sid=None):
             table_data.append(["TOTAL", "-", f"{execution_time:.2f}", "-"])
 
             prompt_id = data.get("prompt_id")
+            deadline_tracker.finished(
+                prompt_id, sum(n["time"] for n in NODE_EXECUTION_TIMES.values())
+            )
             asyncio.create_task(
                 update_run_with_output(
                     prompt_id,
@@ -1548,6 +2387,7 @@ async def send_json_override(self, event, data, sid=None):
     # the last executing event is none, then the workflow is finished
     if event == "executing" and data.get("node") is None:
         mark_prompt_done(prompt_id=prompt_id)
+        deadline_tracker.forget(prompt_id)
         # We will now rely on the UploadQueue worker to set the final SUCCESS status
         # after all uploads are confirmed complete.
 
@@ -1649,10 +2489,9 @@ async def send_json_override(self, event, data, sid=None):
                     node_id=data.get("node"),
                     node_meta=node_meta,
                 )
-                if prompt_id in comfy_message_queues:
-                    comfy_message_queues[prompt_id].put_nowait(
-                        {"event": "output_ready", "data": data}
-                    )
+                output_ready = {"event": "output_ready", "data": data}
+                result_cache.record_event(prompt_id, output_ready)
+                run_event_hub.publish(prompt_id, output_ready)
             # logger.info(f"Executed {class_type} {data}")
         else:
             pass
@@ -1683,19 +2522,19 @@ async def update_run_live_status(prompt_id, live_status, calculated_progress: fl
         "gpu_event_id": gpu_event_id,
     }
 
-    if prompt_id in comfy_message_queues:
-        comfy_message_queues[prompt_id].put_nowait(
-            {
-                "event": "live_status",
-                "data": {
-                    "prompt_id": prompt_id,
-                    "live_status": live_status,
-                    "progress": calculated_progress,
-                },
-            }
-        )
+    run_event_hub.publish(
+        prompt_id,
+        {
+            "event": "live_status",
+            "data": {
+                "prompt_id": prompt_id,
+                "live_status": live_status,
+                "progress": calculated_progress,
+            },
+        },
+    )
 
-    await async_request_with_retry("POST", status_endpoint, token=token, json=body)
+    await status_uplink.report(prompt_id, status_endpoint, token, body)
 
 
 async def update_run_ws_event(prompt_id: str, event: str, data: dict):
@@ -1718,7 +2557,7 @@ async def update_run_ws_event(prompt_id: str, event: str, data: dict):
             "gpu_event_id": gpu_event_id,
         },
     }
-    await async_request_with_retry("POST", status_endpoint, token=token, json=body)
+    await status_uplink.report(prompt_id, status_endpoint, token, body)
 
 
 async def update_run(prompt_id: str, status: Status):
@@ -1752,9 +2591,7 @@ async def update_run(prompt_id: str, status: Status):
             # requests.post(status_endpoint, json=body)
             if status_endpoint is not None:
                 token = prompt_metadata[prompt_id].token
-                await async_request_with_retry(
-                    "POST", status_endpoint, token=token, json=body
-                )
+                await status_uplink.report(prompt_id, status_endpoint, token, body)
 
             if (
                 (status_endpoint is not None)
@@ -1789,8 +2626,8 @@ async def update_run(prompt_id: str, status: Status):
                             "gpu_event_id": gpu_event_id,
                         }
 
-                        await async_request_with_retry(
-                            "POST", status_endpoint, token=token, json=body
+                        await status_uplink.report(
+                            prompt_id, status_endpoint, token, body, flush=True
                         )
                         # requests.post(status_endpoint, json=body)
                 except Exception as log_error:
@@ -1802,16 +2639,17 @@ async def update_run(prompt_id: str, status: Status):
             logger.info(f"Error occurred while updating run: {e} {stack_trace}")
         finally:
             prompt_metadata[prompt_id].status = status
-            if prompt_id in comfy_message_queues:
-                comfy_message_queues[prompt_id].put_nowait(
-                    {
-                        "event": "status",
-                        "data": {
-                            "prompt_id": prompt_id,
-                            "status": status.value,
-                        },
-                    }
-                )
+            settle_result_cache(prompt_id, status)
+            run_event_hub.publish(
+                prompt_id,
+                {
+                    "event": "status",
+                    "data": {
+                        "prompt_id": prompt_id,
+                        "status": status.value,
+                    },
+                },
+            )
 
 
 async def file_sender(file_object, chunk_size):
@@ -1978,15 +2816,15 @@ async def upload_file(
         # response = await async_request_with_retry('PUT', ok.get("url"), headers=headers, data=data)
         # logger.info(f"Upload file response status: {response.status}, status text: {response.reason}")
 
-        async with aiohttp.ClientSession() as session:
-            try:
-                response = await upload_with_retry(
-                    session, ok.get("url"), headers, data
-                )
-                # Process successful response...
-            except Exception as e:
-                # Handle final failure...
-                logger.error(f"Upload ultimately failed: {str(e)}")
+        session = await client_pool.session(ok.get("url"), pool="storage")
+        try:
+            response = await upload_with_retry(
+                session, ok.get("url"), headers, data
+            )
+            # Process successful response...
+        except Exception as e:
+            # Handle final failure...
+            logger.error(f"Upload ultimately failed: {str(e)}")
 
         end_time = time.time()  # End timing after the request is complete
         logger.info("Upload time: {:.2f} seconds".format(end_time - start_time))
@@ -2291,7 +3129,8 @@ async def update_run_with_output(
     # requests.post(status_endpoint, json=body)
     elif status_endpoint is not None:
         token = prompt_metadata[prompt_id].token
-        await async_request_with_retry("POST", status_endpoint, token=token, json=body)
+        result_cache.record_report(prompt_id, body)
+        await status_uplink.report(prompt_id, status_endpoint, token, body)
 
     await send("outputs_uploaded", {"prompt_id": prompt_id})
 
@@ -2356,6 +3195,8 @@ async def initialize_upload_queue(app=None):
     """Initialize the upload queue and start the worker process"""
     logger.info("Initializing upload queue system...")
     await upload_queue.ensure_worker_running()
+    # Drain reports replayed from the outbox
+    status_outbox.start()
     logger.info(
         "Upload queue system initialized with max_concurrent=%d",
         upload_queue.max_concurrent,
@@ -2437,6 +3278,99 @@ async def get_upload_queue_status(request):
     return web.json_response(status_data)
 
 
+@server.PromptServer.instance.routes.get("/comfyui-deploy/status-uplink")
+async def get_status_uplink_stats(request):
+    """Get the status report counters, including how many requests were saved"""
+    return web.json_response(
+        {**status_uplink.stats(), "outbox": status_outbox.stats()}
+    )
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/retry-policy")
+async def get_retry_policy_stats(request):
+    """Get the circuit breaker state and retry counts for each outbound host"""
+    return web.json_response(retry_policy.stats())
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/http-pool")
+async def get_http_pool_stats(request):
+    """Get the outbound connection pools and per host DNS, connect and TTFB timings"""
+    return web.json_response(client_pool.stats())
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/admission")
+async def get_admission_stats(request):
+    """Get the admission queue, or with ?prompt_id= where that run stands"""
+    prompt_id = request.rel_url.query.get("prompt_id")
+    if admission is None:
+        return web.json_response(
+            {
+                "enabled": False,
+                "deadlines": deadline_tracker.stats(),
+                "submissions": run_submissions.stats(),
+                "micro_batch": micro_batcher.stats() if micro_batcher else None,
+            }
+        )
+
+    if prompt_id is None:
+        return web.json_response(
+            {
+                "enabled": True,
+                **admission.stats(),
+                "deadlines": deadline_tracker.stats(),
+                "submissions": run_submissions.stats(),
+                "micro_batch": micro_batcher.stats() if micro_batcher else None,
+            }
+        )
+
+    position = admission.position(prompt_id)
+    if position is None:
+        return web.json_response(
+            {"error": f"{prompt_id} is not waiting for admission"}, status=404
+        )
+    return web.json_response(position)
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/workflow-cache")
+async def get_workflow_cache_stats(request):
+    """Get the compiled workflow, validation and result cache hit rates"""
+    return web.json_response(
+        {
+            "compiled_workflows": compiled_workflows.stats(),
+            "validation": validation_cache.stats(),
+            "results": result_cache.stats(),
+            "store": workflow_store.stats(),
+        }
+    )
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/realtime")
+async def get_realtime_stats(request):
+    """Get the realtime sessions' queueing, frame ingest and preview counters"""
+    return web.json_response(
+        {
+            "scheduler": realtime_scheduler.stats(),
+            "frames": realtime_frames.stats(),
+            "previews": preview_encoder.stats(),
+            "protocols": socket_protocols.stats(),
+        }
+    )
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/ws-stats")
+async def get_ws_stats(request):
+    """Get the per socket outbound queue depth, drops and send lag"""
+    return web.json_response(socket_fanout.stats())
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/run-events")
+async def get_run_events_stats(request):
+    """Get the replay buffers and subscribers of the streaming endpoint"""
+    return web.json_response(
+        {**run_event_hub.stats(), "throttle": event_throttle.stats()}
+    )
+
+
 @server.PromptServer.instance.routes.post("/comfyui-deploy/cancel-uploads")
 async def cancel_prompt_uploads(request):
     """Cancel all pending uploads for a specific prompt"""
@@ -2665,82 +3599,84 @@ class UploadQueue:
                 if signed_url_data.get("include_acl") is True:
                     headers["x-amz-acl"] = "public-read"
 
-                async with aiohttp.ClientSession() as session:
-                    response = await upload_with_retry(
-                        session,
-                        signed_url_data.get("url"),
-                        headers,
-                        data,
-                    )
+                session = await client_pool.session(
+                    signed_url_data.get("url"), pool="storage"
+                )
+                response = await upload_with_retry(
+                    session,
+                    signed_url_data.get("url"),
+                    headers,
+                    data,
+                )
+
+                # Record upload success and timing
+                end_time = time.perf_counter()
+                upload_time = end_time - start_time
 
-                    # Record upload success and timing
-                    end_time = time.perf_counter()
-                    upload_time = end_time - start_time
+                # Store upload statistics
+                self.upload_stats[prompt_id][filename_base] = {
+                    "size": size,
+                    "type": content_type,
+                    "upload_time": upload_time,
+                }
 
-                    # Store upload statistics
-                    self.upload_stats[prompt_id][filename_base] = {
-                        "size": size,
-                        "type": content_type,
-                        "upload_time": upload_time,
+                # Store timeline event
+                self.upload_timeline[prompt_id].append(
+                    {
+                        "filename": filename_base,
+                        "node_id": node_id,
+                        "node_name": node_name,
+                        "start_time": start_time
+                        - prompt_metadata[prompt_id].start_time,
+                        "end_time": end_time
+                        - prompt_metadata[prompt_id].start_time,
                     }
+                )
 
-                    # Store timeline event
-                    self.upload_timeline[prompt_id].append(
-                        {
-                            "filename": filename_base,
-                            "node_id": node_id,
-                            "node_name": node_name,
-                            "start_time": start_time
-                            - prompt_metadata[prompt_id].start_time,
-                            "end_time": end_time
-                            - prompt_metadata[prompt_id].start_time,
-                        }
-                    )
+                # Update the file_info with download URL and timing
+                file_info["url"] = signed_url_data.get("download_url")
+                file_info["upload_duration"] = upload_time
+                if signed_url_data.get("is_public") is not None:
+                    file_info["is_public"] = signed_url_data.get("is_public")
 
-                    # Update the file_info with download URL and timing
-                    file_info["url"] = signed_url_data.get("download_url")
-                    file_info["upload_duration"] = upload_time
-                    if signed_url_data.get("is_public") is not None:
-                        file_info["is_public"] = signed_url_data.get("is_public")
-
-                    # Update node output data if this upload is associated with a node
-                    if (
-                        node_id
-                        and prompt_id in self.node_output_data
-                        and node_id in self.node_output_data[prompt_id]
-                    ):
-                        node_data = self.node_output_data[prompt_id][node_id]
-                        file_type_key = (
-                            "images" if content_type.startswith("image/") else "files"
-                        )
-                        if file_type_key not in node_data["data"]:
-                            node_data["data"][file_type_key] = []
-                        node_data["data"][file_type_key].append(file_info)
-
-                    # Send success status to clients
-                    await send(
-                        "upload_success",
-                        {
-                            "prompt_id": prompt_id,
-                            "filename": filename_base,
-                            "url": file_info["url"],
-                            "node_id": node_id,
-                        },
+                # Update node output data if this upload is associated with a node
+                if (
+                    node_id
+                    and prompt_id in self.node_output_data
+                    and node_id in self.node_output_data[prompt_id]
+                ):
+                    node_data = self.node_output_data[prompt_id][node_id]
+                    file_type_key = (
+                        "images" if content_type.startswith("image/") else "files"
                     )
+                    if file_type_key not in node_data["data"]:
+                        node_data["data"][file_type_key] = []
+                    node_data["data"][file_type_key].append(file_info)
+
+                # Send success status to clients
+                await send(
+                    "upload_success",
+                    {
+                        "prompt_id": prompt_id,
+                        "filename": filename_base,
+                        "url": file_info["url"],
+                        "node_id": node_id,
+                    },
+                )
 
-                    # If this was the last file for this prompt, show the stats summary
-                    if (
-                        prompt_id in self.pending_uploads
-                        # We now rely on the worker's finally block for the final SUCCESS update.
-                        # Check if the set becomes empty *after* removal in the worker.
-                        and len(self.pending_uploads[prompt_id]) == 1
-                    ):
-                        # await update_run(prompt_id, Status.SUCCESS) # <-- REMOVE/COMMENT OUT
+                # If this was the last file for this prompt, show the stats summary
+                if (
+                    prompt_id in self.pending_uploads
+                    # We now rely on the worker's finally block for the final SUCCESS update.
+                    # Check if the set becomes empty *after* removal in the worker.
+                    and len(self.pending_uploads[prompt_id]) == 1
+                ):
+                    # await update_run(prompt_id, Status.SUCCESS) # <-- REMOVE/COMMENT OUT
 
-                        self._log_upload_stats(prompt_id)
-                        # Clean up stats
-                        del self.upload_stats[prompt_id]
-                        del self.upload_timeline[prompt_id]
+                    self._log_upload_stats(prompt_id)
+                    # Clean up stats
+                    del self.upload_stats[prompt_id]
+                    del self.upload_timeline[prompt_id]
 
         except Exception as e:
             logger.error(f"\nUpload failed for {filename_base}: {str(e)}")
@@ -2901,16 +3837,15 @@ class UploadQueue:
                                                 "output_data": node_data["data"],
                                                 "node_meta": {"node_id": node_id},
                                             }
+                                            result_cache.record_report(prompt_id, body)
                                             try:
-                                                await async_request_with_retry(
-                                                    "POST",
+                                                await status_uplink.report(
+                                                    prompt_id,
                                                     prompt_metadata[
                                                         prompt_id
                                                     ].status_endpoint,
-                                                    token=prompt_metadata[
-                                                        prompt_id
-                                                    ].token,
-                                                    json=body,
+                                                    prompt_metadata[prompt_id].token,
+                                                    body,
                                                 )
                                             except Exception as e:
                                                 logger.error(
@@ -3015,574 +3950,174 @@ def format_execution_timeline(execution_times):
     return format_table(headers, rows)
 
 
-@server.PromptServer.instance.routes.get("/comfyui-deploy/auth-response")
-async def auth_response_proxy(request):
-    request_id = request.rel_url.query.get("request_id")
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-
-    if not request_id:
-        return web.json_response({"error": "request_id is required"}, status=400)
-
-    target_url = f"{api_url}/api/platform/comfyui/auth-response?request_id={request_id}"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(target_url) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-@server.PromptServer.instance.routes.post("/comfyui-deploy/workflow")
-async def create_workflow_proxy(request):
-    data = await request.json()
-    name = data.get("name")
-    workflow_json = data.get("workflow_json")
-    workflow_api = data.get("workflow_api")
-    machine_id = data.get("machine_id")
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-
-    auth_header = request.headers.get("Authorization")
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    if not name or not workflow_json or not workflow_api:
-        return web.json_response(
-            {"error": "name, workflow_json, workflow_api are required"}, status=400
-        )
-
-    target_url = f"{api_url}/api/workflow"
-
-    request_body = {
-        "name": name,
-        "workflow_json": json.dumps(workflow_json),
-        "workflow_api": json.dumps(workflow_api),
-        "machine_id": machine_id,
-    }
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json=request_body,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": auth_header,
-            },
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-@server.PromptServer.instance.routes.post("/comfyui-deploy/workflow/version")
-async def create_workflow_version_proxy(request):
-    data = await request.json()
-    workflow_id = data.get("workflow_id")
-    workflow = data.get("workflow")
-    workflow_api = data.get("workflow_api")
-    comment = data.get("comment", "")
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/workflow/{workflow_id}/version"
-
-    request_body = {
-        "workflow": workflow,
-        "workflow_api": workflow_api,
-        "comment": comment,
+def workflow_body(data):
+    return {
+        "name": data.get("name"),
+        "workflow_json": json.dumps(data.get("workflow_json")),
+        "workflow_api": json.dumps(data.get("workflow_api")),
+        "machine_id": data.get("machine_id"),
     }
 
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json=request_body,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": auth_header,
-            },
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-@server.PromptServer.instance.routes.get("/comfyui-deploy/workflows")
-async def get_workflows_proxy(request):
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-    search = request.rel_url.query.get("search", "")
-    limit = request.rel_url.query.get("limit", 10)
-    offset = request.rel_url.query.get("offset", 0)
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    # Build query parameters properly
-    params = {}
-    if search:
-        params["search"] = search
-    if limit:
-        params["limit"] = limit
-    if offset:
-        params["offset"] = offset
-
-    target_url = f"{api_url}/api/workflows"
-    if params:
-        target_url += f"?{urlencode(params)}"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(
-            target_url,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": auth_header,
-            },
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# for getting a workflow by id
-@server.PromptServer.instance.routes.get("/comfyui-deploy/workflow")
-async def get_workflow_proxy(request):
-    workflow_id = request.rel_url.query.get("workflow_id")
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/workflow/{workflow_id}"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(
-            target_url, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# fetch workflow versions (infinite scroll support)
-@server.PromptServer.instance.routes.get("/comfyui-deploy/workflow/versions")
-async def get_workflow_versions_proxy(request):
-    workflow_id = request.rel_url.query.get("workflow_id")
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-    search = request.rel_url.query.get("search", "")
-    limit = request.rel_url.query.get("limit", "20")
-    offset = request.rel_url.query.get("offset", "0")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    # Build target URL with query params
-    params = {"limit": limit, "offset": offset}
-    if search:
-        params["search"] = search
-
-    query = urlencode(params)
-    target_url = f"{api_url}/api/workflow/{workflow_id}/versions"
-    if query:
-        target_url += f"?{query}"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(
-            target_url, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# fetch a specific workflow version json
-@server.PromptServer.instance.routes.get("/comfyui-deploy/workflow/version")
-async def get_workflow_version_proxy(request):
-    workflow_id = request.rel_url.query.get("workflow_id")
-    version = request.rel_url.query.get("version")
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/workflow/{workflow_id}/version/{version}"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(
-            target_url, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# for getting a machine by id
-@server.PromptServer.instance.routes.get("/comfyui-deploy/machine")
-async def get_machine_proxy(request):
-    machine_id = request.rel_url.query.get("machine_id")
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/machine/{machine_id}"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(
-            target_url, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# for fetching docker steps from current snapshot
-@server.PromptServer.instance.routes.post("/comfyui-deploy/snapshot-to-docker")
-async def snapshot_to_docker_proxy(request):
-    data = await request.json()
-    snapshot = data.get("snapshot")
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/snapshot-to-docker"
-
-    request_body = snapshot
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url, json=request_body, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
 
-# update a serverless machine with machine id
-@server.PromptServer.instance.routes.post("/comfyui-deploy/machine/update")
-async def update_machine_proxy(request):
-    data = await request.json()
-    machine_id = data.get("machine_id")
-    comfyui_version = data.get("comfyui_version", None)
-    docker_steps = data.get("docker_steps")
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/machine/serverless/{machine_id}"
-
-    request_body = {"docker_command_steps": docker_steps}
-
-    if comfyui_version:
-        request_body["comfyui_version"] = comfyui_version
+def snapshot_body(data):
+    return data.get("snapshot")
 
-    try:
-        await ensure_client_session()
-        async with client_session.patch(
-            target_url, json=request_body, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-@server.PromptServer.instance.routes.post("/comfyui-deploy/machine/create")
-async def create_machine_proxy(request):
-    data = await request.json()
-    name = data.get("name")
-    docker_command_steps = data.get("docker_command_steps")
-    comfyui_version = data.get("comfyui_version")
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
 
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
+def machine_update_body(data):
+    request_body = {"docker_command_steps": data.get("docker_steps")}
+    if data.get("comfyui_version"):
+        request_body["comfyui_version"] = data.get("comfyui_version")
+    return request_body
 
-    target_url = f"{api_url}/api/machine/serverless"
 
-    request_body = {
-        "name": name,
-        "docker_command_steps": docker_command_steps,
-        "comfyui_version": comfyui_version,
+def machine_create_body(data):
+    return {
+        "name": data.get("name"),
+        "docker_command_steps": data.get("docker_command_steps"),
+        "comfyui_version": data.get("comfyui_version"),
         "gpu": "A10G",
     }
 
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url, json=request_body, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# get latest comfyui version
-@server.PromptServer.instance.routes.get("/comfyui-deploy/comfyui-version")
-async def get_comfyui_version_proxy(request):
-    api_url = request.rel_url.query.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/latest-hashes"
-
-    try:
-        await ensure_client_session()
-        async with client_session.get(
-            target_url, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# Proxy: generate single-part upload URL
-@server.PromptServer.instance.routes.post(
-    "/comfyui-deploy/volume/file/generate-upload-url"
-)
-async def proxy_generate_upload_url(request):
-    data = await request.json()
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/volume/file/generate-upload-url"
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json={
-                "filename": data.get("filename"),
-                "contentType": data.get("contentType"),
-                "size": data.get("size"),
-            },
-            headers={"Authorization": auth_header},
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# Proxy: initiate multipart upload
-@server.PromptServer.instance.routes.post(
-    "/comfyui-deploy/volume/file/initiate-multipart-upload"
-)
-async def proxy_initiate_multipart_upload(request):
-    data = await request.json()
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/volume/file/initiate-multipart-upload"
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json={
-                "filename": data.get("filename"),
-                "contentType": data.get("contentType"),
-                "size": data.get("size"),
-            },
-            headers={"Authorization": auth_header},
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# Proxy: generate part upload URL
-@server.PromptServer.instance.routes.post(
-    "/comfyui-deploy/volume/file/generate-part-upload-url"
-)
-async def proxy_generate_part_upload_url(request):
-    data = await request.json()
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/volume/file/generate-part-upload-url"
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json={
-                "uploadId": data.get("uploadId"),
-                "key": data.get("key"),
-                "partNumber": data.get("partNumber"),
-            },
-            headers={"Authorization": auth_header},
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# Proxy: complete multipart upload
-@server.PromptServer.instance.routes.post(
-    "/comfyui-deploy/volume/file/complete-multipart-upload"
-)
-async def proxy_complete_multipart_upload(request):
-    data = await request.json()
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/volume/file/complete-multipart-upload"
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json={
-                "uploadId": data.get("uploadId"),
-                "key": data.get("key"),
-                "parts": data.get("parts"),
-            },
-            headers={"Authorization": auth_header},
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# Proxy: abort multipart upload
-@server.PromptServer.instance.routes.post(
-    "/comfyui-deploy/volume/file/abort-multipart-upload"
-)
-async def proxy_abort_multipart_upload(request):
-    data = await request.json()
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/volume/file/abort-multipart-upload"
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url,
-            json={
-                "uploadId": data.get("uploadId"),
-                "key": data.get("key"),
-            },
-            headers={"Authorization": auth_header},
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
-
-
-# Proxy: add model (unified endpoint)
-@server.PromptServer.instance.routes.post("/comfyui-deploy/volume/model")
-async def proxy_add_model(request):
-    data = await request.json()
-    api_url = data.get("api_url", "https://api.comfydeploy.com")
-    auth_header = request.headers.get("Authorization")
-
-    if not auth_header:
-        return web.json_response(
-            {"error": "Authorization header is required"}, status=401
-        )
-
-    target_url = f"{api_url}/api/volume/model"
 
-    # pass body through but remove api_url key
-    forward_body = dict(data)
-    if "api_url" in forward_body:
-        forward_body.pop("api_url")
-
-    try:
-        await ensure_client_session()
-        async with client_session.post(
-            target_url, json=forward_body, headers={"Authorization": auth_header}
-        ) as response:
-            json_data = await response.json()
-            return web.json_response(json_data, status=response.status)
-    except Exception as e:
-        return web.json_response({"error": str(e)}, status=500)
+# Short lived cache for the read endpoints the UI refreshes repeatedly
+proxy_cache_ttl = float(os.environ.get("CD_PROXY_CACHE_TTL", "10"))
+
+API_PROXY_ROUTES = [
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/auth-response",
+        "/api/platform/comfyui/auth-response",
+        query=("request_id",),
+        required=("request_id",),
+        require_auth=False,
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/workflow",
+        "/api/workflow",
+        body=workflow_body,
+        required=("name", "workflow_json", "workflow_api"),
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/workflow/version",
+        "/api/workflow/{workflow_id}/version",
+        body=pick("workflow", "workflow_api", comment=""),
+    ),
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/workflows",
+        "/api/workflows",
+        query=("search", "limit", "offset"),
+        defaults={"limit": 10, "offset": 0},
+        cache_ttl=proxy_cache_ttl,
+    ),
+    # for getting a workflow by id
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/workflow",
+        "/api/workflow/{workflow_id}",
+        cache_ttl=proxy_cache_ttl,
+    ),
+    # fetch workflow versions (infinite scroll support)
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/workflow/versions",
+        "/api/workflow/{workflow_id}/versions",
+        query=("limit", "offset", "search"),
+        defaults={"limit": "20", "offset": "0"},
+        cache_ttl=proxy_cache_ttl,
+    ),
+    # fetch a specific workflow version json
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/workflow/version",
+        "/api/workflow/{workflow_id}/version/{version}",
+        cache_ttl=proxy_cache_ttl,
+    ),
+    # for getting a machine by id
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/machine",
+        "/api/machine/{machine_id}",
+        cache_ttl=proxy_cache_ttl,
+    ),
+    # for fetching docker steps from current snapshot
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/snapshot-to-docker",
+        "/api/snapshot-to-docker",
+        body=snapshot_body,
+    ),
+    # update a serverless machine with machine id
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/machine/update",
+        "/api/machine/serverless/{machine_id}",
+        upstream_method="PATCH",
+        body=machine_update_body,
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/machine/create",
+        "/api/machine/serverless",
+        body=machine_create_body,
+    ),
+    # get latest comfyui version
+    ProxyRoute(
+        "GET",
+        "/comfyui-deploy/comfyui-version",
+        "/api/latest-hashes",
+        cache_ttl=proxy_cache_ttl,
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/volume/file/generate-upload-url",
+        "/api/volume/file/generate-upload-url",
+        body=pick("filename", "contentType", "size"),
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/volume/file/initiate-multipart-upload",
+        "/api/volume/file/initiate-multipart-upload",
+        body=pick("filename", "contentType", "size"),
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/volume/file/generate-part-upload-url",
+        "/api/volume/file/generate-part-upload-url",
+        body=pick("uploadId", "key", "partNumber"),
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/volume/file/complete-multipart-upload",
+        "/api/volume/file/complete-multipart-upload",
+        body=pick("uploadId", "key", "parts"),
+    ),
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/volume/file/abort-multipart-upload",
+        "/api/volume/file/abort-multipart-upload",
+        body=pick("uploadId", "key"),
+    ),
+    # add model (unified endpoint)
+    ProxyRoute(
+        "POST",
+        "/comfyui-deploy/volume/model",
+        "/api/volume/model",
+        body=passthrough,
+    ),
+]
+
+api_proxy = ApiProxy(lambda url: client_pool.session(url, pool="api"))
+
+for route in API_PROXY_ROUTES:
+    api_proxy.register(server.PromptServer.instance.routes, route)
+
+
+@server.PromptServer.instance.routes.get("/comfyui-deploy/api-proxy")
+async def get_api_proxy_stats(request):
+    return web.json_response(api_proxy.stats())
 
 
 # FS: stat file (size)
@@ -3632,8 +4167,6 @@ async def upload_part_from_path(request):
 
         size = end - start
 
-        await ensure_client_session()
-
         # Important: S3 pre-signed part uploads do not support chunked transfer
         # Buffer the exact part into memory to provide a Content-Length header
         buffer = bytearray()
@@ -3664,7 +4197,8 @@ async def upload_part_from_path(request):
             "Content-Type": "application/octet-stream",
         }
 
-        async with client_session.put(
+        session = await client_pool.session(upload_url, pool="storage")
+        async with session.put(
             upload_url, data=bytes(buffer), headers=headers
         ) as resp:
             text = await resp.text()
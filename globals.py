@@ -1,10 +1,13 @@
+import os
 import struct
 from enum import Enum
 import aiohttp
 from typing import List, Union, Any, Optional
-from PIL import Image, ImageOps
 from io import BytesIO
 from pydantic import BaseModel as PydanticBaseModel
+from socket_fanout import SocketFanout
+from realtime_media import FrameIngest, PreviewEncoder, encode_preview
+from realtime_protocol import PROTOCOL_V2, SocketProtocols
 
 
 class BaseModel(PydanticBaseModel):
@@ -24,12 +27,16 @@ class Status(Enum):
 class StreamingPrompt(BaseModel):
     workflow_api: Any
     auth_token: str
-    inputs: dict[str, Union[str, bytes, Image.Image]]
+    inputs: dict[str, Union[str, bytes]]
     running_prompt_ids: set[str] = set()
     status_endpoint: Optional[str]
     file_upload_endpoint: Optional[str]
     workflow: Any
     gpu_event_id: Optional[str] = None
+    # CompiledWorkflow of workflow_api, set on the first prompt of the session
+    compiled: Any = None
+    # PromptTemplate of workflow_api, built with compiled
+    template: Any = None
 
 
 class SimplePrompt(BaseModel):
@@ -50,6 +57,15 @@ class SimplePrompt(BaseModel):
 
 
 sockets = dict()
+# Outbound queues and writer tasks of the sockets above
+socket_fanout = SocketFanout(
+    max_queue=int(os.environ.get("CD_WS_QUEUE_SIZE", "256")),
+    overflow_policy=os.environ.get("CD_WS_OVERFLOW_POLICY", "drop_progress"),
+)
+# Newest binary image frame of each realtime input, decoded off the loop
+realtime_frames = FrameIngest(
+    workers=int(os.environ.get("CD_FRAME_DECODE_WORKERS", "2"))
+)
 prompt_metadata: dict[str, SimplePrompt] = {}
 streaming_prompt_metadata: dict[str, StreamingPrompt] = {}
 
@@ -63,46 +79,37 @@ max_output_id_length = 24
 
 
 async def send_image(image_data, sid=None, output_id: str = None):
-    max_length = max_output_id_length
-    output_id = output_id[:max_length]
-    padded_output_id = output_id.ljust(max_length, "\x00")
-    encoded_output_id = padded_output_id.encode("ascii", "replace")
-
     image_type = image_data[0]
     image = image_data[1]
     max_size = image_data[2]
     quality = image_data[3]
-    if max_size is not None:
-        if hasattr(Image, "Resampling"):
-            resampling = Image.Resampling.BILINEAR
-        else:
-            resampling = Image.ANTIALIAS
-
-        image = ImageOps.contain(image, (max_size, max_size), resampling)
-    type_num = 1
-    if image_type == "JPEG":
-        type_num = 1
-    elif image_type == "PNG":
-        type_num = 2
-    elif image_type == "WEBP":
-        type_num = 3
-
-    bytesIO = BytesIO()
-    header = struct.pack(">I", type_num)
-    # 4 bytes for the type
-    bytesIO.write(header)
-    # 10 bytes for the output_id
-    position_before = bytesIO.tell()
-    bytesIO.write(encoded_output_id)
-    position_after = bytesIO.tell()
-    bytes_written = position_after - position_before
-    print(f"Bytes written: {bytes_written}")
-
-    image.save(bytesIO, format=image_type, quality=quality, compress_level=1)
-    preview_bytes = bytesIO.getvalue()
+    preview_bytes = encode_preview(image, image_type, quality, max_size, output_id)
     await send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
 
+def publish_preview(preview_bytes, sid=None, version=1):
+    """send_bytes of an encoded preview, from the event loop without awaiting"""
+    if sid is None or sid in sockets:
+        if version == PROTOCOL_V2:
+            # v2 frames carry their event in their header
+            message = preview_bytes
+        else:
+            message = encode_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes)
+        socket_fanout.publish_bytes(message, sid=sid)
+
+
+# Binary protocol version each socket opted in to
+socket_protocols = SocketProtocols()
+
+# Encodes websocket image outputs off the loop and the executing prompt
+preview_encoder = PreviewEncoder(
+    publish_preview,
+    workers=int(os.environ.get("CD_PREVIEW_ENCODE_WORKERS", "2")),
+    max_in_flight=int(os.environ.get("CD_PREVIEW_MAX_IN_FLIGHT", "32")),
+    protocols=socket_protocols,
+)
+
+
 async def send_socket_catch_exception(function, message):
     try:
         await function(message)
@@ -129,9 +136,5 @@ async def send_bytes(event, data, sid=None):
 
     print("sending image to ", event, sid)
 
-    if sid is None:
-        _sockets = list(sockets.values())
-        for ws in _sockets:
-            await send_socket_catch_exception(ws.send_bytes, message)
-    elif sid in sockets:
-        await send_socket_catch_exception(sockets[sid].send_bytes, message)
+    if sid is None or sid in sockets:
+        socket_fanout.publish_bytes(message, sid=sid)
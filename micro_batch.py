@@ -0,0 +1,199 @@
+import asyncio
+import time
+import uuid
+from logging import getLogger
+
+from validation_cache import structural_hash
+from workflow_compiler import fork_workflow_api, written_fields_hash
+
+logger = getLogger("comfy-deploy")
+
+# Latent sources take their batch through this input
+BATCH_SIZE_FIELD = "batch_size"
+
+
+def batch_size_targets(prompt):
+    """[(node_id, batch_size)] of the literal batch sizes of a prompt"""
+    return [
+        (node_id, node["inputs"][BATCH_SIZE_FIELD])
+        for node_id, node in prompt.items()
+        if isinstance(node.get("inputs"), dict)
+        and isinstance(node["inputs"].get(BATCH_SIZE_FIELD), int)
+        and not isinstance(node["inputs"][BATCH_SIZE_FIELD], bool)
+    ]
+
+
+def batch_group_key(entry, compiled, rewritten=True):
+    """
+    Runs with the same key only differ in their seeds and can share one
+    batched prompt, None when the prompt has no batch size to scale. A
+    prompt not rewritten by on_prompt handlers is only hashed by what it
+    holds in the compiled workflow's other masked fields.
+    """
+    _, prompt, extra_data, outputs_to_execute, _ = entry
+    if not batch_size_targets(prompt):
+        return None
+    seed_fields = [(node_id, field) for node_id, _, field in compiled.seed_candidates]
+    outputs = sorted(map(str, outputs_to_execute))
+    if rewritten:
+        structure = structural_hash(prompt, seed_fields, outputs)
+    else:
+        seeds = set(seed_fields)
+        fields = [f for f in compiled.masked_fields if f not in seeds]
+        structure = written_fields_hash(compiled, prompt, fields, outputs)
+    return structure, extra_data.get("client_id")
+
+
+def build_batch_prompt(prompt, count):
+    """The prompt with every literal batch size multiplied by count"""
+    batched = fork_workflow_api(prompt)
+    for node_id, batch_size in batch_size_targets(prompt):
+        batched[node_id]["inputs"][BATCH_SIZE_FIELD] = batch_size * count
+    return batched
+
+
+def split_output(output, index, count):
+    """The part of a batched node output belonging to member `index`"""
+    split = {}
+    for key, value in output.items():
+        if isinstance(value, list) and value and len(value) % count == 0:
+            size = len(value) // count
+            split[key] = value[index * size : (index + 1) * size]
+        else:
+            # Not one item per batch entry, every member gets all of it
+            split[key] = value
+    return split
+
+
+def split_event(event, data, member_id, index, count):
+    data = {**data, "prompt_id": member_id}
+    if event == "executed" and isinstance(data.get("output"), dict):
+        data["output"] = split_output(data["output"], index, count)
+    return data
+
+
+class PendingBatch:
+    __slots__ = ("key", "entries", "tickets", "handle", "created_at")
+
+    def __init__(self, key):
+        self.key = key
+        self.entries = []
+        self.tickets = []
+        self.handle = None
+        self.created_at = time.monotonic()
+
+
+class MicroBatcher:
+    """
+    Holds validated runs for up to `max_wait` seconds so that runs of the
+    same graph which only differ in their seeds go to the GPU as one prompt,
+    with the batch sizes scaled by the number of runs (at most `max_size`).
+    The batch runs with the seeds of its first member, the other members
+    get the other images of the batch instead of their own seeds.
+
+    Events of a batch are handed back per member with members(), executed
+    outputs are split with split_event.
+    """
+
+    def __init__(self, dispatch, max_size=8, max_wait=0.05, prompt_rewritten=None):
+        # dispatch(entry, ticket) queues a single or batched prompt
+        self.dispatch = dispatch
+        # prompt_rewritten() -> True while on_prompt handlers may change prompts
+        self.prompt_rewritten = prompt_rewritten
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.pending = {}  # group key -> PendingBatch
+        self.held = {}  # prompt_id -> group key
+        self.batches = {}  # batch prompt_id -> [member prompt_ids]
+        self.counters = {
+            "offered": 0,
+            "batches": 0,
+            "batched_runs": 0,
+            "single_runs": 0,
+        }
+
+    def offer(self, entry, compiled, ticket=None):
+        """Hold a run to batch it, False if it can't be batched"""
+        if compiled is None or self.max_size < 2:
+            return False
+        rewritten = self.prompt_rewritten is None or self.prompt_rewritten()
+        key = batch_group_key(entry, compiled, rewritten)
+        if key is None:
+            return False
+
+        self.counters["offered"] += 1
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = PendingBatch(key)
+            self.pending[key] = batch
+            batch.handle = asyncio.get_running_loop().call_later(
+                self.max_wait, self.flush, key
+            )
+        batch.entries.append(entry)
+        batch.tickets.append(ticket)
+        self.held[entry[0]] = key
+
+        if len(batch.entries) >= self.max_size:
+            self.flush(key)
+        return True
+
+    def flush(self, key):
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.handle is not None:
+            batch.handle.cancel()
+        for entry in batch.entries:
+            self.held.pop(entry[0], None)
+
+        if len(batch.entries) == 1:
+            self.counters["single_runs"] += 1
+            self._dispatch(batch.entries[0], batch.tickets[0])
+            return
+
+        first = batch.entries[0]
+        batch_id = f"batch-{uuid.uuid4()}"
+        members = [entry[0] for entry in batch.entries]
+        prompt = build_batch_prompt(first[1], len(members))
+        self.batches[batch_id] = members
+        self.counters["batches"] += 1
+        self.counters["batched_runs"] += len(members)
+        logger.info(f"Micro batch {batch_id}: {len(members)} runs, {members}")
+        self._dispatch((batch_id, prompt, *first[2:]), batch.tickets[0])
+
+    def _dispatch(self, entry, ticket):
+        try:
+            self.dispatch(entry, ticket)
+        except Exception as e:
+            logger.error(f"Failed to queue {entry[0]}: {e}")
+            self.batches.pop(entry[0], None)
+
+    def cancel(self, prompt_id):
+        """Drop a run still held for batching, True if it was held"""
+        key = self.held.pop(prompt_id, None)
+        if key is None:
+            return False
+        batch = self.pending[key]
+        index = next(i for i, e in enumerate(batch.entries) if e[0] == prompt_id)
+        del batch.entries[index]
+        del batch.tickets[index]
+        if not batch.entries:
+            batch.handle.cancel()
+            del self.pending[key]
+        return True
+
+    def members(self, prompt_id):
+        """Member prompt_ids of a batch prompt, None for any other prompt"""
+        return self.batches.get(prompt_id)
+
+    def finish(self, batch_id):
+        self.batches.pop(batch_id, None)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "max_size": self.max_size,
+            "max_wait": self.max_wait,
+            "held": len(self.held),
+            "running_batches": len(self.batches),
+        }
@@ -0,0 +1,455 @@
+import asyncio
+import random
+import time
+from logging import getLogger
+from urllib.parse import urlparse
+
+import aiohttp
+
+logger = getLogger("comfy-deploy")
+
+# Status codes worth retrying, everything else in the 4xx range is the caller's fault
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host whose circuit is open"""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"Circuit open for {host}, retry in {retry_in:.1f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+def is_permanent_error(e: Exception) -> bool:
+    """The server rejected the request itself, sending it again won't help"""
+    return (
+        isinstance(e, aiohttp.ClientResponseError)
+        and 400 <= e.status < 500
+        and e.status not in RETRYABLE_STATUS_CODES
+    )
+
+
+def is_retryable_error(e: Exception) -> bool:
+    if isinstance(e, CircuitOpenError):
+        return True
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in RETRYABLE_STATUS_CODES
+    return isinstance(
+        e, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+    )
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30.0, max_reset_timeout=300.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.probe_started_at = 0.0
+        self.counters = {
+            "requests": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "rejected": 0,
+            "opened": 0,
+        }
+
+    def before_request(self):
+        """Raises CircuitOpenError when the host should not be called right now"""
+        if self.state == self.OPEN:
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0:
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.host, retry_in)
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            # Only a single probe request goes through until it succeeds,
+            # a probe that never reported back is given up on after a while
+            now = time.monotonic()
+            if self.probe_in_flight and now - self.probe_started_at < self.reset_timeout:
+                self.counters["rejected"] += 1
+                raise CircuitOpenError(self.host, self.reset_timeout)
+            self.probe_in_flight = True
+            self.probe_started_at = now
+
+        self.counters["requests"] += 1
+
+    def record_success(self):
+        self.counters["successes"] += 1
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit closed for {self.host}")
+        self.state = self.CLOSED
+        self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        self.counters["failures"] += 1
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            # The probe failed, stay open for longer
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self._open()
+        elif self.consecutive_failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        if self.state != self.OPEN:
+            self.counters["opened"] += 1
+            logger.warning(
+                f"Circuit opened for {self.host} after {self.consecutive_failures} failures"
+            )
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    def stats(self):
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in": round(retry_in, 2),
+            **self.counters,
+        }
+
+
+class RetryBudget:
+    """
+    Global token bucket shared by all hosts. Each retry spends a token and
+    each success earns back `ratio` of one, so during an outage retries are
+    capped at a fraction of the successful traffic (plus a small floor).
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, capacity=50.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last_refill) * self.min_per_second
+        )
+        self.last_refill = now
+
+    def deposit(self):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted += 1
+        return False
+
+    def stats(self):
+        self._refill()
+        return {"tokens": round(self.tokens, 2), "exhausted": self.exhausted}
+
+
+class RetryPolicy:
+    """Retry decisions, backoff and circuit breakers for outbound requests, keyed by host"""
+
+    def __init__(
+        self,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=30.0,
+        delay_multiplier=3.0,
+        failure_threshold=5,
+        reset_timeout=30.0,
+        budget=None,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay_multiplier = delay_multiplier
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.budget = budget or RetryBudget()
+        self.breakers = {}  # host -> CircuitBreaker
+
+    def breaker(self, url) -> CircuitBreaker:
+        host = urlparse(url).netloc or url
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                host,
+                failure_threshold=self.failure_threshold,
+                reset_timeout=self.reset_timeout,
+            )
+            self.breakers[host] = breaker
+        return breaker
+
+    def next_delay(self, previous_delay, retry_after=None):
+        """Decorrelated jitter, never shorter than what the server asked for"""
+        upper = max(self.base_delay, previous_delay * self.delay_multiplier)
+        delay = min(self.max_delay, random.uniform(self.base_delay, upper))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def should_retry(self, breaker, attempt, e) -> bool:
+        if attempt + 1 >= self.max_retries or not is_retryable_error(e):
+            return False
+        if isinstance(e, CircuitOpenError):
+            return False
+        if not self.budget.withdraw():
+            logger.warning(f"Retry budget exhausted, not retrying {breaker.host}")
+            return False
+        breaker.counters["retries"] += 1
+        return True
+
+    def stats(self):
+        return {
+            "max_retries": self.max_retries,
+            "budget": self.budget.stats(),
+            "hosts": {host: b.stats() for host, b in self.breakers.items()},
+        }
+
+
+def parse_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class TimingStat:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def stats(self):
+        avg = self.total / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "avg_ms": round(avg * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class HostTimings:
+    def __init__(self):
+        self.dns = TimingStat()
+        # Time to open a new connection, including the TLS handshake for https
+        self.connect = TimingStat()
+        self.ttfb = TimingStat()
+        self.requests = 0
+        self.reused_connections = 0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "reused_connections": self.reused_connections,
+            "errors": self.errors,
+            "dns": self.dns.stats(),
+            "connect": self.connect.stats(),
+            "ttfb": self.ttfb.stats(),
+        }
+
+
+class ClientPool:
+    """
+    The pooled HTTP sessions every outbound request goes through. Hosts are
+    assigned to a named pool ("api" for the status API, "storage" for the
+    object storage uploads), each pool has its own connector and per-host
+    connection limit, and unknown hosts fall back to the "api" pool.
+    """
+
+    def __init__(self, pool_sizes=None, prewarm_interval=60.0):
+        self.pool_sizes = pool_sizes or {"api": 10, "storage": 16}
+        self.prewarm_interval = prewarm_interval
+        self.sessions = {}  # pool name -> ClientSession
+        self.host_pools = {}  # host -> pool name
+        self.pool_origins = {}  # pool name -> set of origins seen
+        self.host_timings = {}  # host -> HostTimings
+        self.last_prewarm = {}  # origin -> monotonic time
+        self.prewarm_tasks = set()
+        self.trace_config = self._create_trace_config()
+
+    def _timings(self, host) -> HostTimings:
+        timings = self.host_timings.get(host)
+        if timings is None:
+            timings = HostTimings()
+            self.host_timings[host] = timings
+        return timings
+
+    def _create_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.host = params.url.host
+            ctx.request_start = time.perf_counter()
+            self._timings(ctx.host).requests += 1
+
+        async def on_dns_resolvehost_start(session, ctx, params):
+            ctx.dns_start = time.perf_counter()
+
+        async def on_dns_resolvehost_end(session, ctx, params):
+            self._timings(params.host).dns.add(time.perf_counter() - ctx.dns_start)
+
+        async def on_connection_create_start(session, ctx, params):
+            ctx.connect_start = time.perf_counter()
+
+        async def on_connection_create_end(session, ctx, params):
+            self._timings(ctx.host).connect.add(time.perf_counter() - ctx.connect_start)
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._timings(ctx.host).reused_connections += 1
+
+        async def on_request_end(session, ctx, params):
+            # Fired once the response headers are in
+            self._timings(ctx.host).ttfb.add(time.perf_counter() - ctx.request_start)
+
+        async def on_request_exception(session, ctx, params):
+            self._timings(ctx.host).errors += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def assign(self, url, pool):
+        """Route all requests to the url's host through the given pool"""
+        if not url:
+            return
+        parsed = urlparse(url)
+        if parsed.hostname and pool in self.pool_sizes:
+            self.host_pools[parsed.hostname] = pool
+            self.pool_origins.setdefault(pool, set()).add(
+                f"{parsed.scheme}://{parsed.netloc}"
+            )
+
+    def pool_for(self, url) -> str:
+        if url:
+            host = urlparse(url).hostname
+            if host in self.host_pools:
+                return self.host_pools[host]
+        return "api"
+
+    async def session(self, url=None, pool=None) -> aiohttp.ClientSession:
+        if pool is None:
+            pool = self.pool_for(url)
+        elif url:
+            self.assign(url, pool)
+
+        return self._get_session(pool)
+
+    async def raw_session(self, url=None) -> aiohttp.ClientSession:
+        """A session that leaves response bodies compressed, for pass-through proxying"""
+        return self._get_session(self.pool_for(url), auto_decompress=False)
+
+    def _get_session(self, pool, auto_decompress=True):
+        key = pool if auto_decompress else f"{pool}:raw"
+        session = self.sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_sizes[pool] * 3,
+                limit_per_host=self.pool_sizes[pool],
+                enable_cleanup_closed=True,
+                force_close=False,
+                ttl_dns_cache=300,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None, connect=5, sock_read=60, sock_connect=5
+                ),
+                raise_for_status=False,
+                auto_decompress=auto_decompress,
+                trace_configs=[self.trace_config],
+            )
+            self.sessions[key] = session
+            logger.info(
+                f"Created {key} client session with {self.pool_sizes[pool]} connections per host"
+            )
+        return session
+
+    def prewarm(self, *urls, pool=None):
+        """Open connections in the background to hosts a run is about to use"""
+        for url in urls:
+            if not url:
+                continue
+            parsed = urlparse(url)
+            if not parsed.scheme or not parsed.netloc:
+                continue
+            origin = f"{parsed.scheme}://{parsed.netloc}"
+            if pool is not None:
+                self.assign(url, pool)
+
+            now = time.monotonic()
+            if now - self.last_prewarm.get(origin, -self.prewarm_interval) < self.prewarm_interval:
+                continue
+            self.last_prewarm[origin] = now
+
+            task = asyncio.create_task(self._prewarm(origin))
+            self.prewarm_tasks.add(task)
+            task.add_done_callback(self.prewarm_tasks.discard)
+
+    async def _prewarm(self, origin):
+        try:
+            session = await self.session(origin)
+            async with session.head(
+                origin, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=5)
+            ):
+                pass
+        except Exception as e:
+            logger.debug(f"Prewarming {origin} failed: {e}")
+
+    async def close(self):
+        for session in self.sessions.values():
+            if not session.closed:
+                await session.close()
+        self.sessions = {}
+
+    def stats(self):
+        return {
+            "pools": {
+                pool: {
+                    "limit_per_host": size,
+                    "open": pool in self.sessions and not self.sessions[pool].closed,
+                }
+                for pool, size in self.pool_sizes.items()
+            },
+            "host_pools": self.host_pools,
+            "hosts": {host: t.stats() for host, t in self.host_timings.items()},
+        }
@@ -0,0 +1,496 @@
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from logging import getLogger
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from realtime_protocol import (
+    EVENT_PREVIEW_IMAGE,
+    FLAG_CAPTURE_TIMESTAMP,
+    PROTOCOL_V1,
+    PROTOCOL_V2,
+    now_us,
+    pack_v2_header,
+)
+
+logger = getLogger("comfy-deploy")
+
+# image_type codes of binary websocket image frames
+FRAME_JPEG = 1
+FRAME_PNG = 2
+FRAME_WEBP = 3
+# Unencoded uint8 RGB, in v1 prefixed with its width and height ("<II")
+FRAME_RAW_RGB = 4
+# Unencoded uint8 RGBA, v2 only, alpha is dropped on input
+FRAME_RAW_RGBA = 5
+
+FRAME_FORMATS = {
+    FRAME_JPEG: "JPEG",
+    FRAME_PNG: "PNG",
+    FRAME_WEBP: "WEBP",
+    FRAME_RAW_RGB: "RAW_RGB",
+    FRAME_RAW_RGBA: "RAW_RGBA",
+}
+RAW_CHANNELS = {FRAME_RAW_RGB: 3, FRAME_RAW_RGBA: 4}
+RAW_SIZE = struct.Struct("<II")
+
+# image_type codes of preview images sent to the sockets, RAW is only sent
+# unencoded to v2 sockets and as PNG to the others
+PREVIEW_TYPES = {"JPEG": FRAME_JPEG, "PNG": FRAME_PNG, "WEBP": FRAME_WEBP}
+RAW_PREVIEW = "RAW"
+OUTPUT_ID_LENGTH = 24
+
+
+class FrameRing:
+    """
+    The newest frame of one realtime input, in preallocated (H, W, 3) uint8
+    slots reused from frame to frame. The writer fills a slot nobody is
+    reading and commits it, readers pin the newest slot while they copy it.
+    """
+
+    def __init__(self, slots=3):
+        self.lock = threading.Lock()
+        self.slots = [None] * slots
+        self.timestamps = [None] * slots  # capture time of each slot's frame
+        self.busy = [0] * slots
+        self.latest = None  # slot index
+        self.seq = 0  # seq of the frame in latest
+        self.issued = 0  # last seq handed to a writer
+        self.read_timestamp = None  # capture time of the frame last read
+
+    def next_seq(self):
+        with self.lock:
+            self.issued += 1
+            return self.issued
+
+    def acquire(self, shape):
+        """(index, array) of a free slot with the shape, None if all are busy"""
+        with self.lock:
+            for index, busy in enumerate(self.busy):
+                if index != self.latest and not busy:
+                    break
+            else:
+                return None
+            self.busy[index] += 1
+            slot = self.slots[index]
+        if slot is None or slot.shape != shape:
+            slot = np.empty(shape, dtype=np.uint8)
+            self.slots[index] = slot
+        return index, slot
+
+    def commit(self, index, seq, timestamp_us=None):
+        """Publish a filled slot, False if a newer frame was published first"""
+        with self.lock:
+            self.busy[index] -= 1
+            if seq <= self.seq:
+                return False
+            self.latest = index
+            self.seq = seq
+            self.timestamps[index] = timestamp_us
+            return True
+
+    @contextmanager
+    def read(self):
+        """Yields (frame, seq) of the newest frame, (None, 0) before any"""
+        with self.lock:
+            index = self.latest
+            if index is not None:
+                self.busy[index] += 1
+                self.read_timestamp = self.timestamps[index]
+            seq = self.seq
+        if index is None:
+            yield None, 0
+            return
+        try:
+            yield self.slots[index], seq
+        finally:
+            with self.lock:
+                self.busy[index] -= 1
+
+
+def decode_into(ring: FrameRing, seq, payload, timestamp_us=None):
+    """Decode an encoded frame into a slot of the ring, runs on the decode pool"""
+    image = Image.open(BytesIO(payload))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return store_array(ring, seq, np.asarray(image), timestamp_us)
+
+
+def store_raw(
+    ring: FrameRing, seq, payload, image_type, size=None, timestamp_us=None
+):
+    """
+    Copy a raw RGB/RGBA payload into a slot of the ring, nothing to decode.
+    Without a size (v1) the payload starts with it.
+    """
+    pixels = memoryview(payload)
+    if size is None:
+        size = RAW_SIZE.unpack_from(pixels)
+        pixels = pixels[RAW_SIZE.size :]
+    width, height = size
+    channels = RAW_CHANNELS[image_type]
+    if len(pixels) != width * height * channels:
+        raise ValueError(
+            f"Raw {FRAME_FORMATS[image_type]} frame of {width}x{height} has {len(pixels)} bytes of pixels"
+        )
+    frame = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, channels)
+    # The alpha channel is skipped by the copy into the RGB slot
+    return store_array(ring, seq, frame[:, :, :3], timestamp_us)
+
+
+def store_array(ring: FrameRing, seq, frame, timestamp_us=None):
+    acquired = ring.acquire(frame.shape)
+    if acquired is None:
+        return False
+    index, slot = acquired
+    try:
+        np.copyto(slot, frame)
+    except BaseException:
+        ring.commit(index, 0)
+        raise
+    return ring.commit(index, seq, timestamp_us)
+
+
+class FrameIngest:
+    """
+    Binary image frames of the realtime sockets, by session and input_id.
+    Frames are decoded on a thread pool, at most one at a time per input: a
+    frame arriving during a decode waits, replacing any frame already
+    waiting, so only the newest frame is ever decoded next.
+    """
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="cd-frames"
+        )
+        self.rings = {}  # (sid, input_id) -> FrameRing
+        # (sid, input_id) -> (seq, payload, timestamp_us) waiting, or None
+        self.decoding = {}
+        self.counters = {
+            "frames": 0,
+            "decoded": 0,
+            "raw": 0,
+            "replaced": 0,
+            "stale": 0,
+            "errors": 0,
+        }
+
+    def ring(self, sid, input_id):
+        return self.rings.get((sid, input_id))
+
+    def submit(
+        self, loop, sid, input_id, image_type, payload, size=None, timestamp_us=None
+    ):
+        """
+        Take a frame on the event loop, False for an unknown image_type.
+        size is (width, height) of a raw frame when not in its payload,
+        timestamp_us its capture time, its arrival when not given.
+        """
+        if image_type not in FRAME_FORMATS:
+            return False
+        if timestamp_us is None:
+            timestamp_us = now_us()
+        key = (sid, input_id)
+        ring = self.rings.get(key)
+        if ring is None:
+            ring = self.rings[key] = FrameRing()
+        seq = ring.next_seq()
+        self.counters["frames"] += 1
+
+        if image_type in RAW_CHANNELS:
+            self.counters["raw"] += 1
+            try:
+                if not store_raw(ring, seq, payload, image_type, size, timestamp_us):
+                    self.counters["stale"] += 1
+            except Exception as e:
+                self.counters["errors"] += 1
+                logger.info(f"Bad raw frame for {input_id}: {e}")
+            return True
+
+        if key in self.decoding:
+            if self.decoding[key] is not None:
+                self.counters["replaced"] += 1
+            self.decoding[key] = (seq, payload, timestamp_us)
+            return True
+        self.decoding[key] = None
+        self._decode(loop, key, ring, seq, payload, timestamp_us)
+        return True
+
+    def _decode(self, loop, key, ring, seq, payload, timestamp_us):
+        future = loop.run_in_executor(
+            self.executor, decode_into, ring, seq, payload, timestamp_us
+        )
+        future.add_done_callback(lambda f: self._decoded(loop, key, ring, f))
+
+    def _decoded(self, loop, key, ring, future):
+        if future.cancelled():
+            pass
+        elif future.exception() is not None:
+            self.counters["errors"] += 1
+            logger.info(f"Failed to decode frame for {key[1]}: {future.exception()}")
+        elif future.result():
+            self.counters["decoded"] += 1
+        else:
+            self.counters["stale"] += 1
+
+        if self.rings.get(key) is not ring:
+            # The session went away during the decode
+            return
+        waiting = self.decoding.pop(key, None)
+        if waiting is not None:
+            self.decoding[key] = None
+            self._decode(loop, key, ring, *waiting)
+
+    def capture_timestamp(self, sid):
+        """Capture time of the newest frame the session's prompts have read"""
+        timestamps = [
+            ring.read_timestamp
+            for key, ring in list(self.rings.items())
+            if key[0] == sid and ring.read_timestamp is not None
+        ]
+        return max(timestamps) if timestamps else None
+
+    def drop(self, sid):
+        for key in [key for key in self.rings if key[0] == sid]:
+            del self.rings[key]
+            self.decoding.pop(key, None)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "inputs": len(self.rings),
+            "decoding": len(self.decoding),
+        }
+
+
+def padded_output_id(output_id):
+    output_id = output_id[:OUTPUT_ID_LENGTH].ljust(OUTPUT_ID_LENGTH, "\x00")
+    return output_id.encode("ascii", "replace")
+
+
+def fit_image(image, max_size=None):
+    if max_size is None:
+        return image
+    if hasattr(Image, "Resampling"):
+        resampling = Image.Resampling.BILINEAR
+    else:
+        resampling = Image.ANTIALIAS
+    return ImageOps.contain(image, (max_size, max_size), resampling)
+
+
+def encode_preview(image, file_type, quality, max_size=None, output_id=""):
+    """v1 preview payload of a PIL image: ">I" image type, padded output_id, image"""
+    buffer = BytesIO()
+    buffer.write(struct.pack(">I", PREVIEW_TYPES.get(file_type, FRAME_JPEG)))
+    buffer.write(padded_output_id(output_id))
+    fit_image(image, max_size).save(
+        buffer, format=file_type, quality=quality, compress_level=1
+    )
+    return buffer.getvalue()
+
+
+def encode_preview_v2(
+    frame, file_type, quality, max_size, output_id, seq, timestamp_us=None
+):
+    """v2 preview frame of a (H, W, C) uint8 array, raw when file_type is RAW"""
+    flags = FLAG_CAPTURE_TIMESTAMP if timestamp_us is not None else 0
+    if timestamp_us is None:
+        timestamp_us = now_us()
+
+    if file_type == RAW_PREVIEW and max_size is None and frame.shape[2] in (3, 4):
+        height, width, channels = frame.shape
+        format = FRAME_RAW_RGBA if channels == 4 else FRAME_RAW_RGB
+        payload = np.ascontiguousarray(frame).data
+    else:
+        image = fit_image(Image.fromarray(frame), max_size)
+        if file_type == RAW_PREVIEW:
+            file_type = "PNG"
+        width, height = image.size
+        format = PREVIEW_TYPES.get(file_type, FRAME_JPEG)
+        buffer = BytesIO()
+        image.save(buffer, format=file_type, quality=quality, compress_level=1)
+        payload = buffer.getbuffer()
+
+    header = pack_v2_header(
+        EVENT_PREVIEW_IMAGE,
+        format,
+        seq,
+        timestamp_us,
+        width,
+        height,
+        output_id,
+        flags,
+    )
+    return header + payload
+
+
+class PreviewStream:
+    """Frames of one output in flight, sent in the order they were submitted"""
+
+    __slots__ = ("next_seq", "next_send", "ready")
+
+    def __init__(self):
+        self.next_seq = 0
+        self.next_send = 0
+        # seq -> (payload, version), payload None for a frame that failed
+        self.ready = {}
+
+
+class PreviewEncoder:
+    """
+    Encodes the preview images of the websocket image outputs on a thread
+    pool, so neither the event loop nor the executing prompt waits on them.
+    Frames of an output are encoded in parallel and handed to
+    publish(payload, sid, version) on the loop in order, at most
+    `max_in_flight` frames are queued before new ones are dropped. Sockets
+    that opted in to v2 in `protocols` get v2 frames, the others v1.
+    """
+
+    def __init__(self, publish, workers=2, max_in_flight=32, protocols=None):
+        self.publish = publish
+        self.protocols = protocols
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="cd-previews"
+        )
+        self.lock = threading.Lock()
+        self.streams = {}  # (sid, output_id) -> PreviewStream
+        self.in_flight = 0
+        self.counters = {
+            "frames": 0,
+            "encoded": 0,
+            "sent": 0,
+            "dropped": 0,
+            "errors": 0,
+            "bytes": 0,
+            "encode_ms_total": 0.0,
+            "encode_ms_max": 0.0,
+            "latency_ms_total": 0.0,
+            "latency_ms_max": 0.0,
+        }
+
+    def submit(
+        self,
+        loop,
+        frames,
+        file_type,
+        quality,
+        sid,
+        output_id,
+        max_size=None,
+        timestamp_us=None,
+    ):
+        """
+        Queue a (B, H, W, C) uint8 batch, returns the number of frames taken.
+        The batch must not be written to afterwards, frames are views of it.
+        timestamp_us is the capture time of the input the frames were made
+        from, sent back in v2 frames.
+        """
+        taken = 0
+        key = (sid, output_id)
+        version = PROTOCOL_V1
+        if self.protocols is not None and sid is not None:
+            version = self.protocols.version(sid)
+        for frame in frames:
+            with self.lock:
+                self.counters["frames"] += 1
+                if self.in_flight >= self.max_in_flight:
+                    self.counters["dropped"] += 1
+                    continue
+                self.in_flight += 1
+                stream = self.streams.get(key)
+                if stream is None:
+                    stream = self.streams[key] = PreviewStream()
+                seq = stream.next_seq
+                stream.next_seq += 1
+            wire_seq = None
+            if version == PROTOCOL_V2:
+                wire_seq = self.protocols.next_seq(sid, output_id)
+            self.executor.submit(
+                self._encode,
+                loop,
+                key,
+                seq,
+                frame,
+                (file_type, quality, max_size),
+                (version, wire_seq, timestamp_us),
+                time.perf_counter(),
+            )
+            taken += 1
+        return taken
+
+    def _encode(self, loop, key, seq, frame, encoding, framing, queued_at):
+        file_type, quality, max_size = encoding
+        version, wire_seq, timestamp_us = framing
+        started = time.perf_counter()
+        try:
+            if version == PROTOCOL_V2:
+                payload = encode_preview_v2(
+                    frame, file_type, quality, max_size, key[1], wire_seq, timestamp_us
+                )
+            else:
+                if file_type == RAW_PREVIEW:
+                    file_type = "PNG"
+                payload = encode_preview(
+                    Image.fromarray(frame), file_type, quality, max_size, key[1]
+                )
+        except Exception as e:
+            logger.info(f"Failed to encode preview for {key[1]}: {e}")
+            payload = None
+        encode_ms = (time.perf_counter() - started) * 1000
+
+        with self.lock:
+            stream = self.streams[key]
+            stream.ready[seq] = (payload, version)
+            # Scheduled under the lock, so the loop sends them in order
+            while stream.next_send in stream.ready:
+                ready, ready_version = stream.ready.pop(stream.next_send)
+                stream.next_send += 1
+                if ready is not None:
+                    loop.call_soon_threadsafe(
+                        self._send, key[0], ready, ready_version
+                    )
+            if stream.next_send == stream.next_seq:
+                del self.streams[key]
+
+            if payload is None:
+                # Never reaches _send
+                self.in_flight -= 1
+                self.counters["errors"] += 1
+            else:
+                self.counters["encoded"] += 1
+                latency_ms = (time.perf_counter() - queued_at) * 1000
+                self.counters["bytes"] += len(payload)
+                self.counters["encode_ms_total"] += encode_ms
+                self.counters["encode_ms_max"] = max(
+                    self.counters["encode_ms_max"], encode_ms
+                )
+                self.counters["latency_ms_total"] += latency_ms
+                self.counters["latency_ms_max"] = max(
+                    self.counters["latency_ms_max"], latency_ms
+                )
+
+    def _send(self, sid, payload, version):
+        with self.lock:
+            self.in_flight -= 1
+        try:
+            self.publish(payload, sid, version)
+            self.counters["sent"] += 1
+        except Exception as e:
+            logger.info(f"Failed to send preview to {sid}: {e}")
+
+    def stats(self):
+        with self.lock:
+            done = max(self.counters["encoded"], 1)
+            return {
+                **self.counters,
+                "in_flight": self.in_flight,
+                "encode_ms_avg": self.counters["encode_ms_total"] / done,
+                "latency_ms_avg": self.counters["latency_ms_total"] / done,
+            }
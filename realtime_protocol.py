@@ -0,0 +1,375 @@
+import struct
+import threading
+import time
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+# v1 binary frames:
+#   in:  "<I" event 0, "<I" image_type, 24 bytes input_id, image
+#   out: ">I" event 1, ">I" image_type, 24 bytes output_id, image
+# v2 frames start with a version byte, which v1 input (event 0) never has,
+# and carry everything in one big-endian header before the payload:
+#   B version, B event, B format, B flags, I seq, Q timestamp_us,
+#   I width, I height, 24s id
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+V2_HEADER = struct.Struct(">BBBBIQII24s")
+
+EVENT_IMAGE_INPUT = 0
+EVENT_PREVIEW_IMAGE = 1
+
+# timestamp_us of an output is the capture time of the input frame it was
+# made from, as sent by the client, so the client can measure the latency
+FLAG_CAPTURE_TIMESTAMP = 1
+
+ID_LENGTH = 24
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+class FrameHeader:
+    __slots__ = (
+        "version",
+        "event",
+        "format",
+        "flags",
+        "seq",
+        "timestamp_us",
+        "width",
+        "height",
+        "id",
+    )
+
+    def __init__(
+        self, version, event, format, flags, seq, timestamp_us, width, height, id
+    ):
+        self.version = version
+        self.event = event
+        self.format = format
+        self.flags = flags
+        self.seq = seq
+        self.timestamp_us = timestamp_us
+        self.width = width
+        self.height = height
+        self.id = id
+
+
+def pack_id(id):
+    return (id or "")[:ID_LENGTH].encode("ascii", "replace").ljust(ID_LENGTH, b"\x00")
+
+
+def pack_v2_header(
+    event, format, seq, timestamp_us, width, height, id, flags=0
+) -> bytes:
+    return V2_HEADER.pack(
+        PROTOCOL_V2,
+        event,
+        format,
+        flags,
+        seq & 0xFFFFFFFF,
+        timestamp_us,
+        width,
+        height,
+        pack_id(id),
+    )
+
+
+def is_v2(message):
+    return len(message) >= V2_HEADER.size and message[0] == PROTOCOL_V2
+
+
+def parse_v2(message):
+    """(FrameHeader, payload) of a v2 frame, the payload a view of the message"""
+    fields = V2_HEADER.unpack_from(message)
+    header = FrameHeader(*fields[:-1], fields[-1].rstrip(b"\x00").decode("ascii"))
+    return header, memoryview(message)[V2_HEADER.size :]
+
+
+def parse_v1_input(message):
+    """(event, image_type, input_id, payload) of a v1 input frame"""
+    event, image_type = struct.unpack_from("<II", message)
+    input_id = bytes(message[8:32]).decode("ascii").strip()
+    return event, image_type, input_id, memoryview(message)[32:]
+
+
+def parse_input_frame(message):
+    """
+    (event, image_type, input_id, payload, size, timestamp_us) of a binary
+    frame from a client, size and timestamp_us are None for v1
+    """
+    if is_v2(message):
+        header, payload = parse_v2(message)
+        size = (header.width, header.height)
+        timestamp_us = header.timestamp_us
+        return header.event, header.format, header.id, payload, size, timestamp_us
+    event, image_type, input_id, payload = parse_v1_input(message)
+    return event, image_type, input_id, payload, None, None
+
+
+class SocketProtocols:
+    """
+    The binary protocol each socket opted in to, v1 unless it asked for v2,
+    and the sequence numbers of the v2 frames sent to it
+    """
+
+    def __init__(self):
+        # Sequences are taken on the execution thread, sockets come and go
+        # on the loop
+        self.lock = threading.Lock()
+        self.versions = {}  # sid -> version
+        self.sequences = {}  # (sid, id) -> last seq sent
+
+    def set(self, sid, version):
+        if version not in (PROTOCOL_V1, PROTOCOL_V2):
+            raise ValueError(f"Unsupported binary protocol version {version}")
+        with self.lock:
+            if version == PROTOCOL_V1:
+                self.versions.pop(sid, None)
+            else:
+                self.versions[sid] = version
+
+    def version(self, sid):
+        return self.versions.get(sid, PROTOCOL_V1)
+
+    def next_seq(self, sid, id):
+        with self.lock:
+            seq = self.sequences.get((sid, id), 0) + 1
+            self.sequences[(sid, id)] = seq
+            return seq
+
+    def drop(self, sid):
+        with self.lock:
+            self.versions.pop(sid, None)
+            for key in [key for key in self.sequences if key[0] == sid]:
+                del self.sequences[key]
+
+    def stats(self):
+        return {"v2_sockets": len(self.versions)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    from io import BytesIO
+
+    import numpy as np
+    from PIL import Image
+
+    import realtime_media
+    from globals import (
+        publish_preview,
+        realtime_frames,
+        socket_fanout,
+        socket_protocols,
+        sockets,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Loopback the realtime binary protocol: frames in through "
+        "the websocket parsing and the ingest rings, back out through the "
+        "preview encoder and the socket fanout"
+    )
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument(
+        "--format", choices=["RAW", "JPEG", "PNG", "WEBP"], default="RAW"
+    )
+    parser.add_argument("--protocol", type=int, choices=[1, 2], default=2)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument(
+        "--url",
+        help="Instead of the loopback, a /comfyui-deploy/ws URL of a realtime "
+        "session to send the frames to and time its previews",
+    )
+    parser.add_argument("--input-id", default="input_id")
+    args = parser.parse_args()
+
+    image_types = {
+        "RAW": realtime_media.FRAME_RAW_RGB,
+        "JPEG": realtime_media.FRAME_JPEG,
+        "PNG": realtime_media.FRAME_PNG,
+        "WEBP": realtime_media.FRAME_WEBP,
+    }
+    image_type = image_types[args.format]
+
+    def make_frame(index):
+        frame = np.random.randint(
+            0, 256, (args.height, args.width, 3), dtype=np.uint8
+        )
+        frame[0, 0] = index % 256
+        return frame
+
+    def input_message(index, frame):
+        if args.format == "RAW":
+            image = frame.tobytes()
+        else:
+            buffer = BytesIO()
+            Image.fromarray(frame).save(buffer, format=args.format, quality=90)
+            image = buffer.getvalue()
+        if args.protocol == PROTOCOL_V1:
+            if args.format == "RAW":
+                image = realtime_media.RAW_SIZE.pack(args.width, args.height) + image
+            return (
+                struct.pack("<II", EVENT_IMAGE_INPUT, image_type)
+                + pack_id(args.input_id)
+                + image
+            )
+        header = pack_v2_header(
+            EVENT_IMAGE_INPUT,
+            image_type,
+            index,
+            now_us(),
+            args.width,
+            args.height,
+            args.input_id,
+        )
+        return header + image
+
+    def parse_output(message):
+        """(seq, capture timestamp, pixels) of a preview frame"""
+        if is_v2(message):
+            header, payload = parse_v2(message)
+            if header.format in realtime_media.RAW_CHANNELS:
+                channels = realtime_media.RAW_CHANNELS[header.format]
+                pixels = np.frombuffer(payload, dtype=np.uint8).reshape(
+                    header.height, header.width, channels
+                )
+            else:
+                pixels = np.asarray(Image.open(BytesIO(payload)))
+            timestamp = header.timestamp_us
+            if not header.flags & FLAG_CAPTURE_TIMESTAMP:
+                timestamp = None
+            return header.seq, timestamp, pixels
+        # v1: ">I" event, ">I" image type, 24 bytes output_id, image
+        pixels = np.asarray(Image.open(BytesIO(message[32:])))
+        return None, None, pixels
+
+    def report(latencies, mismatches, received):
+        latencies.sort()
+        print(f"frames received  {received}/{args.frames}")
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f"latency p50 ms   {p50:.3f}")
+            print(f"latency p99 ms   {p99:.3f}")
+        if mismatches is not None:
+            print(f"pixel mismatches {mismatches}")
+
+    async def loopback():
+        loop = asyncio.get_running_loop()
+        sid = "loopback"
+        received = []
+        done = asyncio.Event()
+
+        class LoopbackSocket:
+            """Stands in for the client's websocket, the fanout writes to it"""
+
+            closed = False
+
+            async def send_bytes(self, payload):
+                received.append((now_us(), payload))
+                if len(received) == args.frames:
+                    done.set()
+
+        # Registered as websocket_handler does, previews go out through
+        # publish_preview and the socket's fanout queue
+        ws = LoopbackSocket()
+        sockets[sid] = ws
+        socket_fanout.attach(sid, ws)
+        socket_protocols.set(sid, args.protocol)
+        encoder = realtime_media.PreviewEncoder(
+            publish_preview, max_in_flight=args.frames, protocols=socket_protocols
+        )
+        sent = {}
+        frames = [make_frame(index) for index in range(args.frames)]
+        for index, frame in enumerate(frames):
+            event, format, input_id, payload, size, timestamp_us = parse_input_frame(
+                input_message(index, frame)
+            )
+            assert event == EVENT_IMAGE_INPUT
+            realtime_frames.submit(
+                loop,
+                sid,
+                input_id,
+                format,
+                payload,
+                size=size,
+                timestamp_us=timestamp_us,
+            )
+            # Wait for the decode, as a prompt would read the ring afterwards
+            ring = realtime_frames.ring(sid, input_id)
+            while ring.seq < ring.issued and not realtime_frames.counters["errors"]:
+                await asyncio.sleep(0)
+            with ring.read() as (latest, _):
+                batch = latest[None].copy()
+            sent[index] = frame
+            encoder.submit(
+                loop,
+                batch,
+                "RAW" if args.format == "RAW" else "PNG",
+                90,
+                sid,
+                "output_id",
+                timestamp_us=realtime_frames.capture_timestamp(sid),
+            )
+            await asyncio.sleep(1 / args.fps)
+
+        try:
+            await asyncio.wait_for(done.wait(), 30)
+        except asyncio.TimeoutError:
+            pass
+
+        latencies = []
+        # Only frames sent losslessly can be compared pixel for pixel
+        lossless = args.format in ("RAW", "PNG")
+        mismatches = 0 if lossless else None
+        for index, (arrived_us, message) in enumerate(received):
+            seq, timestamp, pixels = parse_output(message)
+            if seq is not None and seq != index + 1:
+                print(f"out of order: frame {index} has seq {seq}")
+            if timestamp is not None:
+                latencies.append((arrived_us - timestamp) / 1000)
+            if lossless and not np.array_equal(pixels[:, :, :3], sent[index]):
+                mismatches += 1
+        report(latencies, mismatches, len(received))
+        print(f"ingest           {realtime_frames.stats()}")
+        print(f"encoder          {encoder.stats()}")
+        print(f"fanout           {socket_fanout.stats()}")
+
+        sockets.pop(sid, None)
+        socket_fanout.detach(sid, ws)
+        socket_protocols.drop(sid)
+        realtime_frames.drop(sid)
+
+    async def remote():
+        import aiohttp
+
+        separator = "&" if "?" in args.url else "?"
+        url = f"{args.url}{separator}protocol={args.protocol}"
+        latencies = []
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url) as ws:
+
+                async def receive():
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.BINARY:
+                            continue
+                        _, timestamp, _ = parse_output(msg.data)
+                        if timestamp is not None:
+                            latencies.append((now_us() - timestamp) / 1000)
+
+                receiver = asyncio.create_task(receive())
+                frames = [make_frame(index) for index in range(args.frames)]
+                for index, frame in enumerate(frames):
+                    await ws.send_bytes(input_message(index, frame))
+                    await ws.send_json({"event": "queue_prompt"})
+                    await asyncio.sleep(1 / args.fps)
+                await asyncio.sleep(5)
+                receiver.cancel()
+        report(latencies, None, len(latencies))
+
+    asyncio.run(remote() if args.url else loopback())
@@ -0,0 +1,155 @@
+import time
+from collections import deque
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+
+class RealtimeSession:
+    __slots__ = ("sid", "pending", "running", "ready", "dispatched", "dropped")
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.pending = None  # entry of the newest frame not queued yet
+        self.running = None  # prompt_id queued or executing
+        self.ready = False  # in the round robin
+        self.dispatched = 0
+        self.dropped = 0
+
+
+class RealtimeScheduler:
+    """
+    Queues the prompts of realtime sessions. A session has at most one prompt
+    in the prompt queue or executing, and one pending behind it which a newer
+    frame replaces (counted as dropped). Sessions with a pending prompt take
+    turns, at most `max_running` realtime prompts are queued at once.
+
+    A prompt deleted from the prompt queue never sends an end event, lost()
+    finds the running prompts is_queued(prompt_id) no longer knows of.
+    """
+
+    def __init__(self, dispatch, max_running=2, is_queued=None, check_after=5.0):
+        # dispatch(sid, entry) puts a validated prompt in the prompt queue
+        self.dispatch = dispatch
+        self.max_running = max_running
+        # is_queued(prompt_id) -> True while queued or executing
+        self.is_queued = is_queued
+        self.check_after = check_after
+        self.sessions = {}  # sid -> RealtimeSession
+        self.running = {}  # prompt_id -> sid
+        self.checked_at = {}  # prompt_id -> last time it was known queued
+        self.ready = deque()  # sessions with a pending prompt, in turn order
+        self.counters = {
+            "offered": 0,
+            "dispatched": 0,
+            "dropped": 0,
+            "finished": 0,
+            "lost": 0,
+            "errors": 0,
+        }
+
+    def offer(self, sid, entry):
+        """Queue the prompt of a session's newest frame, replacing its pending one"""
+        self.counters["offered"] += 1
+        session = self.sessions.get(sid)
+        if session is None:
+            session = self.sessions[sid] = RealtimeSession(sid)
+
+        if session.pending is not None:
+            session.dropped += 1
+            self.counters["dropped"] += 1
+        session.pending = entry
+
+        if session.running is None and not session.ready:
+            session.ready = True
+            self.ready.append(session)
+        self.pump()
+
+    def pump(self):
+        while self.ready and len(self.running) < self.max_running:
+            session = self.ready.popleft()
+            session.ready = False
+            if self.sessions.get(session.sid) is not session:
+                # Dropped while it waited for its turn
+                continue
+            entry, session.pending = session.pending, None
+
+            prompt_id = entry[0]
+            try:
+                self.dispatch(session.sid, entry)
+            except Exception as e:
+                self.counters["errors"] += 1
+                logger.error(f"Failed to queue realtime prompt {prompt_id}: {e}")
+                continue
+            session.running = prompt_id
+            session.dispatched += 1
+            self.running[prompt_id] = session.sid
+            self.checked_at[prompt_id] = time.monotonic()
+            self.counters["dispatched"] += 1
+
+    def finish(self, prompt_id):
+        """
+        The prompt ended, its session's pending prompt gets a turn. Returns
+        the session's sid, None for a prompt that isn't a running one.
+        """
+        sid = self.running.pop(prompt_id, None)
+        if sid is None:
+            return None
+        self.checked_at.pop(prompt_id, None)
+        self.counters["finished"] += 1
+        session = self.sessions.get(sid)
+        if session is not None and session.running == prompt_id:
+            session.running = None
+            if session.pending is not None and not session.ready:
+                session.ready = True
+                self.ready.append(session)
+        self.pump()
+        return sid
+
+    def lost(self):
+        """
+        Running prompts no longer in the prompt queue, to be finished. Only
+        the ones not seen in the queue for `check_after` seconds are looked up.
+        """
+        if self.is_queued is None:
+            return []
+        now = time.monotonic()
+        lost = []
+        for prompt_id, checked_at in self.checked_at.items():
+            if now - checked_at < self.check_after:
+                continue
+            if self.is_queued(prompt_id):
+                self.checked_at[prompt_id] = now
+                continue
+            logger.warning(f"Realtime prompt {prompt_id} left the queue without ending")
+            self.counters["lost"] += 1
+            lost.append(prompt_id)
+        return lost
+
+    def is_running(self, prompt_id):
+        return prompt_id in self.running
+
+    def drop(self, sid):
+        """The session closed, forget its pending prompt"""
+        session = self.sessions.pop(sid, None)
+        if session is not None and session.pending is not None:
+            session.dropped += 1
+            self.counters["dropped"] += 1
+        # A running prompt still ends and frees its place through finish
+
+    def stats(self):
+        return {
+            **self.counters,
+            "max_running": self.max_running,
+            "running": len(self.running),
+            "ready": len(self.ready),
+            "sessions": {
+                sid: {
+                    "dispatched": session.dispatched,
+                    "dropped": session.dropped,
+                    "pending": session.pending is not None,
+                    "running": session.running,
+                }
+                for sid, session in self.sessions.items()
+            },
+        }
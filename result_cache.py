@@ -0,0 +1,166 @@
+import hashlib
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+from workflow_compiler import workflow_hash, written_fields_hash
+
+logger = getLogger("comfy-deploy")
+
+
+def result_key(workflow_api, token=None, compiled=None):
+    """
+    Cache key of a run, its workflow after inputs and seeds, per token. Pass
+    the compiled workflow it was made from to hash only what the run wrote.
+    """
+    scope = hashlib.sha256((token or "").encode()).hexdigest()[:16]
+    if compiled is not None:
+        written = written_fields_hash(compiled, workflow_api, compiled.masked_fields)
+        return f"{scope}:{written}"
+    return f"{scope}:{workflow_hash(workflow_api)}"
+
+
+class CachedResult:
+    """What a finished run reported, replayed for runs with the same key"""
+
+    __slots__ = ("prompt_id", "reports", "events", "stored_at")
+
+    def __init__(self, prompt_id, reports, events):
+        self.prompt_id = prompt_id
+        # Status endpoint bodies carrying output_data, in the order sent
+        self.reports = reports
+        # SSE events of the outputs
+        self.events = events
+        self.stored_at = time.monotonic()
+
+
+class Recording:
+    __slots__ = ("key", "reports", "events", "followers", "started_at")
+
+    def __init__(self, key):
+        self.key = key
+        self.reports = []
+        self.events = []
+        # (prompt_id, resubmit) of identical runs waiting for this one
+        self.followers = []
+        self.started_at = time.monotonic()
+
+
+class ResultCache:
+    """
+    Output manifests of finished runs by result_key, evicted after `max_age`
+    seconds or when more than `max_entries` are kept. While a run with a key
+    is in flight, identical runs attach to it instead of running again.
+    """
+
+    def __init__(self, max_entries=256, max_age=3600, on_orphaned=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # on_orphaned(followers) runs the followers of an expired recording
+        self.on_orphaned = on_orphaned
+        self.entries = OrderedDict()  # key -> CachedResult
+        self.recordings = {}  # prompt_id -> Recording
+        self.in_flight = {}  # key -> prompt_id
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "attached": 0,
+            "stored": 0,
+            "abandoned": 0,
+            "expired": 0,
+        }
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry.stored_at > self.max_age:
+            del self.entries[key]
+            self.counters["expired"] += 1
+            entry = None
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return entry
+
+    def begin(self, key, prompt_id, resubmit):
+        """
+        Start recording the run of `prompt_id`, or attach it to the identical
+        run in flight. Returns that run's prompt_id when attached, else None.
+        resubmit() runs it after all if the run it is attached to fails.
+        """
+        leader = self.in_flight.get(key)
+        inherited = []
+        if leader is not None and leader != prompt_id:
+            recording = self.recordings[leader]
+            if time.monotonic() - recording.started_at <= self.max_age:
+                recording.followers.append((prompt_id, resubmit))
+                self.counters["attached"] += 1
+                return leader
+            # Never reported an end, this run takes over its followers
+            inherited = self._end(leader).followers
+
+        self._expire_recordings()
+        self.counters["misses"] += 1
+        self.in_flight[key] = prompt_id
+        recording = Recording(key)
+        recording.followers.extend(inherited)
+        self.recordings[prompt_id] = recording
+        return None
+
+    def record_report(self, prompt_id, body):
+        recording = self.recordings.get(prompt_id)
+        if recording is not None:
+            recording.reports.append({k: v for k, v in body.items() if k != "run_id"})
+
+    def record_event(self, prompt_id, event):
+        recording = self.recordings.get(prompt_id)
+        if recording is not None:
+            recording.events.append(event)
+
+    def complete(self, prompt_id):
+        """Store what the run reported, returns (entry, followers)"""
+        recording = self._end(prompt_id)
+        if recording is None:
+            return None, []
+        entry = CachedResult(prompt_id, recording.reports, recording.events)
+        self.entries[recording.key] = entry
+        self.entries.move_to_end(recording.key)
+        self.counters["stored"] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry, recording.followers
+
+    def abandon(self, prompt_id):
+        """The run failed, returns its followers to be run themselves"""
+        recording = self._end(prompt_id)
+        if recording is None:
+            return []
+        self.counters["abandoned"] += 1
+        return recording.followers
+
+    def _end(self, prompt_id):
+        recording = self.recordings.pop(prompt_id, None)
+        if recording is not None and self.in_flight.get(recording.key) == prompt_id:
+            del self.in_flight[recording.key]
+        return recording
+
+    def _expire_recordings(self):
+        # A run that never reported an end would otherwise hold its key forever
+        now = time.monotonic()
+        orphaned = []
+        for prompt_id, recording in list(self.recordings.items()):
+            if now - recording.started_at > self.max_age:
+                for follower_id, _ in recording.followers:
+                    logger.warning(
+                        f"Result cache: {follower_id} was attached to {prompt_id}, which never finished, running it on its own"
+                    )
+                orphaned.extend(self._end(prompt_id).followers)
+        if orphaned and self.on_orphaned is not None:
+            self.on_orphaned(orphaned)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "entries": len(self.entries),
+            "in_flight": len(self.in_flight),
+        }
@@ -0,0 +1,372 @@
+import asyncio
+import json
+import time
+from collections import deque
+from logging import getLogger
+
+from run_reporting import TERMINAL_STATUSES
+
+logger = getLogger("comfy-deploy")
+
+
+def is_terminal_event(event: dict) -> bool:
+    if event.get("event") != "status":
+        return False
+    data = event.get("data") or {}
+    return data.get("status") in TERMINAL_STATUSES
+
+
+class EventStream:
+    """Replay ring and subscribers of a single prompt"""
+
+    def __init__(self, prompt_id, replay_size):
+        self.prompt_id = prompt_id
+        # (event_id, prompt_id, event, encoded) records, oldest first
+        self.ring = deque(maxlen=replay_size)
+        self.subscribers = set()
+        self.finished = False
+        # When the stream was last finished or left without subscribers
+        self.idle_since = time.monotonic()
+
+
+class EventSubscription:
+    """
+    One SSE connection, reading the events of one or more prompts in event id
+    order. A subscriber that falls `max_buffered` events behind is resynced
+    from the replay rings instead of growing without bound.
+    """
+
+    def __init__(self, hub, prompt_ids, last_event_id, max_buffered):
+        self.hub = hub
+        self.prompt_ids = list(prompt_ids)
+        self.last_event_id = last_event_id
+        self.max_buffered = max_buffered
+        self.buffer = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+        # Prompts whose terminal status was not delivered yet
+        self.pending = set(self.prompt_ids)
+
+    @property
+    def done(self):
+        return not self.pending and not self.buffer
+
+    def push(self, record):
+        if self.overflowed:
+            return
+        if len(self.buffer) >= self.max_buffered:
+            # Drop what is buffered, next() replays it from the rings
+            self.overflowed = True
+            self.buffer.clear()
+        else:
+            self.buffer.append(record)
+        self.ready.set()
+
+    async def next(self, timeout):
+        """The next (event_id, prompt_id, event, encoded) record, or None on timeout"""
+        if self.overflowed:
+            self.overflowed = False
+            self.buffer.extend(self.hub.replay(self.prompt_ids, self.last_event_id))
+
+        while not self.buffer:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            if self.overflowed:
+                self.overflowed = False
+                self.buffer.extend(
+                    self.hub.replay(self.prompt_ids, self.last_event_id)
+                )
+
+        record = self.buffer.popleft()
+        self.last_event_id = record[0]
+        if is_terminal_event(record[2]):
+            self.pending.discard(record[1])
+        return record
+
+
+class RunEventHub:
+    """
+    Per-prompt event streams for /comfyui-deploy/run/streaming.
+
+    Events get ids from a single monotonically increasing counter, so one
+    `Last-Event-ID` is enough to resume a connection following several
+    prompts. Each prompt keeps its last `replay_size` events, and streams are
+    kept for `retention` seconds after they finish or lose their last
+    subscriber so a reconnecting client can still resume. A prompt that
+    finished after its stream expired gets its terminal status back from
+    status_lookup(prompt_id).
+    """
+
+    def __init__(
+        self, replay_size=512, max_buffered=1024, retention=120, status_lookup=None
+    ):
+        self.replay_size = replay_size
+        self.max_buffered = max_buffered
+        self.retention = retention
+        # status_lookup(prompt_id) -> the run's status, None if unknown
+        self.status_lookup = status_lookup
+        self.streams = {}  # prompt_id -> EventStream
+        self.last_event_id = 0
+        self.counters = {
+            "events_published": 0,
+            "events_replayed": 0,
+            "subscriber_overflows": 0,
+            "streams_expired": 0,
+        }
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.streams
+
+    def open(self, prompt_id):
+        """Start recording the events of a prompt"""
+        self._expire()
+        stream = self.streams.get(prompt_id)
+        if stream is None:
+            stream = EventStream(prompt_id, self.replay_size)
+            self.streams[prompt_id] = stream
+        return stream
+
+    def publish(self, prompt_id, event):
+        stream = self.streams.get(prompt_id)
+        if stream is None:
+            return
+
+        self.last_event_id += 1
+        # Encoded once, however many connections follow this prompt
+        record = (self.last_event_id, prompt_id, event, json.dumps(event))
+        stream.ring.append(record)
+        self.counters["events_published"] += 1
+
+        if is_terminal_event(event):
+            stream.finished = True
+            stream.idle_since = time.monotonic()
+
+        for subscription in stream.subscribers:
+            was_overflowed = subscription.overflowed
+            subscription.push(record)
+            if subscription.overflowed and not was_overflowed:
+                self.counters["subscriber_overflows"] += 1
+
+    def replay(self, prompt_ids, after_event_id):
+        records = [
+            record
+            for prompt_id in prompt_ids
+            if prompt_id in self.streams
+            for record in self.streams[prompt_id].ring
+            if record[0] > after_event_id
+        ]
+        records.sort(key=lambda record: record[0])
+        self.counters["events_replayed"] += len(records)
+        return records
+
+    def subscribe(self, prompt_ids, last_event_id=0) -> EventSubscription:
+        subscription = EventSubscription(
+            self, prompt_ids, last_event_id, self.max_buffered
+        )
+        subscription.buffer.extend(self.replay(prompt_ids, last_event_id))
+
+        replayed = {record[1] for record in subscription.buffer}
+        for prompt_id in prompt_ids:
+            known = prompt_id in self.streams
+            stream = self.open(prompt_id)
+            stream.subscribers.add(subscription)
+            # Already finished and the client has seen everything
+            if stream.finished and prompt_id not in replayed:
+                subscription.pending.discard(prompt_id)
+            elif not known and self.status_lookup is not None:
+                # Its stream expired, nothing would ever end this one
+                status = self.status_lookup(prompt_id)
+                if status in TERMINAL_STATUSES:
+                    self.publish(
+                        prompt_id,
+                        {
+                            "event": "status",
+                            "data": {"prompt_id": prompt_id, "status": status},
+                        },
+                    )
+
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription):
+        for prompt_id in subscription.prompt_ids:
+            stream = self.streams.get(prompt_id)
+            if stream is None:
+                continue
+            stream.subscribers.discard(subscription)
+            if not stream.subscribers:
+                stream.idle_since = time.monotonic()
+
+    def _expire(self):
+        now = time.monotonic()
+        for prompt_id, stream in list(self.streams.items()):
+            if not stream.subscribers and now - stream.idle_since > self.retention:
+                del self.streams[prompt_id]
+                self.counters["streams_expired"] += 1
+
+    def stats(self):
+        return {
+            **self.counters,
+            "last_event_id": self.last_event_id,
+            "streams": len(self.streams),
+            "subscribers": sum(len(s.subscribers) for s in self.streams.values()),
+        }
+
+
+# Events ending a prompt, the throttle state of the prompt is dropped after them
+PROMPT_END_EVENTS = ("execution_success", "execution_error", "execution_interrupted")
+
+
+def parse_throttle_intervals(spec, defaults):
+    """
+    Parse "progress:ws=0.1,progress:status=1,progress_state:*=0.5" into
+    {(event, destination): seconds}. "off" disables throttling altogether.
+    """
+    if spec is None:
+        return dict(defaults)
+    if spec.strip().lower() in ("off", "0", "false"):
+        return {}
+
+    intervals = {}
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        try:
+            key, seconds = part.split("=")
+            event, destination = key.split(":")
+            intervals[(event.strip(), destination.strip())] = float(seconds)
+        except ValueError:
+            logger.warning(f"Ignoring invalid throttle rule: {part}")
+    return intervals
+
+
+class EventThrottle:
+    """
+    Rate limits high frequency events, per event type and per destination.
+
+    Within an interval only the latest value per prompt and node is kept and
+    sent when the interval ends. A value is sent right away when it moves by
+    at least `min_delta` (as a fraction of its max) or completes a node.
+    Events without a rule are never delayed, and flush whatever is pending
+    for their prompt first so ordering is kept.
+    """
+
+    def __init__(self, intervals, min_delta=0.1):
+        self.intervals = intervals  # (event, destination) -> seconds
+        self.min_delta = min_delta
+        # (destination, prompt_id) -> {(event, node): (data, emit)}
+        self.pending = {}
+        self.flush_handles = {}
+        # (destination, event, prompt_id, node) -> (last emit time, last fraction)
+        self.last_emitted = {}
+        self.counters = {}
+
+    def interval(self, event, destination):
+        interval = self.intervals.get((event, destination))
+        if interval is None:
+            interval = self.intervals.get((event, "*"))
+        return interval or 0
+
+    def _count(self, destination, name):
+        counters = self.counters.setdefault(
+            destination, {"received": 0, "emitted": 0, "suppressed": 0}
+        )
+        counters[name] += 1
+
+    def submit(self, destination, event, data, emit):
+        """Call emit(event, data) now, later with the latest value, or not at all"""
+        self._count(destination, "received")
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        interval = self.interval(event, destination)
+
+        if interval <= 0 or prompt_id is None:
+            self.flush(destination, prompt_id)
+            self._emit(destination, event, data, emit)
+            if event in PROMPT_END_EVENTS or (
+                event == "executing" and data.get("node") is None
+            ):
+                self.forget(prompt_id, destination)
+            return
+
+        node = data.get("node")
+        key = (destination, event, prompt_id, node)
+        now = time.monotonic()
+        fraction = self._fraction(data)
+        last = self.last_emitted.get(key)
+
+        if (
+            last is None
+            or now - last[0] >= interval
+            or (fraction is not None and fraction >= 1)
+            or (
+                fraction is not None
+                and last[1] is not None
+                and abs(fraction - last[1]) >= self.min_delta
+            )
+        ):
+            pending = self.pending.get((destination, prompt_id))
+            if pending is not None:
+                pending.pop((event, node), None)
+            self.last_emitted[key] = (now, fraction)
+            self._emit(destination, event, data, emit)
+            return
+
+        # Last value wins until the interval is over
+        self._count(destination, "suppressed")
+        pending = self.pending.setdefault((destination, prompt_id), {})
+        pending.pop((event, node), None)
+        pending[(event, node)] = (data, emit)
+        if (destination, prompt_id) not in self.flush_handles:
+            delay = max(0, interval - (now - last[0]))
+            loop = asyncio.get_running_loop()
+            self.flush_handles[(destination, prompt_id)] = loop.call_later(
+                delay, self.flush, destination, prompt_id
+            )
+
+    def flush(self, destination, prompt_id):
+        handle = self.flush_handles.pop((destination, prompt_id), None)
+        if handle is not None:
+            handle.cancel()
+        pending = self.pending.pop((destination, prompt_id), None)
+        if not pending:
+            return
+        now = time.monotonic()
+        for (event, node), (data, emit) in pending.items():
+            self.last_emitted[(destination, event, prompt_id, node)] = (
+                now,
+                self._fraction(data),
+            )
+            self._emit(destination, event, data, emit)
+
+    def forget(self, prompt_id, destination):
+        self.flush(destination, prompt_id)
+        stale = [
+            key
+            for key in self.last_emitted
+            if key[0] == destination and key[2] == prompt_id
+        ]
+        for key in stale:
+            del self.last_emitted[key]
+
+    def _emit(self, destination, event, data, emit):
+        self._count(destination, "emitted")
+        try:
+            emit(event, data)
+        except Exception as e:
+            logger.error(f"Failed to emit {event} to {destination}: {e}")
+
+    @staticmethod
+    def _fraction(data):
+        value, max_value = data.get("value"), data.get("max")
+        if isinstance(value, (int, float)) and isinstance(max_value, (int, float)):
+            return value / max_value if max_value else None
+        return None
+
+    def stats(self):
+        return {
+            "intervals": {f"{e}:{d}": s for (e, d), s in self.intervals.items()},
+            "destinations": self.counters,
+            "pending": sum(len(p) for p in self.pending.values()),
+        }
@@ -0,0 +1,403 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+TERMINAL_STATUSES = ("success", "failed", "cancelled")
+
+
+def is_terminal_report(body: dict) -> bool:
+    return body.get("status") in TERMINAL_STATUSES
+
+
+def coalesce_key(body: dict):
+    """Reports sharing a key supersede each other, only the latest one is sent"""
+    if "live_status" in body:
+        return ("live_status",)
+
+    ws_event = body.get("ws_event")
+    if isinstance(ws_event, dict):
+        event = ws_event.get("event")
+        data = ws_event.get("data") or {}
+        if event == "progress":
+            return ("progress", data.get("node"))
+        if event == "progress_state":
+            return ("progress_state",)
+
+    return None
+
+
+class PendingReports:
+    def __init__(self, prompt_id, status_endpoint, token):
+        self.prompt_id = prompt_id
+        self.status_endpoint = status_endpoint
+        self.token = token
+        self.entries = []  # list of (coalesce_key, body) in arrival order
+        self.flush_handle = None
+        self.lock = asyncio.Lock()
+
+
+class StatusUplink:
+    """
+    Buffers the reports sent to a run's status endpoint and flushes them in
+    ordered batches, every `flush_interval` seconds or every `max_batch_size`
+    reports, whichever comes first. Terminal statuses flush right away.
+    """
+
+    def __init__(
+        self, send_request, flush_interval=0.25, max_batch_size=25, batch_requests=False
+    ):
+        # async send_request(prompt_id, status_endpoint, token, body)
+        self.send_request = send_request
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        # When enabled, a flush is sent as a single {"run_id", "batch": [...]} request
+        self.batch_requests = batch_requests
+        self.pending = {}  # prompt_id -> PendingReports
+        self.flush_tasks = set()
+        self.counters = {
+            "reports_received": 0,
+            "reports_coalesced": 0,
+            "requests_sent": 0,
+            "requests_failed": 0,
+            "flushes": 0,
+        }
+
+    async def report(self, prompt_id, status_endpoint, token, body, flush=False):
+        """Queue a report for the status endpoint, flushing when needed"""
+        if status_endpoint is None:
+            return
+
+        self.counters["reports_received"] += 1
+
+        pending = self.pending.get(prompt_id)
+        if pending is None:
+            pending = PendingReports(prompt_id, status_endpoint, token)
+            self.pending[prompt_id] = pending
+
+        key = coalesce_key(body)
+        if key is not None:
+            for index, (existing_key, _) in enumerate(pending.entries):
+                if existing_key == key:
+                    # Drop the superseded value, the new one goes to the back to keep order
+                    del pending.entries[index]
+                    self.counters["reports_coalesced"] += 1
+                    break
+        pending.entries.append((key, body))
+
+        if flush or is_terminal_report(body):
+            await self.flush(prompt_id)
+        elif len(pending.entries) >= self.max_batch_size:
+            self._schedule_flush(prompt_id, 0)
+        elif pending.flush_handle is None:
+            self._schedule_flush(prompt_id, self.flush_interval)
+
+    def _schedule_flush(self, prompt_id, delay):
+        pending = self.pending.get(prompt_id)
+        if pending is None:
+            return
+        if pending.flush_handle is not None:
+            pending.flush_handle.cancel()
+
+        loop = asyncio.get_running_loop()
+
+        def start_flush():
+            task = loop.create_task(self.flush(prompt_id))
+            self.flush_tasks.add(task)
+            task.add_done_callback(self.flush_tasks.discard)
+
+        pending.flush_handle = loop.call_later(delay, start_flush)
+
+    async def flush(self, prompt_id):
+        """Send everything buffered for a prompt, in arrival order"""
+        pending = self.pending.get(prompt_id)
+        if pending is None:
+            return
+
+        async with pending.lock:
+            if pending.flush_handle is not None:
+                pending.flush_handle.cancel()
+                pending.flush_handle = None
+
+            entries = pending.entries
+            pending.entries = []
+
+            if entries:
+                self.counters["flushes"] += 1
+                bodies = [body for _, body in entries]
+
+                if self.batch_requests and len(bodies) > 1:
+                    batch = {"run_id": prompt_id, "batch": bodies}
+                    await self._send(pending, batch)
+                else:
+                    for body in bodies:
+                        await self._send(pending, body)
+
+            # Reports that arrived while sending are left for the next scheduled flush
+            if (
+                not pending.entries
+                and pending.flush_handle is None
+                and self.pending.get(prompt_id) is pending
+            ):
+                del self.pending[prompt_id]
+
+    async def _send(self, pending, body):
+        try:
+            await self.send_request(
+                pending.prompt_id, pending.status_endpoint, pending.token, body
+            )
+            self.counters["requests_sent"] += 1
+        except Exception as e:
+            self.counters["requests_failed"] += 1
+            logger.error(f"Failed to send status report: {e}")
+
+    async def flush_all(self):
+        for prompt_id in list(self.pending.keys()):
+            await self.flush(prompt_id)
+
+    def stats(self):
+        received = self.counters["reports_received"]
+        sent = self.counters["requests_sent"] + self.counters["requests_failed"]
+        return {
+            **self.counters,
+            "requests_saved": max(0, received - sent - self.pending_count()),
+            "pending_reports": self.pending_count(),
+            "pending_prompts": len(self.pending),
+            "timestamp": time.time(),
+        }
+
+    def pending_count(self):
+        return sum(len(p.entries) for p in self.pending.values())
+
+
+class RunOutbox:
+    """
+    Append-only, on-disk outbox for status endpoint reports.
+
+    Every report is written to the outbox file before it is sent. Each prompt
+    has its own drain task, keeping the order of its reports and backing off
+    on its own when its endpoint fails, so one failing endpoint never holds
+    up the reports of other prompts. Acknowledged entries are compacted away,
+    entries that were not acknowledged before a restart are replayed on the
+    next start.
+
+    Entries keep their run's token so replayed reports are still authorized,
+    the file is only readable by this user and should live outside the
+    repository.
+    """
+
+    def __init__(
+        self,
+        path,
+        send_request,
+        max_concurrent=8,
+        compact_threshold=500,
+        retry_delay=1.0,
+        max_retry_delay=60.0,
+        max_age=24 * 60 * 60,
+        is_permanent_error=None,
+    ):
+        # async send_request(status_endpoint, token, body)
+        self.path = path
+        self.send_request = send_request
+        # is_permanent_error(exception) -> bool, reports that can never succeed are dropped
+        self.is_permanent_error = is_permanent_error
+        self.max_concurrent = max_concurrent
+        self.compact_threshold = compact_threshold
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+
+        self.entries = {}  # seq -> entry, dicts keep insertion (and so seq) order
+        self.queues = {}  # prompt_id -> deque of seqs, in order
+        self.draining = {}  # prompt_id -> drain task
+        self.semaphore = None
+        self.next_seq = 1
+        self.acked_since_compaction = 0
+        self.counters = {
+            "entries_written": 0,
+            "entries_sent": 0,
+            "entries_replayed": 0,
+            "entries_expired": 0,
+            "entries_dropped": 0,
+            "send_failures": 0,
+            "compactions": 0,
+        }
+
+        # A single IO thread keeps appends, acks and compaction strictly ordered
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cd-outbox")
+        self.file = None
+
+    def load(self):
+        """Read back the entries that were never acknowledged"""
+        if not os.path.exists(self.path):
+            return
+
+        entries = {}
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn write from a crash, everything before it is still valid
+                    continue
+                if record.get("op") == "put":
+                    entries[record["seq"]] = record
+                elif record.get("op") == "ack":
+                    entries.pop(record["seq"], None)
+
+        for seq, entry in entries.items():
+            self.queues.setdefault(entry["prompt_id"], deque()).append(seq)
+
+        self.entries = entries
+        if entries:
+            self.next_seq = max(entries) + 1
+            self.counters["entries_replayed"] = len(entries)
+            logger.info(f"Replaying {len(entries)} unsent status reports from outbox")
+
+        # Start from a compacted file
+        self._rewrite()
+
+    def _open_private(self, path, flags):
+        # Entries carry run tokens and outputs, only this user may read them
+        os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        mode = "w" if flags & os.O_TRUNC else "a"
+        return os.fdopen(os.open(path, flags, 0o600), mode)
+
+    def _open(self):
+        if self.file is None:
+            self.file = self._open_private(
+                self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND
+            )
+        return self.file
+
+    def _append(self, lines, sync):
+        f = self._open()
+        f.write("".join(lines))
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with self._open_private(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC) as f:
+            for entry in list(self.entries.values()):
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        os.replace(tmp_path, self.path)
+
+    async def _io(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io, func, *args)
+
+    async def put(self, prompt_id, status_endpoint, token, body):
+        """Durably record a report and hand it to the prompt's drain task"""
+        entry = {
+            "op": "put",
+            "seq": self.next_seq,
+            "prompt_id": prompt_id,
+            "status_endpoint": status_endpoint,
+            "token": token,
+            "body": body,
+            "created_at": time.time(),
+        }
+        self.next_seq += 1
+        self.entries[entry["seq"]] = entry
+
+        # Terminal statuses must survive a crash, so they are fsynced
+        sync = is_terminal_report(body) or any(
+            is_terminal_report(b) for b in body.get("batch", [])
+        )
+        await self._io(self._append, [json.dumps(entry) + "\n"], sync)
+        self.counters["entries_written"] += 1
+
+        self.queues.setdefault(prompt_id, deque()).append(entry["seq"])
+        self._drain(prompt_id)
+
+    def start(self):
+        """Start draining every prompt with entries, e.g. the replayed ones"""
+        for prompt_id in list(self.queues):
+            self._drain(prompt_id)
+
+    def _drain(self, prompt_id):
+        task = self.draining.get(prompt_id)
+        if task is None or task.done():
+            self.draining[prompt_id] = asyncio.create_task(self.drain(prompt_id))
+
+    async def drain(self, prompt_id):
+        """Send a prompt's entries in order, retrying the head with backoff"""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        delay = self.retry_delay
+        queue = self.queues.get(prompt_id)
+        try:
+            while queue:
+                entry = self.entries[queue[0]]
+                try:
+                    async with self.semaphore:
+                        await self.send_request(
+                            entry["status_endpoint"], entry.get("token"), entry["body"]
+                        )
+                    self.counters["entries_sent"] += 1
+                except Exception as e:
+                    self.counters["send_failures"] += 1
+                    permanent = self.is_permanent_error is not None and (
+                        self.is_permanent_error(e)
+                    )
+                    if permanent:
+                        logger.error(
+                            f"Dropping status report for {prompt_id}, it cannot succeed: {e}"
+                        )
+                        self.counters["entries_dropped"] += 1
+                    elif time.time() - entry["created_at"] > self.max_age:
+                        logger.error(
+                            f"Dropping expired status report for {prompt_id}: {e}"
+                        )
+                        self.counters["entries_expired"] += 1
+                    else:
+                        # Later reports of this prompt wait behind this one,
+                        # other prompts carry on
+                        logger.warning(
+                            f"Status report for {prompt_id} failed, retrying in {delay:.1f}s: {e}"
+                        )
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, self.max_retry_delay)
+                        continue
+
+                delay = self.retry_delay
+                queue.popleft()
+                await self.ack([entry["seq"]])
+        finally:
+            if not queue:
+                self.queues.pop(prompt_id, None)
+            if self.draining.get(prompt_id) is asyncio.current_task():
+                del self.draining[prompt_id]
+
+    async def ack(self, seqs):
+        for seq in seqs:
+            self.entries.pop(seq, None)
+        lines = [json.dumps({"op": "ack", "seq": seq}) + "\n" for seq in seqs]
+        await self._io(self._append, lines, False)
+
+        self.acked_since_compaction += len(seqs)
+        if self.acked_since_compaction >= self.compact_threshold:
+            self.acked_since_compaction = 0
+            self.counters["compactions"] += 1
+            await self._io(self._rewrite)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "pending_entries": len(self.entries),
+            "pending_prompts": len(self.queues),
+            "draining_prompts": len(self.draining),
+        }
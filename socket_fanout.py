@@ -0,0 +1,275 @@
+import asyncio
+import json
+import time
+from collections import deque
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+# Superseded by the next message of the same kind, safe to drop under pressure
+DROPPABLE_EVENTS = {"progress", "progress_state", "live_status"}
+
+OVERFLOW_DROP_PROGRESS = "drop_progress"
+OVERFLOW_DISCONNECT = "disconnect"
+
+# Event the comfy deploy log tail is broadcast as
+LOGS_EVENT = "LOGS"
+PREVIEW_IMAGE_EVENT = "preview_image"
+
+
+def message_topics(event, data):
+    """Topics a broadcast is routed by, its event type and its prompt if any"""
+    topics = [("event", event)]
+    if isinstance(data, dict) and data.get("prompt_id") is not None:
+        topics.append(("prompt", data["prompt_id"]))
+    return topics
+
+
+def subscription_topics(prompt_ids=(), events=(), logs=False):
+    topics = {("prompt", p) for p in prompt_ids or ()}
+    topics.update(("event", e) for e in events or ())
+    if logs:
+        topics.add(("event", LOGS_EVENT))
+    return topics
+
+
+class OutboundMessage:
+    __slots__ = ("payload", "is_binary", "droppable", "enqueued_at")
+
+    def __init__(self, payload, is_binary, droppable):
+        self.payload = payload
+        self.is_binary = is_binary
+        self.droppable = droppable
+        self.enqueued_at = time.perf_counter()
+
+
+class SocketChannel:
+    """Bounded outbound queue of one websocket, drained by its own writer task"""
+
+    def __init__(self, sid, ws, max_queue, overflow_policy):
+        self.sid = sid
+        self.ws = ws
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.writer_task = None
+        self.closed = False
+        # Until a socket subscribes to something it receives every broadcast
+        self.filtered = False
+        self.topics = set()
+        self.counters = {
+            "sent": 0,
+            "bytes_sent": 0,
+            "dropped": 0,
+            "max_queued": 0,
+        }
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.avg_lag_ms = 0.0
+
+    def enqueue(self, message: OutboundMessage) -> bool:
+        """Queue a message, False when the socket has to be disconnected"""
+        if self.closed:
+            return True
+
+        if len(self.queue) >= self.max_queue:
+            if self.overflow_policy == OVERFLOW_DISCONNECT:
+                return False
+
+            # Drop the oldest droppable message, or this one if it is droppable
+            for index, queued in enumerate(self.queue):
+                if queued.droppable:
+                    del self.queue[index]
+                    self.counters["dropped"] += 1
+                    break
+            else:
+                if message.droppable:
+                    self.counters["dropped"] += 1
+                    return True
+                # Nothing left to drop, the client is too far behind
+                return False
+
+        self.queue.append(message)
+        self.counters["max_queued"] = max(self.counters["max_queued"], len(self.queue))
+        self.ready.set()
+        return True
+
+    async def writer(self):
+        while not self.closed:
+            if not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            message = self.queue.popleft()
+            if self.ws.closed:
+                break
+            try:
+                if message.is_binary:
+                    await self.ws.send_bytes(message.payload)
+                else:
+                    await self.ws.send_str(message.payload)
+            except Exception as e:
+                logger.info(f"Websocket send to {self.sid} failed: {e}")
+                break
+
+            lag_ms = (time.perf_counter() - message.enqueued_at) * 1000
+            self.last_lag_ms = lag_ms
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            self.avg_lag_ms = self.avg_lag_ms * 0.9 + lag_ms * 0.1
+            self.counters["sent"] += 1
+            self.counters["bytes_sent"] += len(message.payload)
+
+        self.closed = True
+        self.queue.clear()
+
+    def stats(self):
+        return {
+            **self.counters,
+            "queued": len(self.queue),
+            "last_lag_ms": round(self.last_lag_ms, 2),
+            "avg_lag_ms": round(self.avg_lag_ms, 2),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+        }
+
+
+class SocketFanout:
+    """
+    Delivers websocket messages without awaiting the sockets. Each message is
+    serialized once and put on the bounded queue of every target socket, and
+    a writer task per socket sends it, so a slow client only delays itself.
+
+    Broadcasts go to the sockets that never subscribed, plus the sockets
+    subscribed to the message's event type or prompt_id, looked up in a topic
+    index instead of checking every socket.
+    """
+
+    def __init__(self, max_queue=256, overflow_policy=OVERFLOW_DROP_PROGRESS):
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.channels = {}  # sid -> SocketChannel
+        self.unfiltered = set()  # sids receiving every broadcast
+        self.topic_index = {}  # topic -> set of sids
+        self.counters = {
+            "messages_published": 0,
+            "deliveries": 0,
+            "disconnects": 0,
+        }
+
+    def attach(self, sid, ws):
+        self.detach(sid)
+        channel = SocketChannel(sid, ws, self.max_queue, self.overflow_policy)
+        channel.writer_task = asyncio.create_task(channel.writer())
+        self.channels[sid] = channel
+        self.unfiltered.add(sid)
+        return channel
+
+    def detach(self, sid, ws=None):
+        channel = self.channels.get(sid)
+        # A reconnect under the same sid may already own the channel
+        if channel is None or (ws is not None and channel.ws is not ws):
+            return
+        del self.channels[sid]
+        self.unfiltered.discard(sid)
+        self._remove_topics(sid, channel, set(channel.topics))
+        channel.closed = True
+        channel.ready.set()
+
+    def subscribe(self, sid, prompt_ids=(), events=(), logs=False, everything=False):
+        channel = self.channels.get(sid)
+        if channel is None:
+            return
+        if everything:
+            # Back to receiving every broadcast
+            channel.filtered = False
+            self.unfiltered.add(sid)
+            return
+
+        channel.filtered = True
+        self.unfiltered.discard(sid)
+        for topic in subscription_topics(prompt_ids, events, logs):
+            channel.topics.add(topic)
+            self.topic_index.setdefault(topic, set()).add(sid)
+
+    def unsubscribe(self, sid, prompt_ids=(), events=(), logs=False, everything=False):
+        channel = self.channels.get(sid)
+        if channel is None:
+            return
+        channel.filtered = True
+        self.unfiltered.discard(sid)
+        if everything:
+            topics = set(channel.topics)
+        else:
+            topics = subscription_topics(prompt_ids, events, logs)
+        self._remove_topics(sid, channel, topics)
+
+    def _remove_topics(self, sid, channel, topics):
+        for topic in topics:
+            channel.topics.discard(topic)
+            sids = self.topic_index.get(topic)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.topic_index[topic]
+
+    def subscriptions(self, sid):
+        channel = self.channels.get(sid)
+        if channel is None:
+            return None
+        return {
+            "all": not channel.filtered,
+            "prompt_ids": sorted(t[1] for t in channel.topics if t[0] == "prompt"),
+            "events": sorted(t[1] for t in channel.topics if t[0] == "event"),
+        }
+
+    def publish_json(self, event, data, sid=None):
+        message = OutboundMessage(
+            json.dumps({"event": event, "data": data}),
+            is_binary=False,
+            droppable=event in DROPPABLE_EVENTS,
+        )
+        self._publish(message, sid, message_topics(event, data))
+
+    def publish_bytes(
+        self, payload, sid=None, droppable=True, event=PREVIEW_IMAGE_EVENT
+    ):
+        message = OutboundMessage(bytes(payload), True, droppable)
+        self._publish(message, sid, [("event", event)])
+
+    def _publish(self, message, sid, topics):
+        self.counters["messages_published"] += 1
+        if sid is None:
+            sids = set(self.unfiltered)
+            for topic in topics:
+                sids.update(self.topic_index.get(topic, ()))
+            targets = [self.channels[s] for s in sids if s in self.channels]
+        else:
+            channel = self.channels.get(sid)
+            targets = [channel] if channel is not None else []
+
+        for channel in targets:
+            if channel.ws.closed:
+                continue
+            if channel.enqueue(message):
+                self.counters["deliveries"] += 1
+            else:
+                self._disconnect(channel)
+
+    def _disconnect(self, channel):
+        logger.info(
+            f"Disconnecting websocket {channel.sid}, {len(channel.queue)} messages behind"
+        )
+        self.counters["disconnects"] += 1
+        self.detach(channel.sid)
+        asyncio.create_task(channel.ws.close())
+
+    def stats(self):
+        return {
+            **self.counters,
+            "overflow_policy": self.overflow_policy,
+            "max_queue": self.max_queue,
+            "unfiltered_sockets": len(self.unfiltered),
+            "topics": len(self.topic_index),
+            "sockets": {sid: c.stats() for sid, c in self.channels.items()},
+        }
@@ -0,0 +1,278 @@
+import hashlib
+import inspect
+import json
+from collections import OrderedDict
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+# Stands in for the user input literals in the structural hash
+MASKED = "\x00masked"
+
+
+def structural_hash(prompt, masked_fields, partial_execution_targets=None):
+    """Hash of a prompt with the literals at `masked_fields` left out"""
+    masked_nodes = {}
+    for node_id, field in masked_fields:
+        masked_nodes.setdefault(node_id, []).append(field)
+
+    structure = {}
+    for node_id, node in prompt.items():
+        fields = masked_nodes.get(node_id)
+        if fields and isinstance(node.get("inputs"), dict):
+            inputs = dict(node["inputs"])
+            for field in fields:
+                if field in inputs:
+                    inputs[field] = MASKED
+            node = {**node, "inputs": inputs}
+        structure[node_id] = node
+
+    encoded = json.dumps(
+        [structure, partial_execution_targets],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class InputCheck:
+    """What validate_prompt checks for one masked input, read from the node schema"""
+
+    def __init__(self, node_id, field, input_type, options, validate_args):
+        self.node_id = node_id
+        self.field = field
+        self.input_type = input_type
+        self.options = options
+        # Set when the node's VALIDATE_INPUTS takes over checking this input
+        self.validate_args = validate_args
+
+
+class CachedValidation:
+    def __init__(self, outputs_to_execute, node_errors, checks, validators):
+        self.outputs_to_execute = outputs_to_execute
+        self.node_errors = node_errors
+        self.checks = checks
+        # node_id -> (VALIDATE_INPUTS, its argument names)
+        self.validators = validators
+
+
+class ValidationCache:
+    """
+    Caches validate_prompt results of prompts that only differ in their user
+    inputs and seeds. On a hit only the masked inputs are checked, against
+    the node schemas read on the miss, the rest of the graph is known valid.
+    Cleared whenever the installed nodes change, and by invalidate() when a
+    model folder is rescanned.
+
+    A prompt is keyed by the hash of the compiled workflow it was made from,
+    unless prompt_rewritten() says on_prompt handlers may have changed it
+    outside its masked fields, then by its structural hash.
+    """
+
+    def __init__(
+        self,
+        get_node_classes,
+        max_entries=128,
+        prompt_rewritten=None,
+    ):
+        self.get_node_classes = get_node_classes
+        self.prompt_rewritten = prompt_rewritten
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # NODE_CLASS_MAPPINGS and its size when the entries were cached
+        self.node_classes = None
+        self.node_count = 0
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "revalidation_failures": 0,
+            "uncacheable": 0,
+            "invalidations": 0,
+        }
+
+    def invalidate(self):
+        if self.entries:
+            self.counters["invalidations"] += 1
+        self.entries.clear()
+
+    def _check_node_classes(self):
+        # Nodes are only ever added to the mapping, its size tells
+        node_classes = self.get_node_classes()
+        if (
+            node_classes is not self.node_classes
+            or len(node_classes) != self.node_count
+        ):
+            self.invalidate()
+            self.node_classes = node_classes
+            self.node_count = len(node_classes)
+
+    def key(self, prompt, compiled, partial_execution_targets=None):
+        if self.prompt_rewritten is None or self.prompt_rewritten():
+            return structural_hash(
+                prompt, compiled.masked_fields, partial_execution_targets
+            )
+        # Only its masked fields were written to, the rest is the workflow
+        targets = json.dumps(partial_execution_targets, sort_keys=True, default=str)
+        return (compiled.hash, targets)
+
+    def get(self, key, prompt):
+        """A validate_prompt style result for the prompt, or None to validate it fully"""
+        self._check_node_classes()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+
+        if not self._revalidate(entry, prompt):
+            self.counters["revalidation_failures"] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.counters["hits"] += 1
+        return (True, None, list(entry.outputs_to_execute), dict(entry.node_errors))
+
+    def put(
+        self,
+        key,
+        prompt,
+        masked_fields,
+        valid,
+        structure,
+        partial_execution_targets=None,
+    ):
+        """
+        Cache a validate_prompt result, `structure` is the structural_hash of
+        the prompt taken before validating it
+        """
+        if not valid[0]:
+            return
+        # validate_prompt converts literals in place, only cache if it left the
+        # unmasked ones alone
+        after = structural_hash(prompt, masked_fields, partial_execution_targets)
+        if after != structure:
+            self.counters["uncacheable"] += 1
+            return
+
+        checks, validators = self._read_schemas(prompt, masked_fields)
+        if checks is None:
+            self.counters["uncacheable"] += 1
+            return
+
+        self.entries[key] = CachedValidation(
+            list(valid[2]), dict(valid[3] or {}), checks, validators
+        )
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read_schemas(self, prompt, masked_fields):
+        node_classes = self.get_node_classes()
+        checks = []
+        validators = {}
+        schemas = {}
+        for node_id, field in masked_fields:
+            node = prompt.get(node_id)
+            if node is None:
+                continue
+            class_type = node.get("class_type")
+            node_class = node_classes.get(class_type)
+            if node_class is None:
+                return None, None
+
+            if class_type not in schemas:
+                try:
+                    input_types = node_class.INPUT_TYPES()
+                except Exception:
+                    return None, None
+                schema = {}
+                schema.update(input_types.get("optional") or {})
+                schema.update(input_types.get("required") or {})
+                schemas[class_type] = schema
+
+            validate_args = None
+            if hasattr(node_class, "VALIDATE_INPUTS"):
+                args = inspect.getfullargspec(node_class.VALIDATE_INPUTS).args
+                if "input_types" in args:
+                    return None, None
+                validate_args = [a for a in args if a not in ("s", "cls", "self")]
+                validators[node_id] = (node_class.VALIDATE_INPUTS, validate_args)
+
+            spec = schemas[class_type].get(field)
+            if spec is None:
+                # Not an input of the node, validate_prompt ignores it too
+                continue
+
+            input_type = spec[0]
+            options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+            if (
+                validate_args is not None
+                and field in validate_args
+            ):
+                checks.append(InputCheck(node_id, field, None, options, validate_args))
+            else:
+                checks.append(InputCheck(node_id, field, input_type, options, None))
+        return checks, validators
+
+    def _revalidate(self, entry: CachedValidation, prompt):
+        for check in entry.checks:
+            inputs = prompt[check.node_id]["inputs"]
+            if check.field not in inputs:
+                return False
+            value = inputs[check.field]
+            # A link would need the graph checked again
+            if isinstance(value, list):
+                return False
+            if check.input_type is None:
+                continue
+
+            try:
+                value = self._convert(check, value)
+            except (TypeError, ValueError):
+                return False
+            if value is None:
+                return False
+            inputs[check.field] = value
+
+        for node_id, (validate, args) in entry.validators.items():
+            inputs = prompt[node_id]["inputs"]
+            kwargs = {}
+            for arg in args:
+                if arg in inputs:
+                    if isinstance(inputs[arg], list):
+                        return False
+                    kwargs[arg] = inputs[arg]
+            try:
+                if validate(**kwargs) is not True:
+                    return False
+            except Exception:
+                return False
+        return True
+
+    @staticmethod
+    def _convert(check: InputCheck, value):
+        input_type, options = check.input_type, check.options
+        if input_type == "INT":
+            value = int(value)
+        elif input_type == "FLOAT":
+            value = float(value)
+        elif input_type == "STRING":
+            value = str(value)
+        elif input_type == "BOOLEAN":
+            value = bool(value)
+        elif isinstance(input_type, list):
+            return value if value in input_type else None
+        elif input_type == "COMBO":
+            return value if value in options.get("options", []) else None
+        else:
+            # Other types are links, a literal value has to be checked fully
+            return None
+
+        if input_type in ("INT", "FLOAT"):
+            if "min" in options and value < options["min"]:
+                return None
+            if "max" in options and value > options["max"]:
+                return None
+        return value
+
+    def stats(self):
+        return {**self.counters, "entries": len(self.entries)}
@@ -0,0 +1,433 @@
+import hashlib
+import json
+from collections import OrderedDict
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+# Node classes declare which of their inputs receives a run's input value,
+# and which receives the realtime session id
+INPUT_FIELD_ATTR = "DEPLOY_INPUT_FIELD"
+SESSION_FIELD_ATTR = "DEPLOY_SESSION_FIELD"
+
+# class_type -> field, filled from the node classes by register_node_classes
+input_fields = {
+    # No longer shipped, kept so old workflows still get their value
+    "ComfyUIDeployExternalSlider": "default_value",
+}
+session_fields = {}
+
+
+def register_node_classes(node_class_mappings):
+    """Collect the input bindings declared by the given node classes"""
+    for class_type, node_class in node_class_mappings.items():
+        field = getattr(node_class, INPUT_FIELD_ATTR, None)
+        if field is not None:
+            input_fields[class_type] = field
+        field = getattr(node_class, SESSION_FIELD_ATTR, None)
+        if field is not None:
+            session_fields[class_type] = field
+    compiled_workflows.clear()
+
+
+def workflow_hash(workflow_api) -> str:
+    """Content hash of a workflow, equal for equal graphs whatever the key order"""
+    encoded = json.dumps(workflow_api, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def written_fields_hash(compiled, prompt, fields, extra=None) -> str:
+    """
+    Content hash of a prompt made from a compiled workflow by writing to
+    `fields` only: the workflow's hash and what those fields hold, so the
+    prompt isn't encoded again
+    """
+    values = []
+    for node_id, field in fields:
+        inputs = (prompt.get(node_id) or {}).get("inputs") or {}
+        values.append([node_id, field, inputs.get(field)])
+    encoded = json.dumps(
+        [compiled.hash, values, extra],
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class BindingPlan:
+    """Where each input_id of a workflow is written to"""
+
+    def __init__(self):
+        self.input_targets = {}  # input_id -> [(node_id, field), ...]
+        self.session_targets = []  # [(node_id, field), ...]
+
+    def targets(self):
+        return [t for targets in self.input_targets.values() for t in targets]
+
+
+def compile_binding_plan(workflow_api) -> BindingPlan:
+    plan = BindingPlan()
+    for node_id, node in workflow_api.items():
+        inputs = node.get("inputs")
+        if inputs is None:
+            continue
+        class_type = node.get("class_type")
+
+        session_field = session_fields.get(class_type)
+        if session_field is not None:
+            plan.session_targets.append((node_id, session_field))
+
+        input_id = inputs.get("input_id")
+        # A list is a link to another node, not an input
+        if input_id is None or isinstance(input_id, list):
+            continue
+
+        # input_id itself is overwritten too, for backward compatibility
+        targets = plan.input_targets.setdefault(input_id, [])
+        targets.append((node_id, "input_id"))
+        field = input_fields.get(class_type)
+        if field is not None and field != "input_id":
+            targets.append((node_id, field))
+    return plan
+
+
+# Seed policies, the number of digits of the random seed or "sonic" for int32
+DEFAULT_SEED_POLICY = 15
+SEED_RULES = {
+    "SONICSampler": "sonic",
+    "PromptExpansion": 8,
+}
+NOISE_SEED_CLASSES = ("RandomNoise", "KSamplerAdvanced", "SamplerCustom", "XlabsSampler")
+# UI node type -> index of the widget holding its "fixed"/"randomize" seed mode
+SEED_MODE_WIDGETS = {"KSampler": 1}
+
+
+def ui_seed_modes(workflow):
+    """Seed mode widget of the UI nodes that have one, by node id"""
+    modes = {}
+    for node in (workflow or {}).get("nodes", []):
+        index = SEED_MODE_WIDGETS.get(node.get("type"))
+        if index is None:
+            continue
+        widgets = node.get("widgets_values")
+        if isinstance(widgets, list) and len(widgets) > index:
+            # The first node with an id wins, as in the UI lookup it replaces
+            modes.setdefault(str(node["id"]), widgets[index])
+    return modes
+
+
+def seed_candidates(workflow_api):
+    """[(node_id, class_type, field)] of the literal seed inputs of a workflow"""
+    candidates = []
+    for node_id, node in workflow_api.items():
+        inputs = node.get("inputs")
+        if inputs is None:
+            continue
+        for field in ("seed", "noise_seed"):
+            # A list is a link, generally to an `external number int`
+            if field in inputs and not isinstance(inputs[field], list):
+                candidates.append((node_id, node.get("class_type"), field))
+            elif field in inputs:
+                # A linked seed leaves the node alone altogether
+                break
+    return candidates
+
+
+def resolve_seed_targets(candidates, modes):
+    """[(node_id, field, policy)] of the seeds a run randomizes"""
+    targets = []
+    handled = set()
+    for node_id, class_type, field in candidates:
+        if node_id in handled:
+            continue
+
+        if field == "seed":
+            if node_id in modes:
+                # The UI seed mode decides, noise_seed is left alone
+                handled.add(node_id)
+                if modes[node_id] == "fixed":
+                    logger.info(
+                        f"Skipping random seed for KSampler (node {node_id}) as it's set to fixed"
+                    )
+                else:
+                    targets.append((node_id, "seed", DEFAULT_SEED_POLICY))
+                continue
+
+            policy = SEED_RULES.get(class_type)
+            if policy is not None:
+                handled.add(node_id)
+                targets.append((node_id, "seed", policy))
+                continue
+            targets.append((node_id, "seed", DEFAULT_SEED_POLICY))
+
+        elif class_type in NOISE_SEED_CLASSES:
+            targets.append((node_id, "noise_seed", DEFAULT_SEED_POLICY))
+    return targets
+
+
+class CompiledWorkflow:
+    def __init__(self, hash, bindings, seed_candidates):
+        self.hash = hash
+        self.bindings = bindings
+        self.seed_candidates = seed_candidates
+        # Seed targets by the seed modes of the UI workflow they were resolved for
+        self.seed_targets = {}
+        # Every field a run may write to: bindings, session ids and seeds
+        self.masked_fields = (
+            bindings.targets()
+            + bindings.session_targets
+            + [(node_id, field) for node_id, _, field in seed_candidates]
+        )
+
+    def seeds(self, workflow):
+        modes = ui_seed_modes(workflow)
+        key = tuple(sorted(modes.items(), key=lambda item: item[0]))
+        targets = self.seed_targets.get(key)
+        if targets is None:
+            if len(self.seed_targets) >= 8:
+                self.seed_targets.clear()
+            targets = resolve_seed_targets(self.seed_candidates, modes)
+            self.seed_targets[key] = targets
+        return targets
+
+
+class CompiledWorkflowCache:
+    """Compiled plans of recently run workflows, by workflow hash"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get(self, workflow_api, hash=None) -> CompiledWorkflow:
+        if hash is None:
+            hash = workflow_hash(workflow_api)
+
+        compiled = self.entries.get(hash)
+        if compiled is not None:
+            self.entries.move_to_end(hash)
+            self.counters["hits"] += 1
+            return compiled
+
+        self.counters["misses"] += 1
+        compiled = CompiledWorkflow(
+            hash, compile_binding_plan(workflow_api), seed_candidates(workflow_api)
+        )
+        self.entries[hash] = compiled
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {**self.counters, "entries": len(self.entries)}
+
+
+compiled_workflows = CompiledWorkflowCache()
+
+
+def apply_binding_plan(workflow_api, plan: BindingPlan, inputs, sid=None):
+    """Write inputs into a workflow"""
+    if sid is not None:
+        for node_id, field in plan.session_targets:
+            workflow_api[node_id]["inputs"][field] = sid
+
+    if not inputs:
+        return
+
+    for input_id, value in inputs.items():
+        targets = plan.input_targets.get(input_id)
+        if targets is None:
+            continue
+        for node_id, field in targets:
+            workflow_api[node_id]["inputs"][field] = value
+
+
+def fork_workflow_api(workflow_api):
+    """
+    Copy of a workflow for one run. Runs only write input literals (inputs,
+    seeds, validation conversions), so the inputs dicts are copied and the
+    links and values in them are shared.
+    """
+    return {
+        node_id: {**node, "inputs": dict(node["inputs"])}
+        if isinstance(node.get("inputs"), dict)
+        else dict(node)
+        for node_id, node in workflow_api.items()
+    }
+
+
+class PromptTemplate:
+    """
+    A realtime session's workflow prepared once for all of its prompts. A
+    prompt shares its nodes with the base graph, only the nodes receiving an
+    input, the session id or a seed are copied.
+
+    ComfyUI's validate_inputs still writes to the shared nodes: it converts
+    INT, FLOAT, STRING and BOOLEAN literals in place. Those literals are the
+    workflow's own, the conversion of a converted value gives it back
+    unchanged, so after the first prompt the writes are no-ops and every
+    prompt, including one executing meanwhile, reads the same values.
+    """
+
+    def __init__(self, workflow_api, compiled: CompiledWorkflow, workflow=None):
+        # Forked once so the session's own workflow_api stays untouched
+        self.base = fork_workflow_api(workflow_api)
+        self.compiled = compiled
+        # The UI seed modes don't change during a session
+        self.seed_targets = compiled.seeds(workflow)
+
+    def materialize(self, inputs=None, sid=None, seed=None):
+        """The prompt for one frame, seed(policy) -> value randomizes the seeds"""
+        plan = self.compiled.bindings
+        writes = {}  # node_id -> {field: value}
+        if seed is not None:
+            for node_id, field, policy in self.seed_targets:
+                writes.setdefault(node_id, {})[field] = seed(policy)
+        if sid is not None:
+            for node_id, field in plan.session_targets:
+                writes.setdefault(node_id, {})[field] = sid
+        for input_id, value in (inputs or {}).items():
+            targets = plan.input_targets.get(input_id)
+            if targets is None:
+                continue
+            for node_id, field in targets:
+                writes.setdefault(node_id, {})[field] = value
+
+        prompt = dict(self.base)
+        for node_id, fields in writes.items():
+            node = self.base[node_id]
+            prompt[node_id] = {**node, "inputs": {**node["inputs"], **fields}}
+        return prompt
+
+
+def api_from_ui_workflow(workflow, copies=1):
+    """
+    Approximate workflow_api of a UI workflow, for the benchmarks. Widgets
+    are named after their linked inputs where known, external nodes get
+    input_id and default_value, and the graph can be repeated `copies` times
+    to stand in for larger workflows.
+    """
+    links = {link[0]: link for link in workflow.get("links", [])}
+    workflow_api = {}
+    for copy in range(copies):
+        offset = copy * (workflow.get("last_node_id", 0) + 1)
+        for node in workflow["nodes"]:
+            inputs = {}
+            for node_input in node.get("inputs", []):
+                link = links.get(node_input.get("link"))
+                if link is not None:
+                    inputs[node_input["name"]] = [str(link[1] + offset), link[2]]
+            widgets = node.get("widgets_values")
+            if isinstance(widgets, list):
+                if node["type"].startswith("ComfyUIDeployExternal"):
+                    names = ["input_id", "default_value"]
+                elif node["type"] in ("KSampler", "SONICSampler", "PromptExpansion"):
+                    names = ["seed"]
+                elif node["type"] in ("RandomNoise", "KSamplerAdvanced"):
+                    names = ["noise_seed"]
+                else:
+                    names = []
+                for index, value in enumerate(widgets):
+                    name = names[index] if index < len(names) else f"widget_{index}"
+                    inputs.setdefault(name, value)
+            workflow_api[str(node["id"] + offset)] = {
+                "class_type": node["type"],
+                "inputs": inputs,
+            }
+    return workflow_api
+
+
+if __name__ == "__main__":
+    import argparse
+    import copy
+    import glob
+    import os
+    import time
+
+    parser = argparse.ArgumentParser(description="Benchmark workflow binding plans")
+    parser.add_argument("--copies", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument(
+        "--sizes",
+        default="1,10,50,200",
+        help="Graph copies for the realtime prompt benchmark",
+    )
+    args = parser.parse_args()
+
+    input_fields.update(
+        {
+            "ComfyUIDeployExternalText": "default_value",
+            "ComfyUIDeployExternalNumberInt": "default_value",
+            "ComfyUIDeployExternalImage": "default_value",
+        }
+    )
+
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+    print(f"{'workflow':<32}{'nodes':>7}{'scan ms':>10}{'hash ms':>10}{'plan ms':>10}")
+    for path in sorted(glob.glob(os.path.join(examples, "*.json"))):
+        with open(path) as f:
+            workflow_api = api_from_ui_workflow(json.load(f), args.copies)
+        inputs = {
+            input_id: "value"
+            for input_id in compile_binding_plan(workflow_api).input_targets
+        }
+        runs = [copy.deepcopy(workflow_api) for _ in range(args.runs)]
+
+        start = time.perf_counter()
+        for run in runs:
+            apply_binding_plan(run, compile_binding_plan(run), inputs)
+        scan = (time.perf_counter() - start) / args.runs * 1000
+
+        runs = [copy.deepcopy(workflow_api) for _ in range(args.runs)]
+        start = time.perf_counter()
+        for run in runs:
+            workflow_hash(run)
+        hashing = (time.perf_counter() - start) / args.runs * 1000
+
+        plan = compiled_workflows.get(workflow_api).bindings
+        start = time.perf_counter()
+        for run in runs:
+            apply_binding_plan(run, plan, inputs)
+        planned = (time.perf_counter() - start) / args.runs * 1000
+
+        name = os.path.basename(path)
+        print(
+            f"{name:<32}{len(workflow_api):>7}{scan:>10.3f}{hashing:>10.3f}{planned:>10.3f}"
+        )
+
+    # Realtime: a queue_prompt per frame, deepcopy + apply against a template
+    sizes = [int(size) for size in args.sizes.split(",")]
+    print()
+    print(f"{'realtime prompt':<40}{'nodes':>7}{'copy ms':>10}{'template ms':>13}")
+    for path in sorted(glob.glob(os.path.join(examples, "*.json"))):
+        with open(path) as f:
+            ui_workflow = json.load(f)
+        for size in sizes:
+            workflow_api = api_from_ui_workflow(ui_workflow, size)
+            workflow = {**ui_workflow, "nodes": ui_workflow["nodes"] * size}
+            compiled = compiled_workflows.get(workflow_api)
+            inputs = {input_id: "value" for input_id in compiled.bindings.input_targets}
+
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                run = copy.deepcopy(workflow_api)
+                run_workflow = copy.deepcopy(workflow)
+                for node_id, field, _ in compiled.seeds(run_workflow):
+                    run[node_id]["inputs"][field] = 0
+                apply_binding_plan(run, compiled.bindings, inputs, sid="sid")
+            copied = (time.perf_counter() - start) / args.runs * 1000
+
+            template = PromptTemplate(workflow_api, compiled, workflow)
+            start = time.perf_counter()
+            for _ in range(args.runs):
+                template.materialize(inputs, sid="sid", seed=lambda policy: 0)
+            templated = (time.perf_counter() - start) / args.runs * 1000
+
+            name = f"{os.path.basename(path)} x{size}"
+            print(
+                f"{name:<40}{len(workflow_api):>7}{copied:>10.3f}{templated:>13.3f}"
+            )
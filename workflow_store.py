@@ -0,0 +1,101 @@
+import hashlib
+import json
+from collections import OrderedDict
+from logging import getLogger
+
+logger = getLogger("comfy-deploy")
+
+
+class StoredWorkflow:
+    """
+    A workflow_api and its UI workflow, shared by every run referencing it.
+    Never mutated, runs write to a fork_workflow_api copy.
+    """
+
+    __slots__ = ("hash", "api_hash", "workflow_api", "workflow", "size")
+
+    def __init__(self, hash, api_hash, workflow_api, workflow, size):
+        self.hash = hash
+        self.api_hash = api_hash
+        self.workflow_api = workflow_api
+        self.workflow = workflow
+        self.size = size
+
+
+def stored_workflow_hash(api_hash, workflow):
+    """Content hash of a workflow_api (by its workflow_hash) and UI workflow pair"""
+    ui_encoded = json.dumps(workflow, sort_keys=True, separators=(",", ":"))
+    ui_hash = hashlib.sha256(ui_encoded.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{api_hash}:{ui_hash}".encode()).hexdigest(), len(
+        ui_encoded
+    )
+
+
+class WorkflowStore:
+    """
+    Workflows uploaded once and referenced by hash in run requests, least
+    recently used evicted beyond `max_entries` or `max_bytes` (measured as
+    the size of their canonical JSON).
+    """
+
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # hash -> StoredWorkflow
+        self.total_bytes = 0
+        self.counters = {
+            "puts": 0,
+            "interned": 0,
+            "hits": 0,
+            "misses": 0,
+            "evicted": 0,
+        }
+
+    def put(self, workflow_api, workflow=None) -> StoredWorkflow:
+        self.counters["puts"] += 1
+        api_encoded = json.dumps(workflow_api, sort_keys=True, separators=(",", ":"))
+        # workflow_hash of the same encoding
+        api_hash = hashlib.sha256(api_encoded.encode("utf-8")).hexdigest()
+        hash, ui_size = stored_workflow_hash(api_hash, workflow)
+
+        stored = self.entries.get(hash)
+        if stored is not None:
+            # Already known, the existing copy stays the shared one
+            self.counters["interned"] += 1
+            self.entries.move_to_end(hash)
+            return stored
+
+        stored = StoredWorkflow(
+            hash, api_hash, workflow_api, workflow, len(api_encoded) + ui_size
+        )
+        self.entries[hash] = stored
+        self.total_bytes += stored.size
+        self._evict()
+        return stored
+
+    def get(self, hash):
+        stored = self.entries.get(hash)
+        if stored is None:
+            self.counters["misses"] += 1
+            return None
+        self.entries.move_to_end(hash)
+        self.counters["hits"] += 1
+        return stored
+
+    def __contains__(self, hash):
+        return hash in self.entries
+
+    def _evict(self):
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes
+        ):
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+            self.counters["evicted"] += 1
+
+    def stats(self):
+        return {
+            **self.counters,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+        }